@@ -1,6 +1,25 @@
+"""Subpackages and modules are imported lazily on first attribute access,
+i.e., cascade.tca, so that `import cascade` does not pull in TensorFlow,
+matplotlib, seaborn, or statsmodels until a module that needs them is used."""
+import importlib
+
 # Folders
-from . import metadata, plotting, calc, psytrack
+_subpackages = ('metadata', 'plotting', 'calc', 'psytrack')
 # Files
-from . import df, tca, utils, paths, cluster, glm, bias, load, trialhistory
-from . import cvglm, lookups, adaptation, tuning, stability, mismatch
-from . import categorize, drive
+_modules = ('df', 'tca', 'utils', 'paths', 'cluster', 'glm', 'bias', 'load',
+            'trialhistory', 'cvglm', 'lookups', 'adaptation', 'tuning',
+            'stability', 'mismatch', 'categorize', 'drive', 'store', 'cache')
+
+__all__ = list(_subpackages + _modules)
+
+
+def __getattr__(name):
+    if name in __all__:
+        module = importlib.import_module('.' + name, __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
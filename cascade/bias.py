@@ -7,7 +7,6 @@ import os
 from . import utils
 from . import lookups
 from copy import deepcopy
-from tensortools.tensors import KTensor
 
 
 def get_lick_mask(meta, tensor, buffer_frames=1):
@@ -252,6 +251,8 @@ def get_bias_from_ablated_data(meta, input_tensor, model, model_rank, save_folde
 def ablate_Ktensor(tt_factors, fac_num_to_remove):
     """Create full matrix from an ablated (one factor removed) KTensor from tensortool."""
 
+    from tensortools.tensors import KTensor
+
     # turn factors into tuple, then remove factor from each mode's matrix
     factors = tuple(tt_factors)
     factors = tuple([np.delete(f, fac_num_to_remove, axis=1) for f in factors])
@@ -266,6 +267,8 @@ def ablate_Ktensor(tt_factors, fac_num_to_remove):
 def ablate_data_with_Ktensor(data_tensor, tt_factors, fac_num_to_keep):
     """Create full matrix removing a single tensor component from your data."""
 
+    from tensortools.tensors import KTensor
+
     # turn factors into tuple, then select a single factor from each mode's matrix
     factors = tuple(tt_factors)
     factors = tuple([f[:, fac_num_to_keep][:, None] for f in factors])
@@ -281,6 +284,8 @@ def ablate_data_with_Ktensor(data_tensor, tt_factors, fac_num_to_keep):
 def full_factor(tt_factors, fac_num_to_keep):
     """Create full matrix removing a single tensor component from your data."""
 
+    from tensortools.tensors import KTensor
+
     # turn factors into tuple, then select a single factor from each mode's matrix
     factors = tuple(tt_factors)
     factors = tuple([f[:, fac_num_to_keep][:, None] for f in factors])
@@ -0,0 +1,302 @@
+"""Functions for a per-mouse artifact cache keyed on complete parameter sets.
+
+Each artifact (i.e., TCA meta, tensor, bhv, ids, decomp, or test tensor) is
+registered in a json manifest in the mouse's output directory under a key
+hashed from every parameter that determines its contents. The manifest holds
+the kind, parameters, locations, size, and creation and last access times of
+each artifact, so artifacts can be reused across parameter sets that share
+them (i.e., keep the tensor but refit the model) and least recently used
+artifacts can be evicted to stay under a disk budget.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import flow
+import pandas as pd
+from . import store
+
+# access times are only rewritten once they are this old (s), so loading
+# an artifact does not write the manifest every time
+touch_interval = 3600
+
+
+def artifact_key(pars):
+    """
+    Hash a complete parameter set into a key.
+
+    :param pars: dict, json-serializable (non-serializable values are
+        converted with str) parameters that determine an artifact
+    :return: str, hex digest
+    """
+
+    blob = json.dumps(pars, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+
+def manifest_path(mouse):
+    """
+    Path of the artifact manifest for a mouse.
+
+    :param mouse: str, mouse name
+    :return: str, path of manifest
+    """
+
+    return os.path.join(flow.paths.outd, str(mouse), 'artifact_manifest.json')
+
+
+def _read_manifest(mouse):
+    """Read the manifest for a mouse, empty if none exists."""
+
+    path = manifest_path(mouse)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def _write_manifest(mouse, manifest):
+    """Write the manifest for a mouse, replacing the old file in one step."""
+
+    path = manifest_path(mouse)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.mkdir(os.path.dirname(path))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(json.dumps(manifest))
+    os.replace(tmp_path, path)
+
+
+def _refresh_manifest(mouse, manifest):
+    """
+    Write the manifest after a lookup or touch. Failures are ignored so
+    artifacts can be loaded from read-only data directories.
+    """
+
+    try:
+        _write_manifest(mouse, manifest)
+    except OSError:
+        pass
+
+
+def _artifact_files(path):
+    """
+    All files and folders on disk that belong to an artifact saved at path:
+    the file itself plus any trial chunks, per-rank factors, or fit
+    checkpoints saved next to it by store, or enriched metadata.
+    """
+
+    files = [path, store.chunk_dir(path), store.factor_dir(path),
+             store.checkpoint_dir(path)]
+    if path.endswith('.pkl'):
+        # enriched trial metadata saved by load.groupday_tca_meta
+        files.append(path.replace('.pkl', '_enriched.pkl'))
+    return [f for f in files if os.path.exists(f)]
+
+
+def _disk_size(path):
+    """Size in bytes of a file or of all files in a folder."""
+
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        size += sum([os.path.getsize(os.path.join(root, f)) for f in files])
+    return size
+
+
+def _exists(path):
+    """Check if an artifact exists in either the .npy/.pkl or chunked format."""
+
+    return os.path.isfile(path) or store.tensor_exists(path)
+
+
+def register(mouse, kind, pars, path):
+    """
+    Add an artifact that has been saved at path to the manifest. Registering
+    the same parameters again at a new path adds that path as another
+    location of the same artifact (i.e., a hard link made by link_to).
+
+    :param mouse: str, mouse name
+    :param kind: str, type of artifact, i.e., 'tensor' or 'decomp'
+    :param pars: dict, complete parameter set that determines the artifact
+    :param path: str, path artifact was saved to
+    :return: str, artifact key
+    """
+
+    key = artifact_key({'kind': kind, 'pars': pars})
+    manifest = _read_manifest(mouse)
+    now = time.time()
+    entry = manifest.get(key, {'kind': kind, 'pars': json.loads(
+        json.dumps(pars, default=str)), 'paths': [], 'created': now})
+    if path not in entry['paths']:
+        entry['paths'].append(path)
+    entry['size'] = sum([_disk_size(f) for f in _artifact_files(path)])
+    entry['accessed'] = now
+    manifest[key] = entry
+    _write_manifest(mouse, manifest)
+
+    return key
+
+
+def lookup(mouse, kind, pars, touch=True):
+    """
+    Find a cached artifact. Locations that no longer exist on disk are
+    dropped from the manifest.
+
+    :param mouse: str, mouse name
+    :param kind: str, type of artifact, i.e., 'tensor' or 'decomp'
+    :param pars: dict, complete parameter set that determines the artifact
+    :param touch: bool, update last access time
+    :return: str, path of artifact, None if it is not cached
+    """
+
+    key = artifact_key({'kind': kind, 'pars': pars})
+    manifest = _read_manifest(mouse)
+    if key not in manifest:
+        return None
+    entry = manifest[key]
+    paths = [p for p in entry['paths'] if _exists(p)]
+    if len(paths) == 0:
+        manifest.pop(key)
+        _refresh_manifest(mouse, manifest)
+        return None
+    now = time.time()
+    stale = touch and now - entry['accessed'] > touch_interval
+    if stale or len(paths) < len(entry['paths']):
+        entry['paths'] = paths
+        entry['accessed'] = now if stale else entry['accessed']
+        _refresh_manifest(mouse, manifest)
+
+    return paths[0]
+
+
+def touch(mouse, path):
+    """
+    Update the last access time of any artifact saved at path so that loading
+    it protects it from eviction. The manifest is only rewritten if the last
+    access was more than touch_interval seconds ago and is left as is if it
+    cannot be written (i.e., a read-only data directory).
+
+    :param mouse: str, mouse name
+    :param path: str, path of artifact
+    """
+
+    manifest = _read_manifest(mouse)
+    now = time.time()
+    changed = False
+    for entry in manifest.values():
+        if path in entry['paths'] and now - entry['accessed'] > touch_interval:
+            entry['accessed'] = now
+            changed = True
+    if changed:
+        _refresh_manifest(mouse, manifest)
+
+
+def link_to(path, save_dir):
+    """
+    Make an artifact available in another folder without copying it, using
+    hard links for the file and any chunk, factor, or checkpoint folders.
+    Falls back to copying if hard links are not supported.
+
+    :param path: str, path of cached artifact
+    :param save_dir: str, folder to link into
+    :return: str, new path of artifact
+    """
+
+    new_path = os.path.join(save_dir, os.path.basename(path))
+    if os.path.abspath(new_path) == os.path.abspath(path):
+        return path
+    for src in _artifact_files(path):
+        dst = os.path.join(save_dir, os.path.basename(src))
+        if os.path.exists(dst):
+            continue
+        try:
+            if os.path.isdir(src):
+                shutil.copytree(src, dst, copy_function=os.link)
+            else:
+                os.link(src, dst)
+        except OSError:
+            if os.path.isdir(dst):
+                shutil.rmtree(dst)
+            if os.path.isdir(src):
+                shutil.copytree(src, dst)
+            else:
+                shutil.copy2(src, dst)
+
+    return new_path
+
+
+def manifest(mouse):
+    """
+    Cached artifacts for a mouse.
+
+    :param mouse: str, mouse name
+    :return: pandas.DataFrame, one row per artifact indexed by key, most
+             recently accessed first
+    """
+
+    entries = _read_manifest(mouse)
+    df = pd.DataFrame(
+        [{'key': k, 'kind': e['kind'], 'size': e['size'], 'created': e['created'],
+          'accessed': e['accessed'], 'paths': e['paths']} for k, e in entries.items()],
+        columns=['key', 'kind', 'size', 'created', 'accessed', 'paths'])
+    df['created'] = pd.to_datetime(df['created'], unit='s')
+    df['accessed'] = pd.to_datetime(df['accessed'], unit='s')
+
+    return df.set_index('key').sort_values('accessed', ascending=False)
+
+
+def _dependents(manifest, key):
+    """
+    Keys of models fit to a data artifact (i.e., decomps fit to a tensor).
+    Their folders hold hard links of the data made by link_to, so they can
+    not outlive it.
+    """
+
+    if manifest[key]['kind'] == 'decomp':
+        return []
+    data_key = artifact_key(manifest[key]['pars'])
+    return [k for k, e in manifest.items()
+            if e['kind'] == 'decomp' and e['pars'].get('data') == data_key]
+
+
+def evict(mouse, max_bytes, keep=()):
+    """
+    Delete least recently used artifacts (all of their locations) until the
+    cached artifacts for a mouse fit in max_bytes. Evicting a data artifact
+    also evicts the models fit to it, and data with a kept model is kept.
+
+    :param mouse: str, mouse name
+    :param max_bytes: int, disk budget in bytes
+    :param keep: list of str, keys of artifacts that are never evicted
+    :return: list of str, keys of evicted artifacts
+    """
+
+    manifest = _read_manifest(mouse)
+    total = sum([e['size'] for e in manifest.values()])
+    evicted = []
+    for key in sorted(manifest, key=lambda k: manifest[k]['accessed']):
+        if total <= max_bytes:
+            break
+        if key in keep or key not in manifest:
+            continue
+        dependents = _dependents(manifest, key)
+        if any([k in keep for k in dependents]):
+            continue
+        for k in [key] + dependents:
+            for path in manifest[k]['paths']:
+                for f in _artifact_files(path):
+                    if os.path.isdir(f):
+                        shutil.rmtree(f)
+                    else:
+                        os.remove(f)
+            total -= manifest[k]['size']
+            manifest.pop(k)
+            evicted.append(k)
+            print('Evicted cached artifact: {}'.format(k))
+    if len(evicted) > 0:
+        _write_manifest(mouse, manifest)
+
+    return evicted
@@ -1,2 +1,20 @@
+"""Calc modules are imported lazily on first attribute access,
+i.e., cascade.calc.var, see cascade/__init__.py."""
+import importlib
+
 # Files
-from . import var, fits, misc, tca
+_modules = ('var', 'fits', 'misc', 'tca')
+
+__all__ = list(_modules)
+
+
+def __getattr__(name):
+    if name in __all__:
+        module = importlib.import_module('.' + name, __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
@@ -8,6 +8,7 @@ import pool
 import pandas as pd
 import numpy as np
 import os
+import warnings
 import bottleneck as bt
 from copy import deepcopy
 from .. import load, utils
@@ -24,7 +25,8 @@ def trialbytrial_drive(
         group_by='all2',
         nan_thresh=0.85,
         score_threshold=0.8,
-        drive_type='visual'):
+        drive_type='visual',
+        n_jobs=1):
     """
     Create a cells x trials array that contains the log inverse p-values
     of each trial compared to the distributions of the baseline response
@@ -32,6 +34,9 @@ def trialbytrial_drive(
 
     This is a wrapped function so that a flow Mouse object is correctly
     passed to the memoizer and MongoDB database. 
+
+    n_jobs is the number of worker processes to split cells across, it
+    does not change the result.
     """
 
     drive_mat = trialbytrial_drive_sub(
@@ -44,7 +49,8 @@ def trialbytrial_drive(
         group_by=group_by,
         nan_thresh=nan_thresh,
         score_threshold=score_threshold,
-        drive_type=drive_type)
+        drive_type=drive_type,
+        n_jobs=n_jobs)
 
     return drive_mat
 
@@ -60,7 +66,8 @@ def trialbytrial_drive_sub(
         group_by='all2',
         nan_thresh=0.85,
         score_threshold=0.8,
-        drive_type='visual'):
+        drive_type='visual',
+        n_jobs=1):
     """
     Create a cells x trials array that contains the log inverse p-values
     of each trial compared to the distributions of the baseline response
@@ -83,9 +90,9 @@ def trialbytrial_drive_sub(
         score_threshold=score_threshold)
 
     if drive_type == 'visual':
-        drive_mat = _trial_driven_visually(tensor, mouse, sec=15.5)
+        drive_mat = _trial_driven_visually(tensor, mouse, sec=15.5, n_jobs=n_jobs)
     elif drive_type == 'trial':
-        drive_mat = _trial_driven_trial(tensor, mouse, sec=15.5)
+        drive_mat = _trial_driven_trial(tensor, mouse, sec=15.5, n_jobs=n_jobs)
     else:
         print('{}: requested {}: drive_type not recognized.'.format(
             mouse, drive_type))
@@ -340,7 +347,7 @@ def trial_factor_tuning(
     return tuning_df
 
 
-def _trial_driven_visually(tensor, mouse, sec=15.5):
+def _trial_driven_visually(tensor, mouse, sec=15.5, n_jobs=1):
     """
     Calculate the probability of being visually driven for each cell
     per trial.
@@ -353,6 +360,8 @@ def _trial_driven_visually(tensor, mouse, sec=15.5):
         The mouse name.
     sec : float
         How many samples per second in the input data?
+    n_jobs : int
+        Number of worker processes to split cells across.
 
     Returns:
     --------
@@ -372,31 +381,18 @@ def _trial_driven_visually(tensor, mouse, sec=15.5):
     # Per-cell value
     meanbl = np.nanmean(baselines, axis=1)
     ncells = tensor.shape[0]
+    ntrials = np.sum(~np.isnan(baselines), axis=1)
+    bonferroni_n = ncells*ntrials
 
-    # We will save the maximum inverse p values
-    maxinvps = np.zeros((ncells, tensor.shape[2]), dtype=np.float64)
-
-    for c in range(ncells):
-        cell_baseline_vec = full_baselines[c, :, :].flatten()
-        cell_baseline_vec = cell_baseline_vec[~np.isnan(cell_baseline_vec)]
-        ntrials = np.sum(~np.isnan(baselines[c,:]).flatten())
-        bonferroni_n = ncells*ntrials
-        
-        for trial in range(tensor.shape[2]):
-            # skip nans
-            if np.isnan(stimuli[c, 0, trial]):
-                continue
-            # don't test a cell if it is negative on average
-            if np.nanmean(stimuli[c, :, trial]) > meanbl[c]:
-                pv = sp.stats.ks_2samp(cell_baseline_vec, stimuli[c, :, trial])
-                logpv = -1*np.log(pv[1]*bonferroni_n)
-                if logpv > maxinvps[c, trial]:
-                    maxinvps[c, trial] = logpv
+    # We will save the maximum inverse p values, don't test a cell if it is
+    # negative on average
+    maxinvps = _ks_drive(full_baselines, stimuli, meanbl, bonferroni_n,
+                         mean=np.nanmean, log=np.log, n_jobs=n_jobs)
 
     return maxinvps
 
 
-def _trial_driven_visually_bins(tensor, mouse, sec=15.5, bins_per_sec=2):
+def _trial_driven_visually_bins(tensor, mouse, sec=15.5, bins_per_sec=2, n_jobs=1):
     """
     Calculate the probability of being visually driven for each cell
     per trial across multiple bins with Bonferroni correction.
@@ -409,6 +405,8 @@ def _trial_driven_visually_bins(tensor, mouse, sec=15.5, bins_per_sec=2):
         The mouse name.
     sec : float
         How many samples per second in the input data?
+    n_jobs : int
+        Number of worker processes to split cells across.
 
     Returns:
     --------
@@ -438,41 +436,14 @@ def _trial_driven_visually_bins(tensor, mouse, sec=15.5, bins_per_sec=2):
     # Per-cell value
     meanbl = bt.nanmean(baselines, axis=1)
     ncells = tensor.shape[0]
+    ntrials = np.sum(~np.isnan(baselines), axis=1)
+    bonferroni_n = ncells*ntrials*nbins
 
-    # We will save the maximum inverse p values
-    maxinvps = np.zeros((ncells, tensor.shape[2]), dtype=np.float64)
-
-    for c in range(ncells):
-        cell_baseline_vec = full_baselines[c, :, :].flatten()
-        cell_baseline_vec = cell_baseline_vec[~np.isnan(cell_baseline_vec)]
-        ntrials = np.sum(~np.isnan(baselines[c,:]).flatten())
-        bonferroni_n = ncells*ntrials*nbins
-        
-        for trial in range(tensor.shape[2]):
-
-            # skip nans
-            if np.isnan(stimuli[c, 0, trial]):
-                continue
-
-            bin_pvs = []
-
-            for bin_s, bin_e in zip(bin_starts, bin_ends):
-
-                # get your bin and mean of that bin once
-                this_bin = stimuli[c, bin_s:bin_e, trial]
-                bin_mean = bt.nanmean(this_bin)
-
-                # don't test a bin if it is negative on average
-                if bin_mean > meanbl[c]:
-                    pv = sp.stats.ks_2samp(cell_baseline_vec, this_bin)
-                    bin_pvs.append(pv[1])
-
-            # if no values were above zero skip cell
-            if len(bin_pvs) > 0:
-                best_pv = np.min(bin_pvs)
-                logpv = -1*np.log10(best_pv*bonferroni_n)
-                if logpv > maxinvps[c, trial]:
-                    maxinvps[c, trial] = logpv
+    # We will save the maximum inverse p values, don't test a bin if it is
+    # negative on average
+    maxinvps = _ks_drive(full_baselines, stimuli, meanbl, bonferroni_n,
+                         bins=list(zip(bin_starts, bin_ends)), log=np.log10,
+                         n_jobs=n_jobs)
 
     return maxinvps
 
@@ -548,26 +519,27 @@ def _trial_driven_visually_fast_levene(tensor, mouse, sec=15.5):
     for c in range(ncells):
         cell_baseline_vec = binned_baselines[c, :, :].flatten()
         cell_baseline_vec = cell_baseline_vec[~np.isnan(cell_baseline_vec)]
-        
+        if len(cell_baseline_vec) == 0:
+            continue
+
         ntrials = np.sum(~np.isnan(baselines[c,:]).flatten())
         bonferroni_n = ncells*ntrials
-        
-        for trial in range(tensor.shape[2]):
 
-            # skip nans
-            if np.isnan(stimuli[c, 0, trial]):
-                continue
+        # skip nans, don't test a bin if it is negative on average
+        with np.errstate(invalid='ignore'):
+            tested = ~np.isnan(stimuli[c, 0, :]) & (bt.nanmean(binned_stimuli[c, :, :], axis=0) > 0)
+        if np.sum(tested) == 0:
+            continue
 
-            # don't test a bin if it is negative on average
-            if bt.nanmean(binned_stimuli[c, :, trial]) > 0:
-                pv = sp.stats.levene(cell_baseline_vec, binned_stimuli[c, :, trial])
-                logpv = -1*np.log10(pv[1]*bonferroni_n)
-                if logpv > 0:
-                    maxinvps[c, trial] = logpv
+        # test all trials against the same baseline at once
+        pv = sp.stats.levene(cell_baseline_vec[None, :], binned_stimuli[c, :, tested], axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            logpv = -1*np.log10(pv[1]*bonferroni_n)
+        maxinvps[c, tested] = np.where(logpv > 0, logpv, 0)
 
     return maxinvps
 
-def _trial_driven_visually_bins_local(tensor, mouse, sec=15.5, bins_per_sec=2):
+def _trial_driven_visually_bins_local(tensor, mouse, sec=15.5, bins_per_sec=2, n_jobs=1):
     """
     Calculate the probability of being visually driven for each cell
     per trial across multiple bins with Bonferroni correction. Baseline
@@ -582,6 +554,8 @@ def _trial_driven_visually_bins_local(tensor, mouse, sec=15.5, bins_per_sec=2):
         The mouse name.
     sec : float
         How many samples per second in the input data?
+    n_jobs : int
+        Number of worker processes to split cells across.
 
     Returns:
     --------
@@ -609,51 +583,20 @@ def _trial_driven_visually_bins_local(tensor, mouse, sec=15.5, bins_per_sec=2):
     nbins = len(bin_ends)
 
     # Per-cell value
-    meanbl = bt.nanmean(baselines, axis=1)
     ncells = tensor.shape[0]
+    ntrials = np.sum(~np.isnan(baselines), axis=1)
+    bonferroni_n = ncells*ntrials*nbins
 
-    # We will save the maximum inverse p values
-    maxinvps = np.zeros((ncells, tensor.shape[2]), dtype=np.float64)
-
-    for c in range(ncells):
-        cell_baseline_vec = full_baselines[c, :, :].flatten()
-        cell_baseline_vec = cell_baseline_vec[~np.isnan(cell_baseline_vec)]
-        ntrials = np.sum(~np.isnan(baselines[c,:]).flatten())
-        bonferroni_n = ncells*ntrials*nbins
-        
-        for trial in range(tensor.shape[2]):
-
-            # skip nans
-            if np.isnan(stimuli[c, 0, trial]):
-                continue
-
-            bin_pvs = []
-
-            # get the vector that is the baseline response for the trial
-            local_baseline_vec = full_baselines[c, :, trial]
-
-            for bin_s, bin_e in zip(bin_starts, bin_ends):
-
-                # get your bin and mean of that bin once
-                this_bin = stimuli[c, bin_s:bin_e, trial]
-                bin_mean = bt.nanmean(this_bin)
-
-                # don't test a bin if it is negative on average
-                if bin_mean > 0:
-                    pv = sp.stats.ks_2samp(local_baseline_vec, this_bin)
-                    bin_pvs.append(pv[1])
-
-            # if no values were above zero skip cell
-            if len(bin_pvs) > 0:
-                best_pv = np.min(bin_pvs)
-                logpv = -1*np.log10(best_pv*bonferroni_n)
-                if logpv > 0:
-                    maxinvps[c, trial] = logpv
+    # We will save the maximum inverse p values, testing each trial against
+    # its own baseline and skipping bins that are negative on average
+    maxinvps = _ks_drive(full_baselines, stimuli, np.zeros(ncells), bonferroni_n,
+                         bins=list(zip(bin_starts, bin_ends)), local=True,
+                         log=np.log10, n_jobs=n_jobs)
 
     return maxinvps
 
 
-def _trial_driven_trial(tensor, mouse, sec=15.5):
+def _trial_driven_trial(tensor, mouse, sec=15.5, n_jobs=1):
     """
     Calculate the probability of being visually driven for each cell
     per trial.                                           |
@@ -667,6 +610,8 @@ def _trial_driven_trial(tensor, mouse, sec=15.5):
         The mouse name.
     sec : float
         How many samples per second in the input data?
+    n_jobs : int
+        Number of worker processes to split cells across.
 
     Returns:
     --------
@@ -686,22 +631,178 @@ def _trial_driven_trial(tensor, mouse, sec=15.5):
     # Per-cell value
     meanbl = np.nanmean(baselines, axis=1)
     ncells = tensor.shape[0]
+    ntrials = np.sum(~np.isnan(baselines), axis=1)
+    bonferroni_n = ncells*ntrials
 
-    # We will save the maximum inverse p values
-    maxinvps = np.zeros((ncells, tensor.shape[2]), dtype=np.float64)
+    # We will save the maximum inverse p values, don't test a cell if it is
+    # negative on average
+    maxinvps = _ks_drive(full_baselines, stimuli, meanbl, bonferroni_n,
+                         mean=np.nanmean, log=np.log, n_jobs=n_jobs)
+
+    return maxinvps
+
+
+def _ks_drive(full_baselines, stimuli, thresholds, bonferroni_n, bins=None,
+              local=False, mean=bt.nanmean, log=np.log, n_jobs=1):
+    """
+    Maximum Bonferroni corrected inverse p-values of two-sided KS tests
+    (as sp.stats.ks_2samp) of stimulus bins against baseline for every cell
+    and trial. Each cell's pooled baseline is sorted once and all of its
+    trials are tested together, see _ks_2samp_rows.
+
+    Parameters:
+    -----------
+    full_baselines : np.ndarray
+        cells x baseline time x trials
+    stimuli : np.ndarray
+        cells x stimulus time x trials
+    thresholds : np.ndarray
+        Per cell value, a bin is only tested if its mean is above it.
+    bonferroni_n : np.ndarray
+        Per cell number of tests to correct p-values for.
+    bins : list of tuple
+        (start, end) of stimulus bins to test, None tests the whole stimulus.
+    local : bool
+        Test against the baseline of each trial instead of the baseline
+        pooled across all trials.
+    mean : function
+        Mean used to compare bins to thresholds, i.e., np.nanmean.
+    log : function
+        Log used for inverse p-values, i.e., np.log or np.log10.
+    n_jobs : int
+        Number of worker processes to split cells across, see
+        utils.process_map.
 
+    Returns:
+    --------
+    np.ndarray
+        cells x trials, best -log(p-value*bonferroni_n) across bins, 0 for
+        untested trials or if it is negative.
+
+    """
+
+    if bins is None:
+        bins = [(0, stimuli.shape[1])]
+    ncells = stimuli.shape[0]
+    nworkers = os.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+    nchunks = 1 if n_jobs == 1 else nworkers * 4
+    chunks = [c for c in np.array_split(np.arange(ncells), max(1, min(nchunks, ncells))) if len(c) > 0]
+    args = [(full_baselines[c], stimuli[c], thresholds[c], bonferroni_n[c], bins, local, mean, log)
+            for c in chunks]
+    maxinvps = utils.process_map(_ks_drive_cells, args, n_jobs=n_jobs)
+
+    return np.concatenate(maxinvps, axis=0) if len(maxinvps) > 0 else np.zeros(stimuli.shape[::2])
+
+
+def _ks_drive_cells(full_baselines, stimuli, thresholds, bonferroni_n, bins, local, mean, log):
+    """Run _ks_drive for a chunk of cells, see _ks_drive."""
+
+    ncells, _, ntrials = stimuli.shape
+    maxinvps = np.zeros((ncells, ntrials), dtype=np.float64)
+    pv_cache = {}
     for c in range(ncells):
-        cell_baseline_vec = full_baselines[c, :, :].flatten()
-        cell_baseline_vec = cell_baseline_vec[~np.isnan(cell_baseline_vec)]
-        ntrials = np.sum(~np.isnan(baselines[c,:]).flatten())
-        bonferroni_n = ncells*ntrials
-        std = np.std(cell_baseline_vec)
-        
-        for trial in range(tensor.shape[2]):
-            if np.nanmean(stimuli[c, :, trial]) > meanbl[c]: # don't test a cell if it is negative on average
-                pv = sp.stats.ks_2samp(cell_baseline_vec, stimuli[c, :, trial])
-                logpv = -1*np.log(pv[1]*bonferroni_n)
-                if logpv > maxinvps[c, trial]:
-                    maxinvps[c, trial] = logpv
+        if local:
+            cell_baselines = full_baselines[c, :, :].T
+        else:
+            cell_baselines = full_baselines[c, :, :].flatten()
+            cell_baselines = cell_baselines[~np.isnan(cell_baselines)]
+
+        # best p-value across tested bins, nan if any tested bin had missing data
+        best_pv = np.full(ntrials, np.inf)
+        for bin_s, bin_e in bins:
+            this_bin = np.ascontiguousarray(stimuli[c, bin_s:bin_e, :].T)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                tested = mean(this_bin, axis=1) > thresholds[c]
+            if np.sum(tested) == 0:
+                continue
+            pvs = _ks_2samp_rows(cell_baselines[tested] if local else cell_baselines,
+                                 this_bin[tested], pv_cache=pv_cache)
+            best_pv[tested] = np.minimum(best_pv[tested], pvs)
+
+        # skip nans
+        best_pv[np.isnan(stimuli[c, 0, :])] = np.inf
+        with np.errstate(invalid='ignore', divide='ignore'):
+            logpv = -1*log(best_pv*bonferroni_n[c])
+        maxinvps[c, :] = np.where(logpv > 0, logpv, 0)
 
     return maxinvps
+
+
+def _ks_2samp_rows(baseline, samples, pv_cache=None):
+    """
+    Two-sided two-sample KS test p-values of each row of samples against a
+    baseline, identical to calling sp.stats.ks_2samp(baseline, row) with the
+    default (auto) method for each row.
+
+    The baseline is sorted once and its empirical CDF is evaluated at every
+    sample with searchsorted. The largest ECDF differences can only occur
+    just below or at the sorted samples, so the statistic comes from the
+    trials x samples matrix of baseline counts. P-values only depend on the
+    sample sizes and the statistic (on the 1/lcm(n1, n2) grid for exact
+    p-values), so they are computed once for each unique value.
+
+    Parameters:
+    -----------
+    baseline : np.ndarray
+        Baseline values without nans, or rows x baseline values to test each
+        row against its own baseline.
+    samples : np.ndarray
+        rows x values
+    pv_cache : dict
+        Optional cache of p-values shared across calls.
+
+    Returns:
+    --------
+    np.ndarray
+        p-value of each row, nan if the row (or its baseline) has nans.
+
+    """
+
+    samples = np.sort(samples, axis=1)
+    nrows, n2 = samples.shape
+    j = np.arange(n2)
+    if baseline.ndim == 1:
+        base = np.sort(baseline)
+        n1 = np.full(nrows, len(base))
+        below = np.searchsorted(base, samples, side='left')
+        at_or_below = np.searchsorted(base, samples, side='right')
+        missing = np.isnan(samples).any(axis=1) | (len(base) == 0)
+    else:
+        base = np.sort(baseline, axis=1)
+        n1 = np.full(nrows, base.shape[1])
+        below = np.sum(base[:, None, :] < samples[:, :, None], axis=2)
+        at_or_below = np.sum(base[:, None, :] <= samples[:, :, None], axis=2)
+        missing = np.isnan(samples).any(axis=1) | np.isnan(base).any(axis=1)
+
+    # largest differences of the ECDFs in each direction, both ECDFs are 1
+    # at the largest value so neither is below 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        max_s = np.maximum(np.max(below / n1[:, None] - j / n2, axis=1), 0)
+        min_s = np.clip(np.max((j + 1) / n2 - at_or_below / n1[:, None], axis=1), 0, 1)
+    d = np.where(min_s > max_s, min_s, max_s)
+
+    pvs = np.full(nrows, np.nan)
+    pv_cache = {} if pv_cache is None else pv_cache
+    exact = (np.maximum(n1, n2) <= 10000) & ~missing
+    asymp = (np.maximum(n1, n2) > 10000) & ~missing
+    if np.any(asymp):
+        m = np.maximum(n1[asymp], n2).astype(np.float64)
+        n = np.minimum(n1[asymp], n2).astype(np.float64)
+        keys = [('asymp', en, dn) for en, dn in zip(np.round(m * n / (m + n)).tolist(), d[asymp].tolist())]
+        todo = sorted(set([k for k in keys if k not in pv_cache]))
+        if len(todo) > 0:
+            todo_pvs = np.clip(sp.stats.kstwo.sf([k[2] for k in todo], [k[1] for k in todo]), 0, 1)
+            pv_cache.update(zip(todo, todo_pvs))
+        pvs[asymp] = [pv_cache[k] for k in keys]
+    if np.any(exact):
+        lcm = (n1 // np.gcd(n1, n2)) * n2
+        h = np.round(d * lcm).astype(np.int64)
+        for row in np.flatnonzero(exact):
+            key = ('exact', n1[row], n2, h[row])
+            if key not in pv_cache:
+                row_base = baseline if baseline.ndim == 1 else baseline[row]
+                pv_cache[key] = sp.stats.ks_2samp(row_base, samples[row]).pvalue
+            pvs[row] = pv_cache[key]
+
+    return pvs
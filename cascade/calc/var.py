@@ -192,21 +192,12 @@ def groupday_varex(
 
     # get reconstruction error as variance explained
     # create vectors for dataframe
-    varex = []
-    utilized_varex = []
-    rank = []
-    iteration = []
+    ens_varex = ensemble_varex(X, V.results)
+    varex = ens_varex['varex']
+    utilized_varex = ens_varex['varex_utilized']
+    rank = ens_varex['rank']
+    iteration = ens_varex['iteration']
     total_X_var = bn.nanvar(X)
-    for r in V.results:
-        for it in range(0, len(V.results[r])):
-            cells_with_no_weight = np.sum(V.results[r][it].factors[0], axis=1) == 0
-            U = V.results[r][it].factors.full()
-            varex.append(1 - (bn.nanvar(X - U) / total_X_var))
-            utilized_varex.append(
-                1 - (bn.nanvar(X[~cells_with_no_weight, :, :] - U[~cells_with_no_weight, :, :])
-                     / bn.nanvar(X[~cells_with_no_weight, :, :])))
-            rank.append(r)
-            iteration.append(it)
 
     # mean response of neuron across trials
     mU = np.nanmean(X, axis=2, keepdims=True) * np.ones((1, 1, np.shape(X)[2]))
@@ -324,16 +315,11 @@ def groupday_varex_cv_train_set(
 
     # get reconstruction error as variance explained
     # create vectors for dataframe
-    varex = []
-    rank = []
-    iteration = []
+    ens_varex = ensemble_varex(X, V.results)
+    varex = ens_varex['varex']
+    rank = ens_varex['rank']
+    iteration = ens_varex['iteration']
     total_X_var = bn.nanvar(X)
-    for r in V.results:
-        for it in range(0, len(V.results[r])):
-            U = V.results[r][it].factors.full()
-            varex.append(1 - (bn.nanvar(X - U) / total_X_var))
-            rank.append(r)
-            iteration.append(it)
 
     # mean response of neuron across trials
     mU = np.nanmean(X, axis=2, keepdims=True) * np.ones((1, 1, np.shape(X)[2]))
@@ -451,16 +437,11 @@ def groupday_varex_cv_test_set(
 
     # get reconstruction error as variance explained
     # create vectors for dataframe
-    varex = []
-    rank = []
-    iteration = []
+    ens_varex = ensemble_varex(X, V.results)
+    varex = ens_varex['varex']
+    rank = ens_varex['rank']
+    iteration = ens_varex['iteration']
     total_X_var = bn.nanvar(X)
-    for r in V.results:
-        for it in range(0, len(V.results[r])):
-            U = V.results[r][it].factors.full()
-            varex.append(1 - (bn.nanvar(X - U) / total_X_var))
-            rank.append(r)
-            iteration.append(it)
 
     # mean response of neuron across trials
     mU = np.nanmean(X, axis=2, keepdims=True) * np.ones((1, 1, np.shape(X)[2]))
@@ -767,7 +748,12 @@ def groupday_varex_byday_bycomp(
     if rectified:
         X[X < 0] = 0
 
-    # create vectors for dataframe
+    # sums of the data per day, shared by every rank and component
+    moments = _day_moments(X, dates)
+    days = moments['days']
+    daily_var = _var_from_sums(*[moments[k].sum(axis=0) for k in ['n', 's', 'ss']])
+
+    # create columns for dataframe, ordered by rank, component then day
     varex = []
     var_daily = []
     var_comp_daily = []
@@ -775,25 +761,21 @@ def groupday_varex_byday_bycomp(
     rank = []
     component = []
     for r in V.results:
-        for fac_num in range(np.shape(V.results[r][0].factors[0][:, :])[1]):
-            # reconstruct single component model
-            a = V.results[r][0].factors[0][:, fac_num]
-            b = V.results[r][0].factors[1][:, fac_num]
-            c = V.results[r][0].factors[2][:, fac_num]
-            ab = a[:, None] @ b[None, :]
-            abc = ab[:, :, None] @ c[None, :]
-            # calculate variance explained per day
-            for day in np.unique(dates):
-                day_bool = dates.isin([day])
-                bUd = abc[:, :, day_bool]
-                bX = X[:, :, day_bool]
-                daily_var = bn.nanvar(bX)
-                rank.append(r)
-                date.append(day)
-                component.append(fac_num + 1)
-                varex.append(1 - (bn.nanvar(bX - bUd) / daily_var))
-                var_daily.append(daily_var)
-                var_comp_daily.append(bn.nanvar(bUd))
+        # calculate variance explained per day from the factors of each component
+        comp = _component_moments(moments, V.results[r][0].factors)
+        resid_var = _var_from_sums(*[v.sum(axis=0) for v in _residual_sums(moments, comp)])
+        a = comp['a']
+        model_var = _var_from_sums(comp['model_n'] * a.shape[0], comp['model_s'] * a.sum(axis=0),
+                                   comp['model_ss'] * (a ** 2).sum(axis=0))
+        n_comps = a.shape[1]
+        rank.append(np.full(n_comps * len(days), r))
+        date.append(np.tile(days, n_comps))
+        component.append(np.repeat(np.arange(1, n_comps + 1), len(days)))
+        varex.append((1 - resid_var / daily_var[:, None]).T.ravel())
+        var_daily.append(np.tile(daily_var, n_comps))
+        var_comp_daily.append(model_var.T.ravel())
+    varex, var_daily, var_comp_daily, date, rank, component = [
+        np.concatenate(v) for v in [varex, var_daily, var_comp_daily, date, rank, component]]
 
     # make dataframe of data
     # create your index out of relevant variables
@@ -881,7 +863,13 @@ def groupday_varex_byday_bycomp_bycell(
     if rectified:
         X[X < 0] = 0
 
-    # create vectors for dataframe
+    # per-cell sums of the data per day, shared by every rank and component
+    moments = _day_moments(X, dates)
+    days = moments['days']
+    daily_cell_var = _var_from_sums(moments['n'], moments['s'], moments['ss'])
+    n_cells = daily_cell_var.shape[0]
+
+    # create columns for dataframe, ordered by rank, component, day then cell
     varex = []
     var_cell = []
     var_cell_model = []
@@ -891,31 +879,22 @@ def groupday_varex_byday_bycomp_bycell(
     cell_idx = []
     cell_id = []
     for r in V.results:
-        for fac_num in range(np.shape(V.results[r][0].factors[0][:, :])[1]):
-            # reconstruct single component model
-            a = V.results[r][0].factors[0][:, fac_num]
-            b = V.results[r][0].factors[1][:, fac_num]
-            c = V.results[r][0].factors[2][:, fac_num]
-            ab = a[:, None] @ b[None, :]
-            abc = ab[:, :, None] @ c[None, :]
-            # calculate variance explained per day
-            for day in np.unique(dates):
-                day_bool = dates.isin([day])
-                abcd = abc[:, :, day_bool]
-                xxxx = X[:, :, day_bool]
-                for cell_num in range(np.shape(V.results[r][0].factors[0][:, :])[0]):
-                    cell_identity = ids[cell_num]
-                    bX = xxxx[cell_num, :, :]
-                    bU = abcd[cell_num, :, :]
-                    daily_cell_var = bn.nanvar(bX)
-                    rank.append(r)
-                    date.append(day)
-                    component.append(fac_num + 1)
-                    cell_idx.append(cell_num)
-                    cell_id.append(cell_identity)
-                    varex.append(1 - (bn.nanvar(bX - bU) / daily_cell_var))
-                    var_cell.append(daily_cell_var)
-                    var_cell_model.append(bn.nanvar(bU))
+        # calculate variance explained per day and cell from the factors of each component
+        comp = _component_moments(moments, V.results[r][0].factors)
+        resid_var = _var_from_sums(*_residual_sums(moments, comp))
+        model_var = (comp['a'] ** 2)[:, None, :] * _var_from_sums(
+            comp['model_n'], comp['model_s'], comp['model_ss'])[None, :, :]
+        n_rows = resid_var.size
+        rank.append(np.full(n_rows, r))
+        date.append(np.tile(np.repeat(days, n_cells), comp['a'].shape[1]))
+        component.append(np.repeat(np.arange(1, comp['a'].shape[1] + 1), len(days) * n_cells))
+        cell_idx.append(np.tile(np.arange(n_cells), n_rows // n_cells))
+        cell_id.append(np.tile(ids, n_rows // n_cells))
+        varex.append((1 - resid_var / daily_cell_var[:, :, None]).transpose(2, 1, 0).ravel())
+        var_cell.append(np.tile(daily_cell_var.T.ravel(), comp['a'].shape[1]))
+        var_cell_model.append(model_var.transpose(2, 1, 0).ravel())
+    varex, var_cell, var_cell_model, date, rank, component, cell_idx, cell_id = [
+        np.concatenate(v) for v in [varex, var_cell, var_cell_model, date, rank, component, cell_idx, cell_id]]
 
     # make dataframe of data
     # create your index out of relevant variables
@@ -1005,30 +984,29 @@ def groupday_varex_bycomp_bycell(
     if rectified:
         X[X < 0] = 0
 
-    # create vectors for dataframe
+    # per-cell sums of the data per day, shared by every rank and component
+    moments = _day_moments(X, dates)
+    cell_var = _var_from_sums(*[moments[k].sum(axis=1) for k in ['n', 's', 'ss']])
+    n_cells = cell_var.shape[0]
+
+    # create columns for dataframe, ordered by rank, component then cell
     varex = []
     rank = []
     component = []
     cell_idx = []
     cell_id = []
     for r in V.results:
-        for fac_num in range(np.shape(V.results[r][0].factors[0][:, :])[1]):
-            # reconstruct single component model
-            a = V.results[r][0].factors[0][:, fac_num]
-            b = V.results[r][0].factors[1][:, fac_num]
-            c = V.results[r][0].factors[2][:, fac_num]
-            ab = a[:, None] @ b[None, :]
-            abc = ab[:, :, None] @ c[None, :]
-            # calculate variance explained per cell
-            for cell_num in range(np.shape(V.results[r][0].factors[0][:, :])[0]):
-                cell_identity = ids[cell_num]
-                bX = X[cell_num, :, :]
-                bU = abc[cell_num, :, :]
-                rank.append(r)
-                component.append(fac_num + 1)
-                cell_idx.append(cell_num)
-                cell_id.append(cell_identity)
-                varex.append(1 - (bn.nanvar(bX - bU) / bn.nanvar(bX)))
+        # calculate variance explained per cell from the factors of each component
+        comp = _component_moments(moments, V.results[r][0].factors)
+        resid_var = _var_from_sums(*[v.sum(axis=1) for v in _residual_sums(moments, comp)])
+        n_comps = comp['a'].shape[1]
+        rank.append(np.full(n_comps * n_cells, r))
+        component.append(np.repeat(np.arange(1, n_comps + 1), n_cells))
+        cell_idx.append(np.tile(np.arange(n_cells), n_comps))
+        cell_id.append(np.tile(ids, n_comps))
+        varex.append((1 - resid_var / cell_var[:, None]).T.ravel())
+    varex, rank, component, cell_idx, cell_id = [
+        np.concatenate(v) for v in [varex, rank, component, cell_idx, cell_id]]
 
     # make dataframe of data
     # create your index out of relevant variables
@@ -1537,3 +1515,187 @@ def _full_ablated(tt_factors, fac_num_to_remove):
 
     # create full tensor
     return kt.full()
+
+
+def _day_moments(X, dates):
+    """
+    Per-cell, per-day counts, sums and sums of squares of the non-nan values of
+    a cells x times x trials tensor. These do not depend on a model, so they are
+    computed once and reused for every rank and component.
+
+    :param X: numpy.ndarray, cells x times x trials
+    :param dates: array-like, date of each trial
+    :return: dict, with trials sorted by day: 'days', 'order' of trials, day
+             'bounds' in sorted trials, 'X0' (nan filled with 0), 'mask' of
+             non-nan values and 'n', 's', 'ss' (cells x days)
+    """
+
+    days, codes = np.unique(np.asarray(dates), return_inverse=True)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(days) + 1))
+    X = X[:, :, order]
+    mask = ~np.isnan(X)
+    X0 = np.where(mask, X, 0).astype(np.float64, copy=False)
+    starts = bounds[:-1]
+
+    return {'days': days, 'order': order, 'bounds': bounds, 'X0': X0, 'mask': mask,
+            'n': np.add.reduceat(mask.sum(axis=1), starts, axis=1).astype(np.float64),
+            's': np.add.reduceat(X0.sum(axis=1), starts, axis=1),
+            'ss': np.add.reduceat((X0 * X0).sum(axis=1), starts, axis=1)}
+
+
+def _component_moments(moments, factors):
+    """
+    Per-cell, per-day, per-component sums needed for the variance of each
+    rank-1 component and of the data minus that component, taken directly from
+    the factor matrices without building the full reconstruction.
+
+    For component f with cell, time and trial factors a, b and c the residual
+    sums over the non-nan values M of a cell on a day are:
+        sum(X - abc) = s - a*sum(M*b*c)
+        sum((X - abc)**2) = ss - 2a*sum(M*X*b*c) + a**2*sum(M*b**2*c**2)
+
+    :param moments: dict, from _day_moments
+    :param factors: list of numpy.ndarray, cell, time and trial factors
+    :return: dict, 'w' = sum(M*b*c), 'p' = sum(M*X*b*c) and 'q' =
+             sum(M*b**2*c**2) (cells x days x components) and model 'n', 's'
+             and 'ss' over all times and trials of each day (days x
+             components, to be scaled by a and a**2)
+    """
+
+    a, b, c = [np.asarray(f, dtype=np.float64) for f in factors]
+    c = c[moments['order'], :]
+    bounds = moments['bounds']
+    n_cells, n_comps, n_days = a.shape[0], a.shape[1], len(moments['days'])
+    w, p, q = [np.zeros((n_cells, n_days, n_comps)) for _ in range(3)]
+    for di in range(n_days):
+        day = slice(bounds[di], bounds[di + 1])
+        day_mask = moments['mask'][:, :, day].astype(np.float64)
+        p[:, di, :] = np.einsum('itf,tf->if', moments['X0'][:, :, day] @ c[day], b)
+        w[:, di, :] = np.einsum('itf,tf->if', day_mask @ c[day], b)
+        q[:, di, :] = np.einsum('itf,tf->if', day_mask @ (c[day] ** 2), b ** 2)
+
+    # model values over every time and trial of a day, i.e., for a = 1
+    model_n = np.diff(bounds)[:, None] * b.shape[0] * np.ones((1, n_comps))
+    model_s = np.add.reduceat(c, bounds[:-1], axis=0) * b.sum(axis=0)
+    model_ss = np.add.reduceat(c ** 2, bounds[:-1], axis=0) * (b ** 2).sum(axis=0)
+
+    return {'a': a, 'w': w, 'p': p, 'q': q, 'model_n': model_n, 'model_s': model_s, 'model_ss': model_ss}
+
+
+def _var_from_sums(n, s, ss):
+    """Population variance (i.e., bn.nanvar) from counts, sums and sums of squares, nan where n is 0."""
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = s / n
+        return np.maximum(ss / n - mean ** 2, 0)
+
+
+def _residual_sums(moments, comp):
+    """Counts, sums and sums of squares of data minus each component (cells x days x components)."""
+
+    a = comp['a'][:, None, :]
+    n = np.broadcast_to(moments['n'][:, :, None], comp['w'].shape)
+    s = moments['s'][:, :, None] - a * comp['w']
+    ss = moments['ss'][:, :, None] - 2 * a * comp['p'] + a ** 2 * comp['q']
+
+    return n, s, ss
+
+
+def ensemble_varex(X, results, rectified=False, block_trials=256):
+    """
+    Reconstruction error as variance explained for every rank and replicate of
+    a TCA ensemble in a single pass over blocks of trials. Only one block of
+    the input and of one model's reconstruction is in memory at a time, so X
+    can be a numpy.memmap or store.TensorStore and peak memory does not grow
+    with the size of the ensemble.
+
+    :param X: numpy.ndarray, numpy.memmap or store.TensorStore, cells x times x trials
+    :param results: dict, rank: list of fit results with .factors, i.e., V.results
+    :param rectified: boolean, set negative values of X to 0 as they are read
+    :param block_trials: int, number of trials per block
+    :return: dict, 'rank', 'iteration', 'varex' (all cells) and
+             'varex_utilized' (only cells with nonzero weight in a model) with
+             one entry per model
+    """
+
+    models = [(r, it, [np.asarray(f, dtype=np.float64) for f in results[r][it].factors])
+              for r in results for it in range(len(results[r]))]
+    utilized = [np.sum(factors[0], axis=1) != 0 for _, _, factors in models]
+
+    # running (n, mean, M2) per cell for the data and per model for residuals
+    n_cells, n_times, n_trials = X.shape
+    data_moments = [np.zeros(n_cells) for _ in range(3)]
+    resid_moments = [np.zeros((len(models), 3)) for _ in range(2)]
+    for start in range(0, n_trials, block_trials):
+        stop = min(start + block_trials, n_trials)
+        block = np.array(X[:, :, start:stop], dtype=np.float64).reshape(n_cells, -1)
+        if rectified:
+            block = np.maximum(block, 0)
+        missing = np.isnan(block)
+        block[missing] = 0
+        n = np.sum(~missing, axis=1).astype(np.float64)
+        data_moments = _merge_moments(*data_moments, *_cell_moments(block, n))
+
+        for mi, (_, _, factors) in enumerate(models):
+            a, b, c = factors
+            resid = block - ((a[:, None, :] * b[None, :, :]).reshape(n_cells * n_times, -1)
+                             @ c[start:stop].T).reshape(n_cells, -1)
+            resid[missing] = 0
+            cell_moments = _cell_moments(resid, n)
+            for moments, cells in zip(resid_moments, [slice(None), utilized[mi]]):
+                moments[mi] = _merge_moments(
+                    *moments[mi], *_combine_moments(*[m[cells] for m in cell_moments]))
+
+    # combine per-cell data moments over all cells or utilized cells of each model
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n, _, m2 = _combine_moments(*data_moments)
+        data_var = m2 / n
+        utilized_var = np.array([_combine_moments(*[m[cells] for m in data_moments])
+                                 for cells in utilized]).reshape(-1, 3)
+        utilized_var = utilized_var[:, 2] / utilized_var[:, 0]
+        resid_var = [m[:, 2] / m[:, 0] for m in resid_moments]
+
+    return {'rank': [r for r, _, _ in models],
+            'iteration': [it for _, it, _ in models],
+            'varex': 1 - resid_var[0] / data_var,
+            'varex_utilized': 1 - resid_var[1] / utilized_var}
+
+
+def _cell_moments(flat, n):
+    """
+    Count, mean and sum of squared deviations of each cell (row) of a cells x
+    values block with missing values set to 0, given the number of non-missing
+    values n of each cell.
+    """
+
+    total = flat.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(n > 0, total / n, 0)
+    m2 = np.maximum(np.einsum('ij,ij->i', flat, flat) - total * mean, 0)
+
+    return n, mean, m2
+
+
+def _combine_moments(n, mean, m2):
+    """Combine the moments of several groups (i.e., cells) into moments of all of their values."""
+
+    total = np.sum(n)
+    if total == 0:
+        return 0., 0., 0.
+    grand_mean = np.sum(n * mean) / total
+
+    return total, grand_mean, np.sum(m2) + np.sum(n * (mean - grand_mean) ** 2)
+
+
+def _merge_moments(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    """Merge running moments with the moments of a new block (Chan et al.)."""
+
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.where(n > 0, n_b / n, 0)
+    mean = mean_a + delta * frac
+    m2 = m2_a + m2_b + delta ** 2 * n_a * frac
+
+    return n, mean, m2
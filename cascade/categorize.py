@@ -13,7 +13,7 @@ from . import utils, lookups
 #  2. then calculate bias
 #  3. then stim history/reward history/punish history
 
-def four_way_split(meta, pref_tensor, model=None, ):
+def four_way_split(meta, pref_tensor, model=None, summary=None):
     """
     Split cells into categories based in onset/offset peak and based on the center of mass for firing
     in each respective stage.
@@ -26,6 +26,7 @@ def four_way_split(meta, pref_tensor, model=None, ):
     :param meta:
     :param pref_tensor:
     :param model:
+    :param summary: utils.TensorSummary of pref_tensor, optional, reuses results between calls
     :return:
     """
 
@@ -40,21 +41,21 @@ def four_way_split(meta, pref_tensor, model=None, ):
 
     # Determine if cells have onset or offset peak activity
     if by_cells:
-        off_vec = utils.get_offset_cells(meta, pref_tensor) # or cell-wise version
+        off_vec = utils.get_offset_cells(meta, pref_tensor, summary=summary) # or cell-wise version
     else:
         off_vec = cell_factor_is_offset(meta, model, rank_num=15, buffer_s=0.100, cell_fac_std_thresh=1)
 
 
 def trans_center_of_mass_from_cells(meta, pref_tensor, staging='parsed_11stage', buffer_s=0.300,
                                     stages_for_calc=('L4 learning', 'L5 learning'),
-                                    cm_off_thresh=12, cm_stim_l=12, cm_stim_h=14, shuffle=False):
+                                    cm_off_thresh=12, cm_stim_l=12, cm_stim_h=14, shuffle=False, summary=None):
 
     # make sure your input is a list
     if isinstance(stages_for_calc, str):
         stages_for_calc = [stages_for_calc]
 
     # get off vec
-    offset_bool = utils.get_offset_cells(meta, pref_tensor, buffer_s=buffer_s)
+    offset_bool = utils.get_offset_cells(meta, pref_tensor, buffer_s=buffer_s, summary=summary)
 
     # get mean cell responses for high dprime learning
     meta_bool = meta[staging].isin(stages_for_calc)
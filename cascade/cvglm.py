@@ -1,7 +1,12 @@
 """ Functions for fitting cross-validated glm in tensorflow """
 import numpy as np
-import tensorflow as tf
+from scipy import special
 from time import time
+try:
+    import tensorflow as tf
+except ImportError:
+    # only needed for backend='tf', the numpy backend fits without TensorFlow
+    tf = None
 import matplotlib
 import matplotlib.pyplot as plt
 from statsmodels.distributions.empirical_distribution import ECDF
@@ -14,7 +19,7 @@ def fit_glm(response_matrix, pred_matrix, pred_name_list,
             loss_type = 'poisson', activation = 'exp', regularization = 'elastic_net', l1_ratio = 0.5, smooth_strength = 0., 
             lambda_series = 10.0 ** np.linspace(-1, -8, 30), learning_rate = 0.001,
             convergence_tol = 1e-9, max_iter_per_lambda = 10**4, min_iter_per_lambda = 10**2, 
-            opt = 'adam', device = '/cpu:0'):
+            opt = 'adam', device = '/cpu:0', backend = 'tf'):
     ''' Fit Poisson GLM
     Input:
     response_matrix: neural response data
@@ -26,6 +31,7 @@ def fit_glm(response_matrix, pred_matrix, pred_name_list,
     l1_ratio: ratio for L1 regularization for elastic net
     smooth_ratio: ratio for smooth penalty
     lambda_series: list of lambda values for regularization
+    backend: tf (Adam in TensorFlow) or numpy (proximal gradient, see _fit_glm_path)
 
     Return:
     w_series: list of weights [w0, w] of different lambdas
@@ -36,11 +42,24 @@ def fit_glm(response_matrix, pred_matrix, pred_name_list,
     n_t = response_matrix.shape[0]
     n_features = pred_matrix.shape[1]
     w_series = []
-    loss_trace = np.array([])
-    lambda_trace = np.array([])
+    loss_trace = []
+    lambda_trace = []
+    prior, grouping_mat, feature_group_size = None, None, None
     if len(pred_name_list) > 0:
         prior, grouping_mat, feature_group_size, _, _ = make_prior_matrix(pred_name_list)
 
+    if backend == 'numpy':
+        start_time = time()
+        w_series, loss_trace, lambda_trace = _fit_glm_path(
+            response_matrix, pred_matrix, loss_type=loss_type, activation=activation,
+            regularization=regularization, l1_ratio=l1_ratio, smooth_strength=smooth_strength,
+            prior=prior, grouping_mat=grouping_mat, feature_group_size=feature_group_size,
+            lambda_series=lambda_series, learning_rate=learning_rate, convergence_tol=convergence_tol,
+            max_iter_per_lambda=max_iter_per_lambda)
+        print('Fitting took {:1.1f} seconds.'.format(time() - start_time))
+        return w_series, lambda_series, loss_trace, lambda_trace
+    assert tf is not None, 'TensorFlow is not installed, use backend=\'numpy\'.'
+
     # model definition
     tf.reset_default_graph()
     with tf.device(device):
@@ -146,8 +165,8 @@ def fit_glm(response_matrix, pred_matrix, pred_name_list,
                 # Train:
                 loss_this_iter = sess.run([train_op, loss], feed_dict=feed_dict)[1]
                 assert (not np.isnan(loss_this_iter)), 'Loss is nan -- check.'
-                loss_trace = np.append(loss_trace, loss_this_iter)
-                lambda_trace = np.append(lambda_trace, feed_dict[lam])
+                loss_trace.append(loss_this_iter)
+                lambda_trace.append(feed_dict[lam])
 
                 # Check for convergence:
                 if (iter_this_lambda % 100) == 0 and (iter_this_lambda > min_iter_per_lambda):
@@ -176,14 +195,14 @@ def fit_glm(response_matrix, pred_matrix, pred_name_list,
 
         print('Fitting took {:1.1f} seconds.'.format(time() - start_time))
         
-        return w_series, lambda_series, loss_trace, lambda_trace
+        return w_series, lambda_series, np.array(loss_trace), np.array(lambda_trace)
 
 
 def fit_glm_cv(response_matrix, pred_matrix, pred_name_list, n_folds, train_ind, test_ind,
                loss_type = 'poisson', activation = 'exp', regularization = 'elastic_net', l1_ratio = 0.5, smooth_strength = 0., 
                lambda_series = 10.0 ** np.linspace(-1, -8, 30), learning_rate = 0.001,
                convergence_tol = 1e-10, max_iter_per_lambda = 10**4, min_iter_per_lambda = 10**2, 
-               opt = 'adam', device = '/cpu:0'):
+               opt = 'adam', device = '/cpu:0', backend = 'tf'):
 
     ''' Fit GLM with cross validation
     Input:
@@ -200,6 +219,7 @@ def fit_glm_cv(response_matrix, pred_matrix, pred_name_list, n_folds, train_ind,
     smooth_strength: strength for smooth penalty
     lambda_series: list of lambda values for regularization
     learning_rate: learning rate for the optimizer
+    backend: tf (Adam in TensorFlow) or numpy (proximal gradient, see _fit_glm_path)
 
     Return: 
     w_series_dict: dictionary for each CV fold with list of weights [w0, w] of different lambdas
@@ -215,9 +235,32 @@ def fit_glm_cv(response_matrix, pred_matrix, pred_name_list, n_folds, train_ind,
     w_series_dict = {}
     loss_trace_dict = {}
     lambda_trace_dict = {}
+    prior, grouping_mat, feature_group_size = None, None, None
     if len(pred_name_list) > 0:
         prior, grouping_mat, feature_group_size, _, _ = make_prior_matrix(pred_name_list)
 
+    if backend == 'numpy':
+        start_time = time()
+        path_kwargs = {'loss_type': loss_type, 'activation': activation, 'regularization': regularization,
+                       'l1_ratio': l1_ratio, 'smooth_strength': smooth_strength, 'prior': prior,
+                       'grouping_mat': grouping_mat, 'feature_group_size': feature_group_size,
+                       'lambda_series': lambda_series, 'learning_rate': learning_rate,
+                       'convergence_tol': convergence_tol, 'max_iter_per_lambda': max_iter_per_lambda}
+        all_prediction = [np.full(response_matrix.shape, np.nan) for _ in lambda_series]
+        all_deviance = [np.full((n_folds, n_roi), np.nan) for _ in lambda_series]
+        for n_fold in range(n_folds+1):
+            print('nFold =', n_fold)
+            train_frames = train_ind[n_fold]
+            w_series_dict[n_fold], _, _ = _fit_glm_path(
+                response_matrix[train_frames, :], pred_matrix[train_frames, :], **path_kwargs)
+            if n_fold < n_folds:
+                _held_out_deviance(pred_matrix, response_matrix, test_ind[n_fold], w_series_dict[n_fold],
+                                   all_prediction, all_deviance, n_fold, loss_type=loss_type,
+                                   activation=activation)
+        print('Fitting took {:1.1f} seconds.'.format(time() - start_time))
+        return w_series_dict, lambda_series, loss_trace_dict, lambda_trace_dict, all_prediction, all_deviance
+    assert tf is not None, 'TensorFlow is not installed, use backend=\'numpy\'.'
+
     # model definition
     tf.reset_default_graph()
     with tf.device(device):
@@ -378,20 +421,197 @@ def fit_glm_cv(response_matrix, pred_matrix, pred_name_list, n_folds, train_ind,
                 w_series_dict[n_fold] = w_series
 
                 if n_fold < n_folds:
-                    testFrames = test_ind[n_fold]
-                    X_test = pred_matrix[testFrames,:]
-                    Y_test = response_matrix[testFrames,:]
-                    for this_idx, this_w in enumerate(w_series):
-                        prediction = make_prediction(X_test, this_w[1], this_w[0], activation = activation)
-                        _, d_model, _ = deviance(prediction, Y_test, loss_type = loss_type)
-                        all_prediction[this_idx][testFrames,:] = prediction
-                        all_deviance[this_idx][n_fold,:] = d_model.reshape(1,-1)
+                    _held_out_deviance(pred_matrix, response_matrix, test_ind[n_fold], w_series,
+                                       all_prediction, all_deviance, n_fold, loss_type=loss_type,
+                                       activation=activation)
 
         print('Fitting took {:1.1f} seconds.'.format(time() - start_time))
 
         return w_series_dict, lambda_series, loss_trace_dict, lambda_trace_dict, all_prediction, all_deviance
 
 
+def _held_out_deviance(pred_matrix, response_matrix, test_frames, w_series, all_prediction, all_deviance, n_fold,
+                       loss_type='poisson', activation='exp'):
+    '''Fill in predictions and model deviance on the held-out frames of a CV fold for every lambda'''
+    X_test = pred_matrix[test_frames,:]
+    Y_test = response_matrix[test_frames,:]
+    for this_idx, this_w in enumerate(w_series):
+        prediction = make_prediction(X_test, this_w[1], this_w[0], activation = activation)
+        _, d_model, _ = deviance(prediction, Y_test, loss_type = loss_type)
+        all_prediction[this_idx][test_frames,:] = prediction
+        all_deviance[this_idx][n_fold,:] = d_model.reshape(1,-1)
+
+
+def _fit_glm_path(response_matrix, pred_matrix, loss_type='poisson', activation='exp', regularization='elastic_net',
+                  l1_ratio=0.5, smooth_strength=0., prior=None, grouping_mat=None, feature_group_size=None,
+                  lambda_series=10.0 ** np.linspace(-1, -8, 30), learning_rate=0.001, convergence_tol=1e-9,
+                  max_iter_per_lambda=10**4):
+    ''' Fit a GLM to every column of the response matrix along a lambda path in numpy.
+
+    Minimizes the same loss as the TensorFlow graph in fit_glm with accelerated proximal gradient descent (FISTA
+    with a backtracking line search and adaptive restart), for all ROIs at once. The L1 or group lasso penalty is
+    applied with its proximal operator so weights can be exactly zero, and each lambda is warm started from the
+    solution for the previous one. A lambda is done when the loss changes by less than
+    convergence_tol*avg_dev/learning_rate in an iteration, the threshold used per step for the TensorFlow fits.
+
+    Return:
+    w_series: list of weights [w0, w] of different lambdas
+    loss_trace: loss at each iteration
+    lambda_trace: lambda at each iteration
+    '''
+
+    Y = np.asarray(response_matrix, dtype=np.float64)
+    X = np.asarray(pred_matrix, dtype=np.float64)
+    n_t, n_roi = Y.shape
+    smooth = {'loss_type': loss_type, 'activation': activation, 'smooth_strength': smooth_strength, 'prior': prior}
+    prox = {'regularization': regularization, 'grouping_mat': grouping_mat, 'feature_group_size': feature_group_size}
+
+    # compute average null deviance
+    null_dev = np.array([null_deviance(Y[:, ii], loss_type = loss_type) for ii in range(n_roi)])
+    avg_dev = np.sum(null_dev)/n_t/n_roi
+    tol = convergence_tol*avg_dev/learning_rate
+
+    # start from the intercept-only model
+    w0 = _inverse_activation(np.mean(Y, axis=0, keepdims=True), activation)
+    w = np.zeros((X.shape[1], n_roi))
+    step = np.ones(n_roi)
+    w_series = []
+    loss_trace = []
+    lambda_trace = []
+    for lambda_index, lam in enumerate(lambda_series):
+        ridge = lam*(1. - l1_ratio) if regularization == 'elastic_net' else 0.
+        l1 = lam*l1_ratio if regularization == 'elastic_net' else lam
+        F = _glm_smooth_loss(X, Y, w0, w, ridge=ridge, **smooth)[0] + _glm_penalty(w, l1, **prox)
+        prev_loss = np.sum(F)/n_roi
+        y0, yw = w0, w
+        theta = np.ones(n_roi)
+        step = step*2
+
+        for iter_this_lambda in range(1, max_iter_per_lambda + 1):
+            f_y, g0, gw = _glm_smooth_loss(X, Y, y0, yw, ridge=ridge, grad=True, **smooth)
+
+            # backtracking line search, shrinking the step only for ROIs where it was too long
+            new_w0, new_w, new_f = np.empty_like(w0), np.empty_like(w), np.empty(n_roi)
+            todo = np.arange(n_roi)
+            while len(todo) > 0:
+                # slice instead of copying while every column is still searching
+                cols = slice(None) if len(todo) == n_roi else todo
+                t = step[cols]
+                cand_w0 = y0[:, cols] - t*g0[:, cols]
+                cand_w = _glm_prox(yw[:, cols] - t*gw[:, cols], t*l1, **prox)
+                cand_f = _glm_smooth_loss(X, Y[:, cols], cand_w0, cand_w, ridge=ridge, **smooth)[0]
+                d0, dw = cand_w0 - y0[:, cols], cand_w - yw[:, cols]
+                bound = (f_y[cols] + g0[0, cols]*d0[0] + np.sum(gw[:, cols]*dw, axis=0)
+                         + (d0[0]**2 + np.sum(dw**2, axis=0))/(2*t))
+                # allow for round-off when the step barely moves the weights
+                ok = (cand_f <= bound + 1e-12*np.abs(f_y[cols])) | (t < 1e-20)
+                new_w0[:, todo[ok]], new_w[:, todo[ok]], new_f[todo[ok]] = cand_w0[:, ok], cand_w[:, ok], cand_f[ok]
+                step[todo[~ok]] *= 0.5
+                todo = todo[~ok]
+            new_F = new_f + _glm_penalty(new_w, l1, **prox)
+
+            # momentum, restarted for ROIs where the loss went up
+            new_theta = (1. + np.sqrt(1. + 4.*theta**2))/2.
+            momentum = np.where(new_F > F, 0., (theta - 1.)/new_theta)
+            new_theta[new_F > F] = 1.
+            y0 = new_w0 + momentum*(new_w0 - w0)
+            yw = new_w + momentum*(new_w - w)
+            w0, w, F, theta = new_w0, new_w, new_F, new_theta
+
+            loss = np.sum(F)/n_roi
+            assert (not np.isnan(loss)), 'Loss is nan -- check.'
+            loss_trace.append(loss)
+            lambda_trace.append(lam)
+            loss_diff = prev_loss - loss
+            prev_loss = loss
+            if np.abs(loss_diff) < tol:
+                print('Fitting with Lambda {} iter {} converged (loss diff = {:1.8f}).'
+                      .format(lambda_index, iter_this_lambda, loss_diff))
+                break
+        else:
+            print('Fitting with Lambda {} iter {} did not converge (loss diff = {:1.8f}).'
+                  .format(lambda_index, iter_this_lambda, loss_diff))
+        w_series.append([w0.copy(), w.copy()])
+    print('Finished lambda series.')
+
+    return w_series, np.array(loss_trace), np.array(lambda_trace)
+
+
+def _inverse_activation(mu, activation='exp'):
+    '''Linear predictor that gives a mean response mu, used to start fits from the intercept-only model'''
+    if activation == 'exp':
+        return np.log(stable(mu))
+    elif activation == 'softplus':
+        return np.log(stable(np.expm1(stable(mu))))
+    return mu
+
+
+def _glm_smooth_loss(X, Y, w0, w, loss_type='poisson', activation='exp', ridge=0., smooth_strength=0., prior=None,
+                     grad=False):
+    '''Per ROI loss (mean over frames) plus ridge and smoothness penalties, and optionally its gradients'''
+    n_t = Y.shape[0]
+    Y_hat = np.matmul(X, w) + w0
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        if activation == 'exp':
+            Y_act = np.exp(Y_hat)
+            d_act = Y_act
+        elif activation == 'relu':
+            Y_act = np.maximum(Y_hat, 0)
+            d_act = (Y_hat > 0).astype(np.float64)
+        elif activation == 'softplus':
+            Y_act = np.logaddexp(0, Y_hat)
+            d_act = special.expit(Y_hat)
+        elif activation == 'linear':
+            Y_act = Y_hat
+            d_act = np.ones_like(Y_hat)
+
+        # loss and its derivative with respect to Y_hat, same losses as fit_glm
+        if np.logical_and(loss_type == 'poisson', activation == 'exp'):
+            loss = Y_act - Y * Y_hat
+            d_loss = Y_act - Y
+        elif np.logical_and(loss_type == 'poisson', activation != 'exp'):
+            loss = Y_act - Y * np.log(Y_act + 1e-33)
+            d_loss = d_act * (1. - Y / (Y_act + 1e-33))
+        elif loss_type == 'exponential':
+            loss = Y / (Y_act + 1e-16) + np.log(Y_act)
+            d_loss = d_act * (1. / Y_act - Y / (Y_act + 1e-16)**2)
+        elif np.logical_and(loss_type == 'gaussian', activation == 'linear'):
+            loss = np.square(Y - Y_hat)
+            d_loss = -2. * (Y - Y_hat)
+
+    f = np.sum(loss, axis=0)/n_t + ridge*np.sum(np.square(w), axis=0)/2.
+    if smooth_strength > 0.:
+        f += smooth_strength*np.sum(w*np.matmul(prior, w), axis=0)
+    if not grad:
+        return f, None, None
+
+    g0 = np.sum(d_loss, axis=0, keepdims=True)/n_t
+    gw = np.matmul(X.T, d_loss)/n_t + ridge*w
+    if smooth_strength > 0.:
+        gw += smooth_strength*np.matmul(prior + prior.T, w)
+    return f, g0, gw
+
+
+def _glm_penalty(w, l1, regularization='elastic_net', grouping_mat=None, feature_group_size=None):
+    '''Per ROI L1 (elastic net) or group lasso penalty'''
+    if regularization == 'elastic_net':
+        return l1*np.sum(np.abs(w), axis=0)
+    elif regularization == 'group_lasso':
+        return l1*np.sum(np.sqrt(np.matmul(grouping_mat, np.square(w)))*np.sqrt(feature_group_size)[:, None], axis=0)
+
+
+def _glm_prox(w, l1, regularization='elastic_net', grouping_mat=None, feature_group_size=None):
+    '''Proximal operator of _glm_penalty, l1 is the penalty weight times the step size of each ROI'''
+    if regularization == 'elastic_net':
+        return np.sign(w)*np.maximum(np.abs(w) - l1, 0)
+    elif regularization == 'group_lasso':
+        # shrink the norm of each group of weights, features in no group are not penalized
+        group_norm = np.sqrt(np.matmul(grouping_mat, np.square(w)))
+        shrink = np.maximum(1. - l1*np.sqrt(feature_group_size)[:, None]/stable(group_norm), 0)
+        in_group = np.sum(grouping_mat, axis=0) > 0
+        return w*np.where(in_group[:, None], np.matmul(grouping_mat.T, shrink), 1.)
+
+
 def stable(x):
     return x + 10 * np.finfo(x.dtype).tiny
 
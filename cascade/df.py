@@ -758,45 +758,16 @@ def trigger(mouse, trace_type='zscore_day', cs='', downsample=True,
         # loop through runs on a particular day
         for run in d.runs(exclude_tags=['bad']):
 
-            # get your t2p object
-            t2p = run.trace2p()
-
-            # get your cell# from xday alignment
-            # use to index along axis=0 in cstraces/run_traces
-            cell_ids = flow.xday._read_crossday_ids(run.mouse, run.date)
-            cell_ids = [int(s) for s in cell_ids]
-
             # trigger all trials around stimulus onsets
-            run_traces = utils.getcstraces(run, cs=cs, trace_type=trace_type,
-                                           start_time=start_time, end_time=end_time,
-                                           downsample=True, clean_artifacts=clean_artifacts,
-                                           thresh=thresh, warp=warp, smooth=smooth,
-                                           smooth_win=smooth_win)
-
-            # make timestamps, downsample is necessary
-            timestep = 1 / t2p.d['framerate']
-            timestamps = np.arange(start_time, end_time, timestep)
-
-            if (t2p.d['framerate'] > 30) and downsample:
-                timestamps = timestamps[::2][:np.shape(run_traces)[1]]
-
-            # check that you don't have extra cells
-            if len(cell_ids) != np.shape(run_traces)[0]:
-                run_traces = run_traces[range(0, len(cell_ids)), :, :]
-                warnings.warn(str(run) + ': You have more cell traces than cell_idx: skipping extra cells.')
-
-            # build matrices to match cell, trial, time variables to traces
-            trial_mat = np.ones(np.shape(run_traces))
-            for trial in range(np.shape(run_traces)[2]):
-                trial_mat[:, :, trial] = trial
+            run_traces, cell_ids, timestamps = _trigger_run(
+                run, trace_type=trace_type, cs=cs, downsample=downsample,
+                start_time=start_time, end_time=end_time,
+                clean_artifacts=clean_artifacts, thresh=thresh, warp=warp,
+                smooth=smooth, smooth_win=smooth_win)
 
-            cell_mat = np.ones(np.shape(run_traces))
-            for cell in range(np.shape(run_traces)[0]):
-                cell_mat[cell, :, :] = cell_ids[cell]
-
-            time_mat = np.ones(np.shape(run_traces))
-            for timept in range(np.shape(run_traces)[1]):
-                time_mat[:, timept, :] = timestamps[timept]
+            # match cell, trial, time variables to traces
+            trial_vec, cell_vec, time_vec = utils.trace_index_arrays(
+                run_traces.shape, cell_ids, timestamps)
 
             # reshape and build df
             vec_sz = run_traces.size
@@ -804,9 +775,9 @@ def trigger(mouse, trace_type='zscore_day', cs='', downsample=True,
                 [run.mouse] * vec_sz,
                 [run.date] * vec_sz,
                 [run.run] * vec_sz,
-                trial_mat.reshape(vec_sz),
-                cell_mat.reshape(vec_sz),
-                time_mat.reshape(vec_sz)
+                trial_vec.astype(float),
+                cell_vec.astype(float),
+                time_vec
             ],
                 names=['mouse', 'date', 'run', 'trial_idx',
                        'cell_idx', 'timestamp'])
@@ -832,6 +803,293 @@ def trigger(mouse, trace_type='zscore_day', cs='', downsample=True,
         trial_list = []
 
 
+def trigger_runs(mouse, trace_type='zscore_day', cs='', downsample=True,
+                 start_time=-1, end_time=6, clean_artifacts=None,
+                 thresh=20, warp=False, smooth=True, smooth_win=5,
+                 trace_dtype=None, skip=None):
+    """
+    Generator of triggered traces for a mouse, one run at a time, as flat
+    long-format DataFrames with compact columns instead of a MultiIndex:
+    mouse (categorical), date, run, trial_idx, cell_idx (integers),
+    timestamp (float32), and trace. Only one run is held in memory.
+
+    Parameters:
+    -----------
+    mouse : str
+        Mouse name.
+    trace_type, cs, downsample, start_time, end_time, clean_artifacts,
+    thresh, warp, smooth, smooth_win :
+        See trigger.
+    trace_dtype : numpy.dtype
+        Optionally cast traces, i.e., 'float32'.
+    skip : function
+        Optional function of (date, run) returning True for runs that should
+        not be triggered, i.e., runs already saved.
+
+    Yields:
+    -------
+    run : flow.Run
+    run_df : pandas.DataFrame
+    """
+
+    dates = flow.DateSorter.frommeta(mice=[mouse], exclude_tags=['bad'])
+    for d in dates:
+        for run in d.runs(exclude_tags=['bad']):
+            if skip is not None and skip(run.date, run.run):
+                continue
+
+            run_traces, cell_ids, timestamps = _trigger_run(
+                run, trace_type=trace_type, cs=cs, downsample=downsample,
+                start_time=start_time, end_time=end_time,
+                clean_artifacts=clean_artifacts, thresh=thresh, warp=warp,
+                smooth=smooth, smooth_win=smooth_win)
+            trial_vec, cell_vec, time_vec = utils.trace_index_arrays(
+                run_traces.shape, cell_ids, timestamps)
+            vec_sz = run_traces.size
+            traces = run_traces.reshape(vec_sz)
+            if trace_dtype is not None:
+                traces = traces.astype(trace_dtype)
+
+            run_df = pd.DataFrame({
+                'mouse': pd.Categorical([run.mouse] * vec_sz),
+                'date': np.full(vec_sz, run.date, dtype=np.int32),
+                'run': np.full(vec_sz, run.run, dtype=np.int16),
+                'trial_idx': trial_vec.astype(np.int32),
+                'cell_idx': cell_vec.astype(np.int32),
+                'timestamp': time_vec.astype(np.float32),
+                'trace': traces})
+
+            # clear your t2p to save memory
+            run._t2p = None
+
+            yield run, run_df
+
+
+def trigger_store_dir(mouse, pars=None, word=None, create=True):
+    """
+    Directory of the columnar trigger store for a mouse. Runs are saved as
+    date=<date>/run=<run>.<ext> inside it.
+
+    :param mouse: str, mouse name
+    :param pars: dict, trigger parameters (see trigger)
+    :param word: str, hash word of trigger parameters, for loading
+    :param create: bool, create the folders and save pars. If False, only
+        return the path (same naming as paths.df_path) without touching disk.
+    :return: str, path of store
+    """
+
+    if not create:
+        if word is None:
+            word = flow.misc.wordhash.word(pars)
+        folder_name = 'dfs-' + pars['trace_type'] + '-' + word
+        return os.path.join(flow.paths.outd, mouse, folder_name, 'trigger_store')
+
+    save_dir = os.path.join(paths.df_path(mouse, pars=pars, word=word), 'trigger_store')
+    if not os.path.isdir(save_dir):
+        os.mkdir(save_dir)
+
+    return save_dir
+
+
+# parameters hashed into the trigger store folder name
+_trigger_store_pars = ('trace_type', 'cs', 'downsample', 'start_time', 'end_time',
+                       'clean_artifacts', 'thresh', 'warp', 'smooth', 'smooth_win')
+
+
+def trigger_store(mouse, trace_type='zscore_day', cs='', downsample=True,
+                  start_time=-1, end_time=6, clean_artifacts=None,
+                  thresh=20, warp=False, smooth=True, smooth_win=5,
+                  trace_dtype=None, file_format='parquet', force=False,
+                  verbose=True):
+    """
+    Trigger all runs for a mouse and append them one at a time to a columnar
+    store (Parquet or Feather, one file per run, partitioned by date), so a
+    whole mouse can be triggered in bounded memory and read back selectively
+    with load_trigger_store. Runs already in the store are skipped unless
+    force. Requires pyarrow.
+
+    Parameters:
+    -----------
+    mouse : str
+        Mouse name.
+    trace_type, cs, downsample, start_time, end_time, clean_artifacts,
+    thresh, warp, smooth, smooth_win :
+        See trigger. Parameters are hashed into the same folder as trigger.
+    trace_dtype : numpy.dtype
+        Optionally cast traces, i.e., 'float32'.
+    file_format : str
+        'parquet' or 'feather'
+    force : bool
+        Retrigger and overwrite runs that are already saved.
+
+    Returns:
+    --------
+    str, path of trigger store
+    """
+
+    pars = {'trace_type': trace_type, 'cs': cs, 'downsample': downsample,
+            'start_time': start_time, 'end_time': end_time,
+            'clean_artifacts': clean_artifacts, 'thresh': thresh,
+            'warp': warp, 'smooth': smooth, 'smooth_win': smooth_win}
+    save_dir = trigger_store_dir(mouse, pars=pars)
+
+    def _saved(date, run):
+        return not force and os.path.isfile(
+            _trigger_store_path(save_dir, date, run, file_format))
+
+    runs = trigger_runs(
+        mouse, trace_type=trace_type, cs=cs, downsample=downsample,
+        start_time=start_time, end_time=end_time,
+        clean_artifacts=clean_artifacts, thresh=thresh, warp=warp,
+        smooth=smooth, smooth_win=smooth_win, trace_dtype=trace_dtype,
+        skip=_saved)
+    for run, run_df in runs:
+        save_path = _trigger_store_path(save_dir, run.date, run.run, file_format)
+        date_dir = os.path.dirname(save_path)
+        if not os.path.isdir(date_dir):
+            os.mkdir(date_dir)
+
+        # write to a temporary name so a killed job never leaves a partial run
+        tmp_path = save_path + '.tmp'
+        if file_format == 'parquet':
+            run_df.to_parquet(tmp_path, index=False)
+        elif file_format == 'feather':
+            run_df.to_feather(tmp_path)
+        else:
+            raise ValueError('file_format must be parquet or feather.')
+        os.replace(tmp_path, save_path)
+
+        if verbose:
+            print('{}_{}: run {}: {} rows saved.'.format(
+                run.mouse, run.date, run.run, len(run_df)))
+
+    return save_dir
+
+
+def load_trigger_store(mouse, dates=None, runs=None, cells=None, columns=None,
+                       trace_type='zscore_day', word=None, pars=None,
+                       file_format='parquet'):
+    """
+    Read triggered traces saved with trigger_store, only opening the files
+    for the requested dates and runs and only the requested columns.
+
+    Parameters:
+    -----------
+    mouse : str
+        Mouse name.
+    dates : int or list of int
+        Dates to load, None loads all.
+    runs : int or list of int
+        Runs to load, None loads all.
+    cells : int or list of int
+        Cell ids (cell_idx) to keep, None keeps all.
+    columns : list of str
+        Columns to read, None reads all.
+    trace_type : str
+        Trace type, used with word to find the store.
+    word : str
+        Hash word of trigger parameters.
+    pars : dict
+        Full set of trigger parameters as passed to trigger_store,
+        alternative to word.
+    file_format : str
+        'parquet' or 'feather'
+
+    Returns:
+    --------
+    pandas.DataFrame
+    """
+
+    # partial pars would hash to a different store, so require all of them
+    if word is None:
+        assert pars is not None and all([k in pars for k in _trigger_store_pars]), \
+            'Pass word or the full trigger pars: {}'.format(_trigger_store_pars)
+    if pars is None:
+        pars = {'trace_type': trace_type}
+    save_dir = trigger_store_dir(mouse, pars=pars, word=word, create=False)
+    assert os.path.isdir(save_dir), 'No trigger store at: {}'.format(save_dir)
+
+    if columns is not None and cells is not None and 'cell_idx' not in columns:
+        read_columns = list(columns) + ['cell_idx']
+    else:
+        read_columns = columns
+
+    run_dfs = []
+    for date_dir in sorted(os.listdir(save_dir)):
+        date = int(date_dir.split('=')[-1])
+        if dates is not None and date not in np.atleast_1d(dates):
+            continue
+        for run_file in sorted(os.listdir(os.path.join(save_dir, date_dir))):
+            if not run_file.endswith('.' + file_format):
+                continue
+            run = int(run_file.split('=')[-1].split('.')[0])
+            if runs is not None and run not in np.atleast_1d(runs):
+                continue
+            load_path = os.path.join(save_dir, date_dir, run_file)
+            if file_format == 'parquet':
+                run_df = pd.read_parquet(load_path, columns=read_columns)
+            else:
+                run_df = pd.read_feather(load_path, columns=read_columns)
+            if cells is not None:
+                run_df = run_df.loc[run_df['cell_idx'].isin(np.atleast_1d(cells)), :]
+                if columns is not None:
+                    run_df = run_df.loc[:, columns]
+            run_dfs.append(run_df)
+
+    if len(run_dfs) == 0:
+        return pd.DataFrame(columns=columns)
+
+    return pd.concat(run_dfs, axis=0, ignore_index=True)
+
+
+def _trigger_store_path(save_dir, date, run, file_format='parquet'):
+    """Path of a single run in a trigger store."""
+
+    return os.path.join(save_dir, 'date=' + str(date),
+                        'run=' + str(run) + '.' + file_format)
+
+
+def _trigger_run(run, trace_type='zscore_day', cs='', downsample=True,
+                 start_time=-1, end_time=6, clean_artifacts=None,
+                 thresh=20, warp=False, smooth=True, smooth_win=5):
+    """
+    Trigger all trials of a run around stimulus onsets.
+
+    :return: run_traces, numpy.ndarray, cells x times x trials
+             cell_ids, list of int, cross-day cell id for each cell
+             timestamps, numpy.ndarray, time of each sample
+    """
+
+    # get your t2p object
+    t2p = run.trace2p()
+
+    # get your cell# from xday alignment
+    # use to index along axis=0 in cstraces/run_traces
+    cell_ids = flow.xday._read_crossday_ids(run.mouse, run.date)
+    cell_ids = [int(s) for s in cell_ids]
+
+    # trigger all trials around stimulus onsets
+    run_traces = utils.getcstraces(run, cs=cs, trace_type=trace_type,
+                                   start_time=start_time, end_time=end_time,
+                                   downsample=True, clean_artifacts=clean_artifacts,
+                                   thresh=thresh, warp=warp, smooth=smooth,
+                                   smooth_win=smooth_win)
+
+    # make timestamps, downsample is necessary
+    timestep = 1 / t2p.d['framerate']
+    timestamps = np.arange(start_time, end_time, timestep)
+
+    if (t2p.d['framerate'] > 30) and downsample:
+        timestamps = timestamps[::2][:np.shape(run_traces)[1]]
+
+    # check that you don't have extra cells
+    if len(cell_ids) != np.shape(run_traces)[0]:
+        run_traces = run_traces[range(0, len(cell_ids)), :, :]
+        warnings.warn(str(run) + ': You have more cell traces than cell_idx: skipping extra cells.')
+
+    return run_traces, cell_ids, timestamps
+
+
 def trialmeta(mouse, downsample=True, verbose=True):
     """
     Create a pandas dataframe of all of your trial metadata
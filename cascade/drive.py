@@ -5,7 +5,7 @@ import flow
 import pool
 import numpy as np
 import pandas as pd
-from scipy import stats
+from scipy import stats, special
 
 
 def drive_map_from_meta_and_ids(meta, ids, drive_type='trial'):
@@ -318,9 +318,12 @@ def multi_stat_drive(meta, ids, tensor, alternative='less', offset_bool=None):
     :return: pandas.DataFrame of drivenness p-values and -log10(p-values) for each cell for each stage and cue.
     """
 
+    # means of the tensor are shared by the calls below
+    summary = utils.TensorSummary(tensor)
+
     # offset_bool = cas.utils.get_offset_cells(meta, pref_tensor)
     if offset_bool is None:
-        offset_bool = utils.get_offset_cells(meta, tensor)
+        offset_bool = utils.get_offset_cells(meta, tensor, summary=summary)
 
     # You can't use 'greater', it will test an unintended direction
     assert alternative.lower() in ['less', 'two-sided']
@@ -342,92 +345,194 @@ def multi_stat_drive(meta, ids, tensor, alternative='less', offset_bool=None):
     stim_off_frame_minus1s = np.where(time_vec > stim_length - 1)[0][0]
 
     # get mean trial response matriices, cells x trials
-    mean_t_tensor = utils.tensor_mean_per_trial(meta, tensor, nan_licking=False, account_for_offset=True)
-    mean_t_baselines = np.nanmean(tensor[:, :15, :], axis=1)
-    mean_t_1stsec = np.nanmean(tensor[:, ms200:ms700, :], axis=1)
+    mean_t_tensor = utils.tensor_mean_per_trial(
+        meta, tensor, nan_licking=False, account_for_offset=True, summary=summary)
+    mean_t_baselines = summary.window_mean(0, 15)
+    mean_t_1stsec = summary.window_mean(ms200, ms700)
 
     # for offset cells it is useful to have averages of 1sec before offset and 1 sec after as well
-    mean_t_off_baselines = np.nanmean(tensor[:, stim_off_frame_minus1s:stim_off_frame, :], axis=1)
-    mean_t_off_1st_sec = np.nanmean(tensor[:, off_ms200:off_ms700, :], axis=1)
+    mean_t_off_baselines = summary.window_mean(stim_off_frame_minus1s, stim_off_frame)
+    mean_t_off_1st_sec = summary.window_mean(off_ms200, off_ms700)
     
-    # preallocate
-    data = {
-        'mouse': [],
-        'parsed_11stage': [],
-        'initial_cue': [],
-        'cell_id': [],
-        'cell_n':[],
-        'pv': [],
-        'neg_log10_pv': []
-    }
+    # test all cells of a stage and cue at once
+    data = {'mouse': [], 'parsed_11stage': [], 'initial_cue': [], 'cell_id': [], 'cell_n': [], 'pv': []}
+    offset_bool = np.asarray(offset_bool, dtype=bool)
+    ids = np.asarray(ids)
     for si, stage in enumerate(lookups.staging['parsed_11stage']):
         stage_boo = meta.parsed_11stage.isin([stage]).values
 
         for icue in ['plus', 'minus', 'neutral']:
             cue_boo = meta.initial_cue.isin([icue]).values
+            epoch_bool = stage_boo & cue_boo
 
-            for celli in range(mean_t_tensor.shape[0]):
-                cell_boo = ~np.isnan(mean_t_tensor[celli, :])
+            # existing trials of each cell, cells with no matched trials are skipped
+            cell_trials = ~np.isnan(mean_t_tensor[:, epoch_bool])
+            cells = np.where(np.sum(cell_trials, axis=1) > 0)[0]
+            if len(cells) == 0:
+                continue
+            cell_trials = cell_trials[cells, :]
+
+            # get baseline vectors
+            # mean_t_tensor accounts for offset, so this is the first test for both cases full-stim or full-offset
+            epoch_bases = mean_t_baselines[cells, :][:, epoch_bool]
+            epoch_means = mean_t_tensor[cells, :][:, epoch_bool]
+
+            # different 1st second if a cell is a stimulus peaking or offset peaking cell
+            # stim: check 1st second of stim period to not punish transient responses
+            # offset: 1st second following offset
+            cell_off = offset_bool[cells]
+            epoch_1s = np.where(cell_off[:, None],
+                                mean_t_off_1st_sec[cells, :][:, epoch_bool],
+                                mean_t_1stsec[cells, :][:, epoch_bool])
+
+            # check for drivenness
+            # this compares baseline to the full stim or offset period as well as to the first second of both
+            # tests bases-means delta is negative, H0: symmetric
+            pv_epoch = _wilcoxon_rows(epoch_bases, epoch_means, cell_trials, alternative)
+            pv_epoch_1s = _wilcoxon_rows(epoch_bases, epoch_1s, cell_trials, alternative)
+
+            # reset pv_epoch to be best with bonferroni
+            pv_epoch = np.fmin(pv_epoch, pv_epoch_1s) * 2
+
+            # additional tests specific offset using the 1s before stim offset as a baseline
+            if np.any(cell_off):
+                # additional baseline values defined from last second of the stimulus
+                off_epoch_bases = mean_t_off_baselines[cells[cell_off], :][:, epoch_bool]
+
+                # this compares 1s pre offset to stim or offset period as well as to the first second of both
+                off_pv_epoch = _wilcoxon_rows(
+                    off_epoch_bases, epoch_means[cell_off], cell_trials[cell_off], alternative)
+                off_pv_epoch_1s = _wilcoxon_rows(
+                    off_epoch_bases, epoch_1s[cell_off], cell_trials[cell_off], alternative)
 
-                # get boolean of stage, cue, and existing trials
-                existing_epoch_trial_bool = stage_boo & cue_boo & cell_boo
-                if np.sum(existing_epoch_trial_bool) == 0:  # no matched trials for cell
-                    continue
+                # reset pv_epoch to be best with bonferroni
+                off_pv_epoch = np.fmin(off_pv_epoch, off_pv_epoch_1s) * 2
+
+                # select your final p-value for offset cells to be the worst of the two comparisons.
+                # 1. baseline-(full or 1s)
+                # 2. last_second_of_stim-(full or 1s)
+                # both must be significant for a cell to pass so select the worst of the two for offset cells.
+                pv_epoch[cell_off] = np.fmax(pv_epoch[cell_off], off_pv_epoch)
+
+            # add columns for your dataframe
+            data['mouse'].append(np.repeat(mouse, len(cells)))
+            data['parsed_11stage'].append(np.repeat(stage, len(cells)))
+            data['initial_cue'].append(np.repeat(icue, len(cells)))
+            data['cell_id'].append(ids[cells])
+            data['cell_n'].append(cells + 1)
+            data['pv'].append(pv_epoch)
+
+    data = {k: np.concatenate(v) if len(v) > 0 else [] for k, v in data.items()}
+    with np.errstate(divide='ignore'):
+        data['neg_log10_pv'] = -np.log10(data['pv'])
 
-                # get baseline vectors
-                # mean_t_tensor accounts for offset, so this is the first test for both cases full-stim or full-offset
-                epoch_bases = mean_t_baselines[celli, existing_epoch_trial_bool]
-                epoch_means = mean_t_tensor[celli, existing_epoch_trial_bool]
+    df = pd.DataFrame(data=data).set_index(['mouse', 'parsed_11stage', 'initial_cue'])
 
-                # different calcs if a cell is a stimulus peaking or offset peaking cell
-                if not offset_bool[celli]:
+    return df
 
-                    # additional test, check 1st second of stim period to not punish transient responses
-                    epoch_1s = mean_t_1stsec[celli, existing_epoch_trial_bool]
 
-                else:
+def _wilcoxon_rows(x, y, valid, alternative='less'):
+    """
+    scipy.stats.wilcoxon(x[i, valid[i]], y[i, valid[i]], alternative=alternative)
+    for every row i at once. Differences are ranked per row (average ranks for
+    ties), then p-values come from the exact null distribution (n <= 50, no
+    ties) or the tie-corrected normal approximation, matching scipy's default
+    method='auto' and correction=False. A row with a NaN difference gets a NaN
+    p-value. The few rows scipy tests by permutation (zero differences, or
+    ties with n <= 13) are passed to scipy.
+
+    :param x: numpy.ndarray, rows x samples
+    :param y: numpy.ndarray, rows x samples
+    :param valid: boolean numpy.ndarray, rows x samples, samples of each row
+    :param alternative: str, 'less', 'greater' or 'two-sided'
+    :return: numpy.ndarray, p-value of each row
+    """
 
-                    # additional baseline values defined from last second of the stimulus
-                    off_epoch_bases = mean_t_off_baselines[celli, existing_epoch_trial_bool]  # last second of stimulus
+    if alternative not in ['less', 'greater', 'two-sided']:
+        raise ValueError("alternative must be 'less', 'greater' or 'two-sided'")
+
+    d = x - y
+    samples = valid
+    n_total = np.sum(samples, axis=1)
+    has_nan = np.any(np.isnan(d) & samples, axis=1)
+    has_zero = np.any((d == 0) & samples, axis=1)
+    valid = samples & ~np.isnan(d) & (d != 0)
+    count = np.sum(valid, axis=1)
+
+    # average ranks of |d| within each row, invalid samples sort last as inf
+    nrow, ncol = d.shape
+    absd = np.where(valid, np.abs(d), np.inf)
+    order = np.argsort(absd, axis=1, kind='mergesort')
+    sorted_d = np.take_along_axis(absd, order, axis=1)
+    group_start = np.ones(d.shape, dtype=bool)
+    group_start[:, 1:] = sorted_d[:, 1:] != sorted_d[:, :-1]
+    group = np.cumsum(group_start.ravel()) - 1
+    group_size = np.bincount(group)
+    group_rank = np.bincount(group, weights=np.tile(np.arange(1, ncol + 1), nrow)) / group_size
+    ranks = np.empty(d.shape)
+    np.put_along_axis(ranks, order, group_rank[group].reshape(d.shape), axis=1)
+    r_plus = np.sum(np.where(valid & (d > 0), ranks, 0), axis=1)
+
+    # ties among valid samples of each row
+    group_row = np.repeat(np.arange(nrow), ncol)[group_start.ravel()]
+    group_valid = np.isfinite(sorted_d.ravel()[group_start.ravel()])
+    tie_correct = np.bincount(group_row, weights=(group_size**3 - group_size) * group_valid,
+                              minlength=nrow)
+    has_ties = np.bincount(group_row, weights=(group_size > 1) & group_valid, minlength=nrow) > 0
+
+    pv = np.zeros(nrow)
+    pv[:] = np.nan
+    permutation = ~has_nan & (has_zero | (has_ties & (n_total <= 13)))
+    exact = ~has_nan & ~permutation & (n_total <= 50) & ~has_ties & ~has_zero
+    asymptotic = ~has_nan & ~permutation & ~exact & (count > 0)
+
+    # normal approximation
+    mn = count * (count + 1.) * 0.25
+    with np.errstate(invalid='ignore', divide='ignore'):
+        se = np.sqrt((count * (count + 1.) * (2. * count + 1.) - tie_correct / 2) / 24)
+        z = (r_plus - mn) / se
+    if alternative == 'less':
+        pv[asymptotic] = special.ndtr(z[asymptotic])
+    elif alternative == 'greater':
+        pv[asymptotic] = special.ndtr(-z[asymptotic])
+    else:
+        pv[asymptotic] = 2 * special.ndtr(-np.abs(z[asymptotic]))
 
-                    # additional data for 1st second following offset
-                    epoch_1s = mean_t_off_1st_sec[celli, existing_epoch_trial_bool]  # first second following offset
+    # exact null distribution, r_plus is an integer without ties
+    for n in np.unique(count[exact]):
+        rows = exact & (count == n)
+        k = np.round(r_plus[rows]).astype(int)
+        cdf, sf = _wilcoxon_cdf_sf(n)
+        if alternative == 'less':
+            pv[rows] = cdf[k]
+        elif alternative == 'greater':
+            pv[rows] = sf[k]
+        else:
+            pv[rows] = np.clip(2 * np.minimum(sf[k], cdf[k]), 0, 1)
 
-                # check for drivenness
-                # this compares baseline to the full stim or offset period as well as to the first second of both
-                # tests bases-means delta is negative, H0: symmetric
-                pv_epoch = stats.wilcoxon(epoch_bases, epoch_means, alternative=alternative).pvalue
-                pv_epoch_1s = stats.wilcoxon(epoch_bases, epoch_1s, alternative=alternative).pvalue
+    for ri in np.where(permutation)[0]:
+        pv[ri] = stats.wilcoxon(x[ri, samples[ri]], y[ri, samples[ri]], alternative=alternative).pvalue
 
-                # reset pv_epoch to be best with bonferroni
-                pv_epoch = np.nanmin([pv_epoch, pv_epoch_1s]) * 2
-
-                # additional tests specific offset using the 1s before stim offset as a baseline
-                if offset_bool[celli]:
-                    # this compares 1s pre offset to stim or offset period as well as to the first second of both
-                    off_pv_epoch = stats.wilcoxon(off_epoch_bases, epoch_means, alternative=alternative).pvalue
-                    off_pv_epoch_1s = stats.wilcoxon(off_epoch_bases, epoch_1s, alternative=alternative).pvalue
-
-                    # reset pv_epoch to be best with bonferroni
-                    off_pv_epoch = np.nanmin([off_pv_epoch, off_pv_epoch_1s]) * 2
-
-                    # select your final p-value for offset cells to be the worst of the two comparisons.
-                    # 1. baseline-(full or 1s)
-                    # 2. last_second_of_stim-(full or 1s)
-                    # both must be significant for a cell to pass so select the worst of the two for offset cells.
-
-                    # pick the worst of your 2 p_values.
-                    pv_epoch = np.nanmax([pv_epoch, off_pv_epoch])
-
-                # build your dict for a dataframe
-                data['mouse'].append(mouse)
-                data['parsed_11stage'].append(stage)
-                data['initial_cue'].append(icue)
-                data['cell_id'].append(ids[celli])
-                data['cell_n'].append(celli + 1)
-                data['pv'].append(pv_epoch)
-                data['neg_log10_pv'].append(-np.log10(pv_epoch))
+    return pv
 
-    df = pd.DataFrame(data=data).set_index(['mouse', 'parsed_11stage', 'initial_cue'])
 
-    return df
+_wilcoxon_distributions = {}
+
+
+def _wilcoxon_cdf_sf(n):
+    """
+    Exact null distribution of the signed-rank statistic for n samples.
+
+    :return: cdf, sf: numpy.ndarray, P(T <= k) and P(T >= k) for k = 0 ... n(n+1)/2
+    """
+
+    if n not in _wilcoxon_distributions:
+        # number of subsets of ranks 1 ... n with each sum
+        counts = np.zeros(n * (n + 1) // 2 + 1)
+        counts[0] = 1
+        for i in range(1, n + 1):
+            counts[i:] = counts[i:] + counts[:-i]
+        pmf = counts / 2.**n
+        _wilcoxon_distributions[n] = (np.cumsum(pmf), np.cumsum(pmf[::-1])[::-1])
+
+    return _wilcoxon_distributions[n]
@@ -1,10 +1,12 @@
 """Functions for fitting generalized linear models (GLM)."""
+import os
 import flow
 import pool
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from . import utils, load, calc, lookups
+from scipy import special, stats
+from . import utils, load, calc, lookups, cache
 from . psytrack.train_factor import sync_tca_pillow
 from flow.misc import regression
 from copy import deepcopy
@@ -745,9 +747,20 @@ def groupmouse_fit_poisson(
         hitmiss=False,
         hitmiss_v2=False,
         hitmiss_v3=False,
-        verbose=True, **kwargs):
+        verbose=True, n_jobs=1, force=False, **kwargs):
     """
     Create a pandas dataframe of GLM results fit across mice.
+
+    The results for each mouse are cached in its output directory under a
+    hash of the model variant and all of its parameters, so rerunning with
+    a changed option only refits the mice whose inputs changed. The key also
+    holds the modification times of the TCA ids, decomp and meta files, so
+    rerunning TCA under the same word refits too. A psytracker refit with
+    the same sigmas is not detected, use force. Mice that need fitting are
+    dispatched to n_jobs worker processes (if only one mouse needs fitting
+    its components are fit in parallel instead).
+
+    :param force: bool, refit all mice even if their results are cached
     """
     kwargs_defaults = {
         'trace_type': 'zscore_day',
@@ -771,42 +784,83 @@ def groupmouse_fit_poisson(
         w2 = 'whale'
         words = [w1 if s == 'OA27' else w2 for s in mice]
 
-    # get all single mouse dataframes
-    df_list = []
+    if hitmiss:
+        # includes preferred ori and relevant hit/miss, CR/FA
+        variant = 'hitmiss'
+    elif hitmiss_v2:
+        # includes preferred ori and relevant hit, CR
+        variant = 'hitmiss_v2'
+    elif hitmiss_v3:
+        # includes relevant hit/miss, CR/FA
+        variant = 'hitmiss_v3'
+    else:
+        # includes preferred ori and relevant plus, minus, neutral
+        variant = 'cs'
+
+    # get cached single mouse dataframes
+    mouse_pars, df_dict, to_fit = {}, {}, []
     for m, w in zip(mice, words):
-        kwargs_defaults['word'] = w
-        if hitmiss:
-            # includes preferred ori and relevant hit/miss, CR/FA
-            th_df = fit_trial_factors_poisson_hitmiss(
-                        m,
-                        verbose=verbose,
-                        **kwargs_defaults)
-        elif hitmiss_v2:
-            # includes preferred ori and relevant hit, CR
-            th_df = fit_trial_factors_poisson_hitmiss_v2(
-                        m,
-                        verbose=verbose,
-                        **kwargs_defaults)
-        elif hitmiss_v3:
-            # includes relevant hit/miss, CR/FA
-            th_df = fit_trial_factors_poisson_hitmiss_v3(
-                        m,
-                        verbose=verbose,
-                        **kwargs_defaults)
+        mouse_pars[m] = {'mouse': m, 'variant': variant,
+                         'kwargs': dict(kwargs_defaults, word=w)}
+        mouse_pars[m]['inputs'] = _poisson_input_mtimes(m, mouse_pars[m]['kwargs'])
+        cached = cache.lookup(m, 'glm_poisson', mouse_pars[m])
+        if cached is not None and not force:
+            if verbose:
+                print('{}: Loading cached GLM fits.'.format(m))
+            df_dict[m] = pd.read_pickle(cached)
         else:
-            # includes preferred ori and relevant plus, minus, neutral
-            th_df = fit_trial_factors_poisson(
-                        m,
-                        verbose=verbose,
-                        **kwargs_defaults)
-
-        df_list.append(th_df)
-    all_dfs = pd.concat(df_list, axis=0)
+            to_fit.append(m)
+
+    # fit the remaining mice, with a single mouse to fit spread its
+    # components across workers instead
+    mouse_jobs, component_jobs = (1, n_jobs) if len(to_fit) == 1 else (n_jobs, 1)
+    fit_args = [(m, variant, verbose, component_jobs, mouse_pars[m]['kwargs'])
+                for m in to_fit]
+    fits = utils.process_map(_fit_poisson_mouse, fit_args, n_jobs=mouse_jobs)
+    for m, th_df in zip(to_fit, fits):
+        save_path = os.path.join(
+            flow.paths.outd, str(m),
+            'glm_poisson_{}.pkl'.format(cache.artifact_key(mouse_pars[m])))
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        th_df.to_pickle(save_path)
+        cache.register(m, 'glm_poisson', mouse_pars[m], save_path)
+        df_dict[m] = th_df
+    all_dfs = pd.concat([df_dict[m] for m in mice], axis=0)
 
     return all_dfs
 
 
-def fit_trial_factors_poisson(mouse, verbose=True, **kwargs):
+def _poisson_input_mtimes(mouse, kwargs):
+    """
+    Modification times of the TCA files a groupmouse_fit_poisson fit reads,
+    so cached fits are refit after the TCA is rerun under the same word.
+    """
+
+    tca_kwargs = {k: kwargs[k] for k in
+                  ['trace_type', 'cs', 'warp', 'word', 'group_by',
+                   'nan_thresh', 'score_threshold']}
+    tca_paths = load.groupday_tca_paths(mouse=mouse, **tca_kwargs)
+
+    return {k: os.path.getmtime(p) if os.path.isfile(p) else None
+            for k, p in tca_paths.items()}
+
+
+def _fit_poisson_mouse(mouse, variant, verbose, n_jobs, kwargs):
+    """
+    Fit the trial factor Poisson GLMs of one mouse for a groupmouse_fit_poisson
+    worker.
+    """
+
+    fit_func = {
+        'cs': fit_trial_factors_poisson,
+        'hitmiss': fit_trial_factors_poisson_hitmiss,
+        'hitmiss_v2': fit_trial_factors_poisson_hitmiss_v2,
+        'hitmiss_v3': fit_trial_factors_poisson_hitmiss_v3}[variant]
+
+    return fit_func(mouse, verbose=verbose, n_jobs=n_jobs, **kwargs)
+
+
+def fit_trial_factors_poisson(mouse, verbose=True, n_jobs=1, **kwargs):
     kwargs_defaults = {
         'trace_type': 'zscore_day',
         'method': 'mncp_hals',
@@ -883,11 +937,7 @@ def fit_trial_factors_poisson(mouse, verbose=True, **kwargs):
     filters_subset = zfilters_df.loc[:, cols]
 
     # fit GLM and a GLM dropping out each filter to test deviance explained
-    models, model_fits, dev_exp_full_list = [], [], []
-    delta_aic_full_list, sub_aic_full_list = [], []
-    total_aic_full_list = []
-    total_dev_full_list = []
-    fac_list = []
+    formulas = []
     for fac_num in range(1, kwargs_defaults['rank_num']+1):
         # original formula
         fac_tuning = tuning_df.loc[(mouse, fac_num), 'preferred_tuning']
@@ -950,108 +1000,13 @@ def fit_trial_factors_poisson(mouse, verbose=True, **kwargs):
                 ' pupil +',
                 ' + anticipatory_licks']
 
-        # add your factor for fitting as the y variable
-        fac = 'factor_' + str(fac_num)
-        sub_xy = filters_subset.join(fac_df)
-        # scale and round to make it Poisson-friendly
-        sub_xy['y'] = deepcopy((sub_xy[fac]*100).apply(np.floor))
-        sub_xy = sub_xy.reset_index()
-
-        # if a filter is totally empty remove it from the formula and the drop
-        for col in sub_xy.columns:
-            total_nan = np.sum(sub_xy[col].isna().values)
-            total_vals = len(sub_xy[col].values)
-            if total_nan == total_vals:
-                sub_xy = sub_xy.drop(columns=[col])
-                formula = formula.replace([s for s in drop_list if col in s][0], '')
-                drop_list = [s for s in drop_list if col not in s]
-                if verbose:
-                    print('{}: dropped column/filter: {}'.format(mouse, col))
-
-        # make sure you don't have any nans
-        sub_xy = sub_xy.replace([np.inf, -np.inf], np.nan).dropna()
-
-        try:
-            model = regression.glm(
-                formula, sub_xy, dropzeros=False,
-                link='log', family='Poisson', verbose=False)
-        except ValueError:
-            print('!!!!!!')
-            print('{}: Skipped {}'.format(mouse, fac))
-            print('!!!!!!')
-            continue
-
-        models.append(model)
-        res = model.fit()
-        model_fits.append(res)
-        total_dev_exp = 1 - res.deviance/res.null_deviance
-        total_aic = res.aic
-        if verbose:
-            print('{}: Component {}'.format(mouse, fac_num))
-            print('    Total deviance explained: ',
-                  1 - res.deviance/res.null_deviance)
-
-        # get deviance explained per filter
-        # add NaN for the internal intercept
-        dev_explained_drop = []
-        delta_aic = []
-        aic_drop = []
-        for c, dl in enumerate(drop_list):
-            drop_formula = formula.replace(dl, '')
-            try:
-                model = regression.glm(
-                    drop_formula, sub_xy, dropzeros=False,
-                    link='log', family='Poisson', verbose=False)
-            except:
-                dev_explained_drop.append(np.nan)
-                delta_aic.append(np.nan)
-                aic_drop.append(np.nan)
-                continue
-            # make up for the intercept beta
-            if c == 0:
-                dev_explained_drop.append(np.nan)
-                delta_aic.append(np.nan)
-                aic_drop.append(np.nan)
-            res = model.fit()
-            aic_drop.append(res.aic)
-            delta_aic.append(res.aic - total_aic)
-            drop_dev_exp = 1 - res.deviance/res.null_deviance
-            dev_explained_drop.append(total_dev_exp - drop_dev_exp)
-            delta_aic
-        dev_exp_full_list.extend(dev_explained_drop)
-        sub_aic_full_list.extend(aic_drop)
-        delta_aic_full_list.extend(delta_aic)
-        total_aic_full_list.extend([total_aic]*len(delta_aic))
-        total_dev_full_list.extend([total_dev_exp]*len(delta_aic))
-        fac_list.append(fac_num)
-
-    # aggregate all of your fit results
-    df_list = []
-    for c, mod in zip(fac_list, model_fits):
-        mod_df = mod.summary2().tables[1]
-        mod_df['component'] = [c]*len(mod_df)
-        mod_df['x'] = mod_df.index
-        df_list.append(mod_df)
-    all_model_df = pd.concat(df_list, axis=0)
-    all_model_df['sub_deviance_explained'] = dev_exp_full_list
-    all_model_df['frac_deviance_explained'] = (
-        np.array(dev_exp_full_list)/np.array(total_dev_full_list))
-    all_model_df['sub_model_aic'] = sub_aic_full_list
-    all_model_df['delta_aic'] = delta_aic_full_list
-    all_model_df['full_model_aic'] = total_aic_full_list
-    all_model_df['full_deviance_explained'] = total_dev_full_list
-
-    all_model_df['mouse'] = [mouse]*len(all_model_df)
-    all_model_df = (
-        all_model_df
-        .reset_index()
-        .drop(columns=['index'])
-        .set_index(['mouse', 'component', 'x']))
+        formulas.append((fac_num, formula, drop_list))
 
-    return all_model_df
+    return _fit_poisson_drop_one(
+        mouse, filters_subset, fac_df, formulas, verbose=verbose, n_jobs=n_jobs)
 
 
-def fit_trial_factors_poisson_hitmiss(mouse, verbose=True, **kwargs):
+def fit_trial_factors_poisson_hitmiss(mouse, verbose=True, n_jobs=1, **kwargs):
     kwargs_defaults = {
         'trace_type': 'zscore_day',
         'method': 'mncp_hals',
@@ -1147,11 +1102,7 @@ def fit_trial_factors_poisson_hitmiss(mouse, verbose=True, **kwargs):
     filters_subset = zfilters_df.loc[:, cols]
 
     # fit GLM and a GLM dropping out each filter to test deviance explained
-    models, model_fits, dev_exp_full_list = [], [], []
-    delta_aic_full_list, sub_aic_full_list = [], []
-    total_aic_full_list = []
-    total_dev_full_list = []
-    fac_list = []
+    formulas = []
     for fac_num in range(1, kwargs_defaults['rank_num']+1):
 
         # get your tuning (ori), cs, or trialerror vectors for each factor
@@ -1241,108 +1192,13 @@ def fit_trial_factors_poisson_hitmiss(mouse, verbose=True, **kwargs):
                 ' pupil +',
                 ' + anticipatory_licks']
 
-        # add your factor for fitting as the y variable
-        fac = 'factor_' + str(fac_num)
-        sub_xy = filters_subset.join(fac_df)
-        # scale and round to make it Poisson-friendly
-        sub_xy['y'] = deepcopy((sub_xy[fac]*100).apply(np.floor))
-        sub_xy = sub_xy.reset_index()
-
-        # if a filter is totally empty remove it from the formula and the drop
-        for col in sub_xy.columns:
-            total_nan = np.sum(sub_xy[col].isna().values)
-            total_vals = len(sub_xy[col].values)
-            if total_nan == total_vals:
-                sub_xy = sub_xy.drop(columns=[col])
-                formula = formula.replace([s for s in drop_list if col in s][0], '')
-                drop_list = [s for s in drop_list if col not in s]
-                if verbose:
-                    print('{}: dropped column/filter: {}'.format(mouse, col))
-
-        # make sure you don't have any nans
-        sub_xy = sub_xy.replace([np.inf, -np.inf], np.nan).dropna()
-
-        try:
-            model = regression.glm(
-                formula, sub_xy, dropzeros=False,
-                link='log', family='Poisson', verbose=False)
-        except ValueError:
-            print('!!!!!!')
-            print('{}: Skipped {}'.format(mouse, fac))
-            print('!!!!!!')
-            continue
-
-        models.append(model)
-        res = model.fit()
-        model_fits.append(res)
-        total_dev_exp = 1 - res.deviance/res.null_deviance
-        total_aic = res.aic
-        if verbose:
-            print('{}: Component {}'.format(mouse, fac_num))
-            print('    Total deviance explained: ',
-                  1 - res.deviance/res.null_deviance)
-
-        # get deviance explained per filter
-        # add NaN for the internal intercept
-        dev_explained_drop = []
-        delta_aic = []
-        aic_drop = []
-        for c, dl in enumerate(drop_list):
-            drop_formula = formula.replace(dl, '')
-            try:
-                model = regression.glm(
-                    drop_formula, sub_xy, dropzeros=False,
-                    link='log', family='Poisson', verbose=False)
-            except:
-                dev_explained_drop.append(np.nan)
-                delta_aic.append(np.nan)
-                aic_drop.append(np.nan)
-                continue
-            # make up for the intercept beta
-            if c == 0:
-                dev_explained_drop.append(np.nan)
-                delta_aic.append(np.nan)
-                aic_drop.append(np.nan)
-            res = model.fit()
-            aic_drop.append(res.aic)
-            delta_aic.append(res.aic - total_aic)
-            drop_dev_exp = 1 - res.deviance/res.null_deviance
-            dev_explained_drop.append(total_dev_exp - drop_dev_exp)
-            delta_aic
-        dev_exp_full_list.extend(dev_explained_drop)
-        sub_aic_full_list.extend(aic_drop)
-        delta_aic_full_list.extend(delta_aic)
-        total_aic_full_list.extend([total_aic]*len(delta_aic))
-        total_dev_full_list.extend([total_dev_exp]*len(delta_aic))
-        fac_list.append(fac_num)
-
-    # aggregate all of your fit results
-    df_list = []
-    for c, mod in zip(fac_list, model_fits):
-        mod_df = mod.summary2().tables[1]
-        mod_df['component'] = [c]*len(mod_df)
-        mod_df['x'] = mod_df.index
-        df_list.append(mod_df)
-    all_model_df = pd.concat(df_list, axis=0)
-    all_model_df['sub_deviance_explained'] = dev_exp_full_list
-    all_model_df['frac_deviance_explained'] = (
-        np.array(dev_exp_full_list)/np.array(total_dev_full_list))
-    all_model_df['sub_model_aic'] = sub_aic_full_list
-    all_model_df['delta_aic'] = delta_aic_full_list
-    all_model_df['full_model_aic'] = total_aic_full_list
-    all_model_df['full_deviance_explained'] = total_dev_full_list
-
-    all_model_df['mouse'] = [mouse]*len(all_model_df)
-    all_model_df = (
-        all_model_df
-        .reset_index()
-        .drop(columns=['index'])
-        .set_index(['mouse', 'component', 'x']))
+        formulas.append((fac_num, formula, drop_list))
 
-    return all_model_df
+    return _fit_poisson_drop_one(
+        mouse, filters_subset, fac_df, formulas, verbose=verbose, n_jobs=n_jobs)
 
 
-def fit_trial_factors_poisson_hitmiss_v2(mouse, verbose=True, **kwargs):
+def fit_trial_factors_poisson_hitmiss_v2(mouse, verbose=True, n_jobs=1, **kwargs):
     kwargs_defaults = {
         'trace_type': 'zscore_day',
         'method': 'mncp_hals',
@@ -1438,11 +1294,7 @@ def fit_trial_factors_poisson_hitmiss_v2(mouse, verbose=True, **kwargs):
     filters_subset = zfilters_df.loc[:, cols]
 
     # fit GLM and a GLM dropping out each filter to test deviance explained
-    models, model_fits, dev_exp_full_list = [], [], []
-    delta_aic_full_list, sub_aic_full_list = [], []
-    total_aic_full_list = []
-    total_dev_full_list = []
-    fac_list = []
+    formulas = []
     for fac_num in range(1, kwargs_defaults['rank_num']+1):
 
         # get your tuning (ori), cs, or trialerror vectors for each factor
@@ -1520,108 +1372,13 @@ def fit_trial_factors_poisson_hitmiss_v2(mouse, verbose=True, **kwargs):
                 ' pupil +',
                 ' + anticipatory_licks']
 
-        # add your factor for fitting as the y variable
-        fac = 'factor_' + str(fac_num)
-        sub_xy = filters_subset.join(fac_df)
-        # scale and round to make it Poisson-friendly
-        sub_xy['y'] = deepcopy((sub_xy[fac]*100).apply(np.floor))
-        sub_xy = sub_xy.reset_index()
-
-        # if a filter is totally empty remove it from the formula and the drop
-        for col in sub_xy.columns:
-            total_nan = np.sum(sub_xy[col].isna().values)
-            total_vals = len(sub_xy[col].values)
-            if total_nan == total_vals:
-                sub_xy = sub_xy.drop(columns=[col])
-                formula = formula.replace([s for s in drop_list if col in s][0], '')
-                drop_list = [s for s in drop_list if col not in s]
-                if verbose:
-                    print('{}: dropped column/filter: {}'.format(mouse, col))
-
-        # make sure you don't have any nans
-        sub_xy = sub_xy.replace([np.inf, -np.inf], np.nan).dropna()
-
-        try:
-            model = regression.glm(
-                formula, sub_xy, dropzeros=False,
-                link='log', family='Poisson', verbose=False)
-        except ValueError:
-            print('!!!!!!')
-            print('{}: Skipped {}'.format(mouse, fac))
-            print('!!!!!!')
-            continue
-
-        models.append(model)
-        res = model.fit()
-        model_fits.append(res)
-        total_dev_exp = 1 - res.deviance/res.null_deviance
-        total_aic = res.aic
-        if verbose:
-            print('{}: Component {}'.format(mouse, fac_num))
-            print('    Total deviance explained: ',
-                  1 - res.deviance/res.null_deviance)
-
-        # get deviance explained per filter
-        # add NaN for the internal intercept
-        dev_explained_drop = []
-        delta_aic = []
-        aic_drop = []
-        for c, dl in enumerate(drop_list):
-            drop_formula = formula.replace(dl, '')
-            try:
-                model = regression.glm(
-                    drop_formula, sub_xy, dropzeros=False,
-                    link='log', family='Poisson', verbose=False)
-            except:
-                dev_explained_drop.append(np.nan)
-                delta_aic.append(np.nan)
-                aic_drop.append(np.nan)
-                continue
-            # make up for the intercept beta
-            if c == 0:
-                dev_explained_drop.append(np.nan)
-                delta_aic.append(np.nan)
-                aic_drop.append(np.nan)
-            res = model.fit()
-            aic_drop.append(res.aic)
-            delta_aic.append(res.aic - total_aic)
-            drop_dev_exp = 1 - res.deviance/res.null_deviance
-            dev_explained_drop.append(total_dev_exp - drop_dev_exp)
-            delta_aic
-        dev_exp_full_list.extend(dev_explained_drop)
-        sub_aic_full_list.extend(aic_drop)
-        delta_aic_full_list.extend(delta_aic)
-        total_aic_full_list.extend([total_aic]*len(delta_aic))
-        total_dev_full_list.extend([total_dev_exp]*len(delta_aic))
-        fac_list.append(fac_num)
-
-    # aggregate all of your fit results
-    df_list = []
-    for c, mod in zip(fac_list, model_fits):
-        mod_df = mod.summary2().tables[1]
-        mod_df['component'] = [c]*len(mod_df)
-        mod_df['x'] = mod_df.index
-        df_list.append(mod_df)
-    all_model_df = pd.concat(df_list, axis=0)
-    all_model_df['sub_deviance_explained'] = dev_exp_full_list
-    all_model_df['frac_deviance_explained'] = (
-        np.array(dev_exp_full_list)/np.array(total_dev_full_list))
-    all_model_df['sub_model_aic'] = sub_aic_full_list
-    all_model_df['delta_aic'] = delta_aic_full_list
-    all_model_df['full_model_aic'] = total_aic_full_list
-    all_model_df['full_deviance_explained'] = total_dev_full_list
+        formulas.append((fac_num, formula, drop_list))
 
-    all_model_df['mouse'] = [mouse]*len(all_model_df)
-    all_model_df = (
-        all_model_df
-        .reset_index()
-        .drop(columns=['index'])
-        .set_index(['mouse', 'component', 'x']))
-
-    return all_model_df
+    return _fit_poisson_drop_one(
+        mouse, filters_subset, fac_df, formulas, verbose=verbose, n_jobs=n_jobs)
 
 
-def fit_trial_factors_poisson_hitmiss_v3(mouse, verbose=True, **kwargs):
+def fit_trial_factors_poisson_hitmiss_v3(mouse, verbose=True, n_jobs=1, **kwargs):
     kwargs_defaults = {
         'trace_type': 'zscore_day',
         'method': 'mncp_hals',
@@ -1718,11 +1475,7 @@ def fit_trial_factors_poisson_hitmiss_v3(mouse, verbose=True, **kwargs):
     filters_subset = zfilters_df.loc[:, cols]
 
     # fit GLM and a GLM dropping out each filter to test deviance explained
-    models, model_fits, dev_exp_full_list = [], [], []
-    delta_aic_full_list, sub_aic_full_list = [], []
-    total_aic_full_list = []
-    total_dev_full_list = []
-    fac_list = []
+    formulas = []
     for fac_num in range(1, kwargs_defaults['rank_num']+1):
 
         # get your tuning (ori), cs, or trialerror vectors for each factor
@@ -1810,96 +1563,103 @@ def fit_trial_factors_poisson_hitmiss_v3(mouse, verbose=True, **kwargs):
             ' anticipatory_licks +',
             ' + dprime']
 
-        # add your factor for fitting as the y variable
-        fac = 'factor_' + str(fac_num)
-        sub_xy = filters_subset.join(fac_df)
-        # scale and round to make it Poisson-friendly
-        sub_xy['y'] = deepcopy((sub_xy[fac]*100).apply(np.floor))
-        sub_xy = sub_xy.reset_index()
-
-        # if a filter is totally empty remove it from the formula and the drop
-        for col in sub_xy.columns:
-            total_nan = np.sum(sub_xy[col].isna().values)
-            total_vals = len(sub_xy[col].values)
-            if total_nan == total_vals:
-                sub_xy = sub_xy.drop(columns=[col])
-                formula = formula.replace([s for s in drop_list if col in s][0], '')
-                drop_list = [s for s in drop_list if col not in s]
-                if verbose:
-                    print('{}: dropped column/filter: {}'.format(mouse, col))
-
-        # make sure you don't have any nans
-        sub_xy = sub_xy.replace([np.inf, -np.inf], np.nan).dropna()
-
-        try:
-            model = regression.glm(
-                formula, sub_xy, dropzeros=False,
-                link='log', family='Poisson', verbose=False)
-        except ValueError:
+        formulas.append((fac_num, formula, drop_list))
+
+    return _fit_poisson_drop_one(
+        mouse, filters_subset, fac_df, formulas, verbose=verbose, n_jobs=n_jobs)
+
+
+def _fit_poisson_drop_one(
+        mouse, filters_subset, fac_df, formulas, verbose=True, n_jobs=1):
+    """
+    Fit a Poisson GLM (log link) to each TCA component and a reduced GLM
+    dropping out each filter to get the deviance explained and change in AIC
+    of every filter.
+
+    The design matrix is built once for the mouse and each model picks its
+    columns from it, so formulas are only parsed for their terms. Reduced
+    models are warm-started from the full model coefficients and components
+    are fit in parallel across n_jobs worker processes.
+
+    :param mouse: str, mouse name
+    :param filters_subset: pandas.DataFrame, z-scored filters (trials x filters)
+    :param fac_df: pandas.DataFrame, TCA trial factors (trials x components)
+    :param formulas: list of tuple, (component number, formula, drop_list)
+        for each component where drop_list has the part of the formula to
+        remove for each reduced model
+    :param verbose: bool, print deviance explained for each component
+    :param n_jobs: int, number of worker processes, -1 for all cores
+    :return: pandas.DataFrame, coefficient table with deviance explained and
+        AIC for each component and filter
+    """
+
+    sub_xy = filters_subset.join(fac_df).reset_index()
+
+    # if a filter is totally empty remove it from all formulas
+    empty_cols = [c for c in filters_subset.columns if sub_xy[c].isna().all()]
+    sub_xy = sub_xy.drop(columns=empty_cols)
+    for col in empty_cols:
+        if verbose:
+            print('{}: dropped column/filter: {}'.format(mouse, col))
+
+    # make sure you don't have any nans, the same trials are used for every
+    # component so the design matrix can be shared
+    sub_xy = sub_xy.replace([np.inf, -np.inf], np.nan).dropna()
+    design_cols = ['Intercept'] + [
+        c for c in filters_subset.columns if c not in empty_cols]
+    design = np.ones((len(sub_xy), len(design_cols)))
+    design[:, 1:] = sub_xy.loc[:, design_cols[1:]].values
+
+    fac_list, term_list, fit_args = [], [], []
+    for fac_num, formula, drop_list in formulas:
+        terms = [t.strip() for t in formula.split('~')[1].split('+')]
+        terms = [t for t in terms if t not in empty_cols]
+        drop_terms = [dl.replace('+', '').strip() for dl in drop_list]
+        drop_terms = [t for t in drop_terms if t not in empty_cols]
+        missing = [t for t in terms + drop_terms if t not in design_cols]
+        if len(terms) == 0 or len(missing) > 0:
             print('!!!!!!')
-            print('{}: Skipped {}'.format(mouse, fac))
+            print('{}: Skipped factor_{}'.format(mouse, fac_num))
             print('!!!!!!')
             continue
 
-        models.append(model)
-        res = model.fit()
-        model_fits.append(res)
-        total_dev_exp = 1 - res.deviance/res.null_deviance
-        total_aic = res.aic
-        if verbose:
-            print('{}: Component {}'.format(mouse, fac_num))
-            print('    Total deviance explained: ',
-                  1 - res.deviance/res.null_deviance)
-
-        # get deviance explained per filter
-        # add NaN for the internal intercept
-        dev_explained_drop = []
-        delta_aic = []
-        aic_drop = []
-        for c, dl in enumerate(drop_list):
-            drop_formula = formula.replace(dl, '')
-            try:
-                model = regression.glm(
-                    drop_formula, sub_xy, dropzeros=False,
-                    link='log', family='Poisson', verbose=False)
-            except:
-                dev_explained_drop.append(np.nan)
-                delta_aic.append(np.nan)
-                aic_drop.append(np.nan)
-                continue
-            # make up for the intercept beta
-            if c == 0:
-                dev_explained_drop.append(np.nan)
-                delta_aic.append(np.nan)
-                aic_drop.append(np.nan)
-            res = model.fit()
-            aic_drop.append(res.aic)
-            delta_aic.append(res.aic - total_aic)
-            drop_dev_exp = 1 - res.deviance/res.null_deviance
-            dev_explained_drop.append(total_dev_exp - drop_dev_exp)
-            delta_aic
-        dev_exp_full_list.extend(dev_explained_drop)
-        sub_aic_full_list.extend(aic_drop)
-        delta_aic_full_list.extend(delta_aic)
-        total_aic_full_list.extend([total_aic]*len(delta_aic))
-        total_dev_full_list.extend([total_dev_exp]*len(delta_aic))
+        # scale and round to make it Poisson-friendly
+        y = np.floor(sub_xy['factor_' + str(fac_num)].values*100)
+        cols = [0] + [design_cols.index(t) for t in terms]
         fac_list.append(fac_num)
+        term_list.append(terms)
+        fit_args.append((y, cols, [[c for c in cols if c != design_cols.index(t)]
+                                   for t in drop_terms], drop_terms))
+
+    fits = utils.process_map(
+        _fit_poisson_component, fit_args, n_jobs=n_jobs,
+        initializer=_init_glm_worker, initargs=(design,))
+    _glm_worker_state.clear()
 
-    # aggregate all of your fit results
+    # aggregate all of your fit results, adding NaN for the intercept
     df_list = []
-    for c, mod in zip(fac_list, model_fits):
-        mod_df = mod.summary2().tables[1]
-        mod_df['component'] = [c]*len(mod_df)
+    for fac_num, terms, fit in zip(fac_list, term_list, fits):
+        total_dev_exp = 1 - fit['deviance']/fit['null_deviance']
+        total_aic = fit['aic']
+        if verbose:
+            print('{}: Component {}'.format(mouse, fac_num))
+            print('    Total deviance explained: ', total_dev_exp)
+        mod_df = _coef_table(fit['params'], fit['bse'], ['Intercept'] + terms)
+        drops = [fit['drops'].get(t, (np.nan, np.nan)) for t in terms]
+        aic_drop = np.array([np.nan] + [d[0] for d in drops])
+        dev_drop = np.array([np.nan] + [d[1] for d in drops])
+        mod_df['component'] = [fac_num]*len(mod_df)
         mod_df['x'] = mod_df.index
+        mod_df['sub_deviance_explained'] = total_dev_exp - (
+            1 - dev_drop/fit['null_deviance'])
+        mod_df['frac_deviance_explained'] = (
+            mod_df['sub_deviance_explained'].values/total_dev_exp)
+        mod_df['sub_model_aic'] = aic_drop
+        mod_df['delta_aic'] = aic_drop - total_aic
+        mod_df['full_model_aic'] = [total_aic]*len(mod_df)
+        mod_df['full_deviance_explained'] = [total_dev_exp]*len(mod_df)
         df_list.append(mod_df)
     all_model_df = pd.concat(df_list, axis=0)
-    all_model_df['sub_deviance_explained'] = dev_exp_full_list
-    all_model_df['frac_deviance_explained'] = (
-        np.array(dev_exp_full_list)/np.array(total_dev_full_list))
-    all_model_df['sub_model_aic'] = sub_aic_full_list
-    all_model_df['delta_aic'] = delta_aic_full_list
-    all_model_df['full_model_aic'] = total_aic_full_list
-    all_model_df['full_deviance_explained'] = total_dev_full_list
 
     all_model_df['mouse'] = [mouse]*len(all_model_df)
     all_model_df = (
@@ -1911,6 +1671,92 @@ def fit_trial_factors_poisson_hitmiss_v3(mouse, verbose=True, **kwargs):
     return all_model_df
 
 
+_glm_worker_state = {}
+
+
+def _init_glm_worker(design):
+    """
+    Share the design matrix of a mouse with a GLM worker once, rather than
+    pickling it for every component.
+    """
+
+    _glm_worker_state['design'] = design
+
+
+def _fit_poisson_component(y, cols, drop_cols, drop_terms):
+    """
+    Fit the full and every reduced Poisson GLM for one component using the
+    columns cols (and each list in drop_cols) of the design matrix set by
+    _init_glm_worker. Reduced models start from the full model coefficients.
+    """
+
+    design = _glm_worker_state['design']
+    params, bse, deviance, aic = _poisson_irls(design[:, cols], y)
+    fit = {'params': params, 'bse': bse, 'deviance': deviance, 'aic': aic,
+           'null_deviance': _poisson_deviance(y, np.full(len(y), np.mean(y))),
+           'drops': {}}
+    for dcols, term in zip(drop_cols, drop_terms):
+        start = params[[cols.index(c) for c in dcols]]
+        _, _, drop_dev, drop_aic = _poisson_irls(design[:, dcols], y, start=start)
+        fit['drops'][term] = (drop_aic, drop_dev)
+
+    return fit
+
+
+def _poisson_deviance(y, mu):
+    """Deviance of a Poisson GLM."""
+
+    return 2*np.sum(special.xlogy(y, y) - special.xlogy(y, mu) - (y - mu))
+
+
+def _poisson_irls(X, y, start=None, tol=1e-8, maxiter=100):
+    """
+    Fit a Poisson GLM with a log link by iteratively reweighted least
+    squares, following statsmodels GLM.fit (same starting values, weights
+    and deviance convergence criterion).
+
+    :param X: numpy.ndarray, design matrix (trials x parameters)
+    :param y: numpy.ndarray, counts
+    :param start: numpy.ndarray, optional starting coefficients
+    :return: coefficients, standard errors, deviance and AIC
+    """
+
+    if start is None:
+        mu = (y + np.mean(y))/2
+        eta = np.log(mu)
+    else:
+        eta = np.matmul(X, start)
+        mu = np.exp(eta)
+    dev = _poisson_deviance(y, mu)
+    for _ in range(maxiter):
+        # weighted least squares on the working response
+        w_sqrt = np.sqrt(mu)
+        wX_pinv = np.linalg.pinv(X*w_sqrt[:, None])
+        params = np.matmul(wX_pinv, (eta + (y - mu)/mu)*w_sqrt)
+        eta = np.matmul(X, params)
+        mu = np.exp(eta)
+        dev, last_dev = _poisson_deviance(y, mu), dev
+        if np.abs(dev - last_dev) <= tol:
+            break
+    bse = np.sqrt(np.diag(np.matmul(wX_pinv, wX_pinv.T)))
+    llf = np.sum(special.xlogy(y, mu) - mu - special.gammaln(y + 1))
+    aic = -2*llf + 2*np.linalg.matrix_rank(X)
+
+    return params, bse, dev, aic
+
+
+def _coef_table(params, bse, names):
+    """Coefficient table matching statsmodels summary2().tables[1]."""
+
+    z = params/bse
+    crit = stats.norm.ppf(0.975)
+    return pd.DataFrame(
+        {'Coef.': params, 'Std.Err.': bse, 'z': z,
+         'P>|z|': 2*stats.norm.sf(np.abs(z)),
+         '[0.025': params - crit*bse, '0.975]': params + crit*bse},
+        index=names)
+
+
 def fit_trial_factors(
         mouse='OA27',
         trace_type='zscore_day',
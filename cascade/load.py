@@ -7,8 +7,10 @@ import pandas as pd
 import os
 from . import utils
 from . import paths
-from .tca import _trialmetafromrun, _group_ids_score
-from .tca import _group_drive_ids, _get_speed_pupil_npil_traces
+from . import store
+from . import cache
+from .tca import _trialmetafromrun, _group_day_id_filters
+from .tca import _get_speed_pupil_npil_traces, _scatter_group_tensor
 from .tca import _remove_stimulus_corr, _three_point_temporal_trace
 
 
@@ -291,59 +293,19 @@ def groupday_tensor(
             days = [d for c, d in enumerate(days) if dprime[c]
                     <= dprime_threshold]
 
+    # select cells and sort ids for each day, cross-day ids are only
+    # calculated once for the full group of days
+    day_filters, score_tag = _group_day_id_filters(
+        days, driven=driven, drive_css=drive_css,
+        drive_threshold=drive_threshold, drive_type='visual',
+        score_threshold=score_threshold, verbose=verbose)
+
     # preallocate for looping over a group of days/runs
     meta_list = []
     tensor_list = []
     bhv_list = []
     id_list = []
-    for c, day1 in enumerate(days, 0):
-
-        # get cell_ids
-        d1_ids = flow.xday._read_crossday_ids(day1.mouse, day1.date)
-        # skip empty if there is no crossday alignment file
-        if len(d1_ids) == 0:
-            continue
-        d1_ids = np.array([int(s) for s in d1_ids])
-
-        # filter cells based on visual/trial drive across all cs, prevent
-        # breaking when only pavs are shown
-        if driven:
-            good_ids = _group_drive_ids(days, drive_css, drive_threshold)
-            # filter for being able to check for quality of xday alignment
-            if score_threshold > 0:
-                orig_num_ids = len(good_ids)
-                highscore_ids = _group_ids_score(days, score_threshold)
-                good_ids = np.intersect1d(good_ids, highscore_ids)
-                if verbose and c == 0:
-                    print('Cell score threshold ' + str(score_threshold) + ':'
-                          + ' ' + str(len(highscore_ids)) + ' above threshold:'
-                          + ' good_ids updated to ' + str(len(good_ids)) + '/'
-                          + str(orig_num_ids) + ' cells.')
-                # update saving tag
-                score_tag = '_score0pt' + str(int(score_threshold * 10))
-            else:
-                score_tag = ''
-            d1_ids_bool = np.isin(d1_ids, good_ids)
-            d1_sorter = np.argsort(d1_ids[d1_ids_bool])
-        else:
-            good_ids = d1_ids
-            # filter for being able to check for quality of xday alignment
-            if score_threshold > 0:
-                orig_num_ids = len(good_ids)
-                highscore_ids = _group_ids_score(days, score_threshold)
-                good_ids = np.intersect1d(good_ids, highscore_ids)
-                if verbose and c == 0:
-                    print('Cell score thresh ' + str(score_threshold) + ':'
-                          + ' ' + str(len(highscore_ids)) + ' above thresh:'
-                          + ' good_ids updated to ' + str(len(good_ids)) + '/'
-                          + str(orig_num_ids) + ' cells.')
-                # update saving tag
-                score_tag = '_score0pt' + str(int(score_threshold * 10))
-            else:
-                score_tag = ''
-            d1_ids_bool = np.isin(d1_ids, good_ids)
-            d1_sorter = np.argsort(d1_ids[d1_ids_bool])
-        ids = d1_ids[d1_ids_bool][d1_sorter]
+    for day1, d1_ids_bool, d1_sorter, ids in day_filters:
 
         # get all runs for both days
         d1_runs = day1.runs(exclude_tags=['bad'], run_types='training')
@@ -421,42 +383,26 @@ def groupday_tensor(
             if len(d1_tensor_list) == 0:
                 continue
 
-            # concatenate matched cells across trials 3rd dim (aka, 2)
-            tensor = np.concatenate(d1_tensor_list, axis=2)
-
-            # concatenate matched cells across trials 3rd dim (aka, 2)
-            bhv_tensor = np.concatenate(d1_bhv_list, axis=2)
-
-            # concatenate all trial metadata in pd dataframe
+            # concatenate all trial metadata in pd dataframe, run tensors
+            # are written directly into the group tensor
             meta = pd.concat(d1_meta, axis=0)
 
             meta_list.append(meta)
-            tensor_list.append(tensor)
-            bhv_list.append(bhv_tensor)
+            tensor_list.append(d1_tensor_list)
+            bhv_list.extend(d1_bhv_list)
             id_list.append(ids)
 
-    # get total trial number across all days/runs
+    # concatenate all trial metadata across days/runs
     meta = pd.concat(meta_list, axis=0)
-    trial_num = len(meta.reset_index()['trial_idx'])
 
     # get union of ids. Use these for indexing and splicing tensors together
     id_union = np.unique(np.concatenate(id_list, axis=0))
-    cell_num = len(id_union)
 
     # build final behavior trace tensor
     group_bhv_tensor = np.concatenate(bhv_list, axis=2)
 
     # build a single large tensor leaving nans where cell is not found
-    trial_start = 0
-    trial_end = 0
-    group_tensor = np.zeros((cell_num, np.shape(tensor_list[0])[1], trial_num))
-    group_tensor[:] = np.nan
-    for i in range(len(tensor_list)):
-        trial_end += np.shape(tensor_list[i])[2]
-        for c, k in enumerate(id_list[i]):
-            celln_all_trials = tensor_list[i][c, :, :]
-            group_tensor[(id_union == k), :, trial_start:trial_end] = celln_all_trials
-        trial_start += np.shape(tensor_list[i])[2]
+    group_tensor = _scatter_group_tensor(tensor_list, id_list, id_union)
 
     # allow for cells with low number of trials to be dropped
     if nan_trial_threshold:
@@ -514,9 +460,13 @@ def load_all_groupday(
         full_output=False,
         unsorted=True,
         with_model=True,
+        mmap=False,
         verbose=False):
     """
     Load all existing data from fitting a TCA model.
+
+    Optionally (mmap=True) input and behavior tensors are returned as
+    read-only memory-mapped tensors instead of being read into memory.
     """
 
     # load TCA model
@@ -560,7 +510,8 @@ def load_all_groupday(
         word=word,
         group_by=group_by,
         nan_thresh=nan_thresh,
-        score_threshold=score_threshold)
+        score_threshold=score_threshold,
+        mmap=mmap)
 
     # load metadata
     meta = groupday_tca_meta(
@@ -584,7 +535,8 @@ def load_all_groupday(
         word=word,
         group_by=group_by,
         nan_thresh=nan_thresh,
-        score_threshold=score_threshold)
+        score_threshold=score_threshold,
+        mmap=mmap)
 
     return model, ids, tensor, meta, bhv, sorts
 
@@ -741,29 +693,27 @@ def singleday_tensor(
         return tensor, meta, ids
 
 
-def groupday_tca_ids(
+def groupday_tca_paths(
         mouse='OA27',
         trace_type='zscore_day',
-        method='mncp_hals',
         cs='',
         warp=False,
         word='tray',
         group_by='all3',
         nan_thresh=0.85,
-        score_threshold=None):
+        score_threshold=None,
+        train_test_split=0.8,
+        cv=False):
     """
-    Load existing TCA ids (absolute cell ids for all aligned cells in tensor).
-
-    Parameters
-    ----------
+    Paths of the files read by groupday_tca_ids, groupday_tca_model and
+    groupday_tca_meta, i.e., to check if a TCA has been refit.
 
     Returns
     -------
-    ids array
+    dict of str, paths of 'ids', 'decomp' and 'meta'
 
     """
 
-    mouse = mouse
     pars = {'trace_type': trace_type, 'cs': cs, 'warp': warp}
     group_pars = {'group_by': group_by}
 
@@ -777,15 +727,51 @@ def groupday_tca_ids(
     if score_threshold:
         load_tag = '_score0pt' + str(int(score_threshold * 10)) + load_tag
 
-    # load dir
+    # if train-test split was made
+    load_tag_decomp = load_tag
+    if cv:
+        load_tag_decomp = load_tag + '_cv' + str(train_test_split)
+
     load_dir = paths.tca_path(
         mouse, 'group', pars=pars, word=word, group_pars=group_pars)
-    ids_path = os.path.join(
-        load_dir, str(mouse) + '_' + str(group_by) + load_tag
-                  + '_group_ids_' + str(trace_type) + '.npy')
+    file_tag = os.path.join(load_dir, str(mouse) + '_' + str(group_by))
+
+    return {
+        'ids': file_tag + load_tag + '_group_ids_' + str(trace_type) + '.npy',
+        'decomp': file_tag + load_tag_decomp + '_group_decomp_' + str(trace_type) + '.npy',
+        'meta': file_tag + load_tag + '_df_group_meta.pkl'}
+
+
+def groupday_tca_ids(
+        mouse='OA27',
+        trace_type='zscore_day',
+        method='mncp_hals',
+        cs='',
+        warp=False,
+        word='tray',
+        group_by='all3',
+        nan_thresh=0.85,
+        score_threshold=None):
+    """
+    Load existing TCA ids (absolute cell ids for all aligned cells in tensor).
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    ids array
+
+    """
+
+    ids_path = groupday_tca_paths(
+        mouse=mouse, trace_type=trace_type, cs=cs, warp=warp, word=word,
+        group_by=group_by, nan_thresh=nan_thresh,
+        score_threshold=score_threshold)['ids']
 
     # load your data
     ids = np.load(ids_path)
+    cache.touch(mouse, ids_path)
 
     return ids
 
@@ -805,66 +791,89 @@ def groupday_tca_model(
         cv=False,
         full_output=False,
         unsorted=False,
+        ranks=None,
         verbose=False):
     """
     Load existing tensor component analysis (TCA) model and ids.
 
     Parameters
     ----------
+    ranks : int or list of int
+        Only load these ranks. Requires a per-rank factor store (see
+        store.save_factors). None loads all ranks. Must include rank
+        unless full_output or unsorted. Rebalanced and sorted factors are
+        cached next to the model the first time they are calculated, if
+        the folder is writable.
 
     Returns
     -------
 
     """
 
-    mouse = mouse
-    pars = {'trace_type': trace_type, 'cs': cs, 'warp': warp}
-    group_pars = {'group_by': group_by}
+    tca_paths = groupday_tca_paths(
+        mouse=mouse, trace_type=trace_type, cs=cs, warp=warp, word=word,
+        group_by=group_by, nan_thresh=nan_thresh,
+        score_threshold=score_threshold, train_test_split=train_test_split,
+        cv=cv)
+    tensor_path = tca_paths['decomp']
+    ids_path = tca_paths['ids']
 
-    # if cells were removed with too many nan trials
-    if nan_thresh:
-        load_tag = '_nantrial' + str(nan_thresh)
-    else:
-        load_tag = ''
+    # load your data
+    ids = np.load(ids_path)
+    cache.touch(mouse, ids_path)
+    cache.touch(mouse, tensor_path)
 
-    # update saving tag if you used a cell score threshold
-    if score_threshold:
-        load_tag = '_score0pt' + str(int(score_threshold * 10)) + load_tag
+    # default to every fit rank if a per-rank factor store exists
+    if ranks is None and store.factors_exist(tensor_path, method):
+        ranks = store.factor_ranks(tensor_path, method)
 
-    # if train-test split was made
-    load_tag_ids = load_tag
-    if cv:
-        load_tag = load_tag + '_cv' + str(train_test_split)
+    # a single rank is returned, so make sure it will be loaded
+    if not unsorted and not full_output and ranks is not None:
+        assert rank in np.atleast_1d(ranks), \
+            'rank {} is not in ranks {}, add it or use full_output.'.format(rank, ranks)
 
-    # load dir
-    load_dir = paths.tca_path(
-        mouse, 'group', pars=pars, word=word, group_pars=group_pars)
-    tensor_path = os.path.join(
-        load_dir, str(mouse) + '_' + str(group_by) + load_tag
-                  + '_group_decomp_' + str(trace_type) + '.npy')
-    ids_path = os.path.join(
-        load_dir, str(mouse) + '_' + str(group_by) + load_tag_ids
-                  + '_group_ids_' + str(trace_type) + '.npy')
+    # use cached rebalanced and sorted factors when they exist
+    if store.factors_exist(tensor_path, method, ranks=ranks, variant='sorted'):
+        if verbose:
+            print('{}: {}: Loading cached sorted factors.'.format(mouse, word))
+        V, my_sorts = store.load_factors(
+            tensor_path, method, ranks=ranks, variant='sorted')
+        ensemble = {method: V}
+        sort_ensemble = utils.apply_factor_sorts(ensemble[method], my_sorts)
 
-    # load your data
-    ensemble = np.load(tensor_path, allow_pickle=True)
-    ensemble = ensemble.item()
-    ids = np.load(ids_path)
+    else:
+        # only read the requested ranks if a per-rank factor store exists
+        if store.factors_exist(tensor_path, method, ranks=ranks):
+            V, _ = store.load_factors(tensor_path, method, ranks=ranks)
+            ensemble = {method: V}
+        else:
+            assert ranks is None, 'Loading single ranks requires a factor store.'
+            ensemble = np.load(tensor_path, allow_pickle=True)
+            ensemble = ensemble.item()
+            ensemble = {method: ensemble[method]}
 
-    # re-balance your factors ()
-    if verbose:
-        print('{}: {}: Re-balancing factors.'.format(mouse, word))
-    for r in ensemble[method].results:
-        for i in range(len(ensemble[method].results[r])):
-            ensemble[method].results[r][i].factors.rebalance()
+        # re-balance your factors ()
+        if verbose:
+            print('{}: {}: Re-balancing factors.'.format(mouse, word))
+        for r in ensemble[method].results:
+            for i in range(len(ensemble[method].results[r])):
+                ensemble[method].results[r][i].factors.rebalance()
 
-    # force cell factors to be positive at the expense of trial factors
-    if verbose:
-        print('{}: {}: Re-nonneg-ing cell factors.'.format(mouse, word))
-    ensemble = utils.correct_nonneg(ensemble)
+        # force cell factors to be positive at the expense of trial factors
+        if verbose:
+            print('{}: {}: Re-nonneg-ing cell factors.'.format(mouse, word))
+        ensemble = utils.correct_nonneg(ensemble)
+
+        # sort neuron factors by component they belong to most
+        sort_ensemble, my_sorts = utils.sortfactors(ensemble[method])
 
-    # sort neuron factors by component they belong to most
-    sort_ensemble, my_sorts = utils.sortfactors(ensemble[method])
+        # cache rebalanced factors and sort order for next time, loading
+        # still works if the model folder is read-only
+        try:
+            store.save_factors(tensor_path, ensemble, variant='sorted',
+                               sorts={method: my_sorts})
+        except OSError as err:
+            print('{}: {}: Could not cache sorted factors: {}'.format(mouse, word, err))
 
     cell_ids = {}  # keys are rank
     cell_clusters = {}
@@ -896,42 +905,79 @@ def groupday_tca_meta(
         word='tray',
         group_by='all3',
         nan_thresh=0.85,
-        score_threshold=None):
+        score_threshold=None,
+        enrich=None,
+        **enrich_pars):
     """
     Load existing tensor component analysis (TCA) metadata.
 
     Parameters
     ----------
+    enrich : list of str
+        Enrichments to add with utils.enrich_meta, i.e., ['parsed_11stage'].
+        Enriched columns are saved next to the metadata and reused on the
+        next load unless their inputs have changed.
+    enrich_pars : dict
+        Parameters passed to utils.enrich_meta, i.e., bin_scale.
 
     Returns
     -------
 
     """
 
-    mouse = mouse
-    pars = {'trace_type': trace_type, 'cs': cs, 'warp': warp}
-    group_pars = {'group_by': group_by}
-
-    # if cells were removed with too many nan trials
-    if nan_thresh:
-        load_tag = '_nantrial' + str(nan_thresh)
-    else:
-        load_tag = ''
-
-    # update saving tag if you used a cell score threshold
-    if score_threshold:
-        load_tag = '_score0pt' + str(int(score_threshold * 10)) + load_tag
-
-    # load dir
-    load_dir = paths.tca_path(
-        mouse, 'group', pars=pars, word=word, group_pars=group_pars)
-    meta_path = os.path.join(
-        load_dir, str(mouse) + '_' + str(group_by) + load_tag
-                  + '_df_group_meta.pkl')
+    meta_path = groupday_tca_paths(
+        mouse=mouse, trace_type=trace_type, cs=cs, warp=warp, word=word,
+        group_by=group_by, nan_thresh=nan_thresh,
+        score_threshold=score_threshold)['meta']
 
     # load your data
     meta = pd.read_pickle(meta_path)
+    cache.touch(mouse, meta_path)
     meta = utils.update_naive_meta(meta)
+    if enrich:
+        meta = _enriched_meta(meta, meta_path, enrich, **enrich_pars)
+
+    return meta
+
+
+def _enriched_meta(meta, meta_path, enrichments, **pars):
+    """
+    Add enrichments to trial metadata, reusing enriched columns saved from
+    an earlier load and saving any that had to be computed.
+
+    :param meta: pandas.DataFrame, trial metadata as loaded from meta_path
+    :param meta_path: str, path of saved trial metadata
+    :param enrichments: list of str, names of enrichments in
+        utils.meta_enrichments
+    :return: meta, with enriched columns
+    """
+
+    enriched_path = meta_path.replace('.pkl', '_enriched.pkl')
+
+    # copy saved columns over if they belong to the same trials, stale ones
+    # are recomputed by enrich_meta
+    record = {}
+    if os.path.isfile(enriched_path):
+        saved = pd.read_pickle(enriched_path)
+        same_trials = len(saved) == len(meta) and all(
+            [np.array_equal(saved.index.get_level_values(k),
+                            meta.index.get_level_values(k)) for k in ['date', 'run', 'trial_idx']])
+        if same_trials:
+            record = saved.attrs.get('enrichments', {})
+            for rec in record.values():
+                for col in rec['columns']:
+                    meta[col] = saved[col].values
+            meta.attrs['enrichments'] = dict(record)
+
+    # cache enriched columns for next time, loading still works if the
+    # metadata folder is read-only
+    meta = utils.enrich_meta(meta, enrichments, **pars)
+    if meta.attrs['enrichments'] != record:
+        try:
+            meta.to_pickle(enriched_path)
+        except OSError as err:
+            print('{}: Could not cache enriched metadata: {}'.format(
+                os.path.basename(meta_path), err))
 
     return meta
 
@@ -947,12 +993,17 @@ def groupday_tca_input_tensor(
         nan_thresh=0.95,
         score_threshold=0.8,
         train_test_split=0.8,
-        cv=False):
+        cv=False,
+        mmap=False):
     """
     Load existing input tensor from tensor component analysis (TCA).
 
     Parameters
     ----------
+    mmap : bool
+        Return a read-only memory-mapped tensor (numpy.memmap or
+        store.TensorStore if the tensor was saved in trial chunks) so that
+        slices only read the bytes needed.
 
     Returns
     -------
@@ -985,7 +1036,8 @@ def groupday_tca_input_tensor(
                   + '_group_tensor_' + str(trace_type) + '.npy')
 
     # load your data
-    input_tensor = np.load(input_tensor_path)
+    input_tensor = store.load_tensor(input_tensor_path, mmap=mmap)
+    cache.touch(mouse, input_tensor_path)
 
     return input_tensor
 
@@ -999,12 +1051,15 @@ def groupday_tca_bhv(
         word='determined',
         group_by='all3',
         nan_thresh=0.85,
-        score_threshold=0.8):
+        score_threshold=0.8,
+        mmap=False):
     """
     Load existing behavioral tensor from tensor component analysis (TCA).
 
     Parameters
     ----------
+    mmap : bool
+        Return a read-only memory-mapped tensor.
 
     Returns
     -------
@@ -1033,7 +1088,8 @@ def groupday_tca_bhv(
                   + '_group_bhv_' + str(trace_type) + '.npy')
 
     # load your data
-    input_tensor = np.load(input_tensor_path)
+    input_tensor = store.load_tensor(input_tensor_path, mmap=mmap)
+    cache.touch(mouse, input_tensor_path)
 
     return input_tensor
 
@@ -1048,12 +1104,15 @@ def groupday_tca_cv_test_set_tensor(
         group_by='all3',
         nan_thresh=0.95,
         train_test_split=0.8,
-        score_threshold=0.8):
+        score_threshold=0.8,
+        mmap=False):
     """
     Load existing input tensor from tensor component analysis (TCA).
 
     Parameters
     ----------
+    mmap : bool
+        Return a read-only memory-mapped tensor.
 
     Returns
     -------
@@ -1085,6 +1144,7 @@ def groupday_tca_cv_test_set_tensor(
                   + '_test_tensor_' + str(trace_type) + '.npy')
 
     # load your data
-    input_tensor = np.load(input_tensor_path)
+    input_tensor = store.load_tensor(input_tensor_path, mmap=mmap)
+    cache.touch(mouse, input_tensor_path)
 
     return input_tensor
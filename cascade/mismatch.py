@@ -1,3 +1,4 @@
+import bisect
 from copy import deepcopy
 
 import numpy as np
@@ -34,68 +35,133 @@ def match_trials(meta, target_epoch='L1 reversal1', search_epoch='L5 learning',
         matched_s --> searched trials [5 nan nan nan 1 ...]
     """
 
-    # set up trials post reversal as target
-    possible_post = meta.parsed_11stage.isin([target_epoch]).values
-    if np.sum(possible_post) == 0:
-        return [], []  # return empty if no reversal
-    speed_copy_post = deepcopy(meta[match_on].values)
-    speed_copy_post[~possible_post] = np.nan  # nan all values that you can't draw from
-    post_inds_to_check = np.where(possible_post)[0]
-    np.random.shuffle(post_inds_to_check)  # shuffle inds for for loop
-
-    # set up trials pre reversal to search over
-    possible_pre = meta.parsed_11stage.isin([search_epoch]).values
-    speed_copy_pre = deepcopy(meta[match_on].values)
-    speed_copy_pre[~possible_pre] = np.nan  # nan all values that you can't draw from
-
-    # get copies of speed vectors for each cue
-    speed_copy_plus_pre = deepcopy(speed_copy_pre)
-    speed_copy_plus_pre[~meta.initial_condition.isin(['plus'])] = np.nan
-    speed_copy_minus_pre = deepcopy(speed_copy_pre)
-    speed_copy_minus_pre[~meta.initial_condition.isin(['minus'])] = np.nan
-    speed_copy_neut_pre = deepcopy(speed_copy_pre)
-    speed_copy_neut_pre[~meta.initial_condition.isin(['neutral'])] = np.nan
-    speed_dict_pre = {'plus': speed_copy_plus_pre, 'minus': speed_copy_minus_pre, 'neutral': speed_copy_neut_pre, }
+    return match_trials_over_epochs(meta, [target_epoch], search_epoch=search_epoch, match_on=match_on,
+                                    tolerance=tolerance)[0][0]
+
+
+def match_trials_over_epochs(meta, target_epochs, search_epoch='L5 learning', match_on='speed', tolerance=1,
+                             n_shuffles=1):
+    """
+    Run match_trials for many target epochs and random target orders in one call. The search epoch is sorted
+    once per cue and each target trial takes its closest remaining search trial with a binary search, so
+    matching is O(n log n) rather than O(targets x trials). Random draws are made in the same order as calling
+    match_trials for each epoch and shuffle in turn, so results are identical under a fixed seed.
+
+    :param meta: pandas.DataFrame
+        Trial metadata.
+    :param target_epochs: list of str
+        Sets of trials to try and match, i.e., lookups.staging['parsed_11stage'].
+    :param search_epoch: str
+        Set of trials to search over.
+    :param match_on: str
+        Name of column in trial meta DataFrame to try and match on
+    :param tolerance: float or int
+        Threshold in units of [match_on]. Forces: target trial - tol < best matched trial < target trial + tol.
+    :param n_shuffles: int
+        Number of random orders of target trials to match for each epoch.
+    :return: list (one per target epoch) of lists (one per shuffle) of (s_had_match, matched_s) as returned
+        by match_trials, ([], []) for epochs with no trials.
+    """
+
+    values = meta[match_on].values.astype(float)
+    value_list, cue_list = values.tolist(), list(meta.initial_condition.values)
+
+    # sort possible search trials once per cue, stable so that ties keep trial order
+    possible_pre = meta.parsed_11stage.isin([search_epoch]).values & ~np.isnan(values)
+    search_index = {}
+    for cue in ['plus', 'minus', 'neutral']:
+        cue_inds = np.where(possible_pre & meta.initial_condition.isin([cue]).values)[0]
+        order = np.argsort(values[cue_inds], kind='stable')
+        search_index[cue] = (cue_inds[order], values[cue_inds[order]])
+
+    matches = []
+    for target_epoch in target_epochs:
+        possible_post = meta.parsed_11stage.isin([target_epoch]).values
+        if np.sum(possible_post) == 0:
+            matches.append([([], []) for _ in range(n_shuffles)])  # return empty if no reversal
+            continue
+        epoch_matches = []
+        for _ in range(n_shuffles):
+            post_inds_to_check = np.where(possible_post)[0]
+            np.random.shuffle(post_inds_to_check)  # shuffle inds for for loop
+            epoch_matches.append(_greedy_match(post_inds_to_check, value_list, cue_list, search_index,
+                                                tolerance))
+        matches.append(epoch_matches)
+
+    return matches
+
+
+def _greedy_match(post_inds_to_check, values, cues, search_index, tolerance):
+    """
+    Match target trials in order to their closest unmatched search trial of the same cue, without replacement.
+    Matched search trials are skipped with union-find pointers to the next unmatched trial on either side.
+    """
+
+    # per cue, sorted search trials as lists for fast scalar access, pointers to next unmatched sorted
+    # position to the right (sentinel n) and left (stored + 1, sentinel 0)
+    sorted_trials = {cue: (inds.tolist(), vals.tolist()) for cue, (inds, vals) in search_index.items()}
+    right = {cue: list(range(len(inds) + 1)) for cue, (inds, _) in search_index.items()}
+    left = {cue: list(range(len(inds) + 1)) for cue, (inds, _) in search_index.items()}
+
+    def _find(ptr, i):
+        while ptr[i] != i:
+            ptr[i] = ptr[ptr[i]]
+            i = ptr[i]
+        return i
 
     # preallocate
-    matched_s = np.zeros(len(meta))
-    s_had_match = np.zeros(len(meta))
+    matched_s = np.zeros(len(values))
+    s_had_match = np.zeros(len(values))
     match_counter = 1
-    for indi in post_inds_to_check:
+    for indi in post_inds_to_check.tolist():
 
         # for each index match speed and cue type
-        c_to_match = meta.initial_condition.values[indi]
-        s_to_match = meta[match_on].values[indi]
-
-        # find closest matched speed
-        difference_to_target = speed_dict_pre[c_to_match] - s_to_match
-        if all(np.isnan(difference_to_target)):
+        c_to_match = cues[indi]
+        s_to_match = values[indi]
+        search_inds, search_vals = sorted_trials[c_to_match]
+        r_ptr, l_ptr = right[c_to_match], left[c_to_match]
+        if s_to_match != s_to_match:
+            continue  # nan
+
+        # closest unmatched trials at or above and below the target
+        pos = bisect.bisect_left(search_vals, s_to_match)
+        r_pos = _find(r_ptr, pos)
+        l_pos = _find(l_ptr, pos) - 1
+        if l_pos >= 0:
+            # first unmatched trial with the same value, as np.nanargmin takes the lowest index on ties
+            l_pos = _find(r_ptr, bisect.bisect_left(search_vals, search_vals[l_pos]))
+        candidates = [p for p in [l_pos, r_pos] if 0 <= p < len(search_inds)]
+        if len(candidates) == 0:
             continue
-        closest_matched_ind = np.nanargmin(np.abs(difference_to_target))
-        closest_matched_speed = speed_dict_pre[c_to_match][closest_matched_ind]
+        closest_pos = min(candidates, key=lambda p: (abs(search_vals[p] - s_to_match), search_inds[p]))
+        closest_matched_speed = search_vals[closest_pos]
 
         # only use closest matched speed within tolerance (i.e., 1 cm/s)
         if (closest_matched_speed < s_to_match + tolerance) & (closest_matched_speed > s_to_match - tolerance):
-            matched_s[closest_matched_ind] = match_counter
+            matched_s[search_inds[closest_pos]] = match_counter
             s_had_match[indi] = match_counter
-            speed_dict_pre[c_to_match][closest_matched_ind] = np.nan  # no replacement, blank trial
+            r_ptr[closest_pos] = closest_pos + 1  # no replacement, skip trial
+            l_ptr[closest_pos + 1] = closest_pos
             match_counter += 1
 
     return s_had_match, matched_s
 
 
-def trial_match_diff_over_stages(meta, pref_tensor, search_epoch='L5 learning', min_trials=10):
+def trial_match_diff_over_stages(meta, pref_tensor, search_epoch='L5 learning', min_trials=10, summary=None):
 
     # get mean trial response matrix, cells x trials
-    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True)
+    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True,
+                                                summary=summary)
 
     # preallocate
     diff_mat = np.zeros((mean_t_tensor.shape[0], len(lookups.staging['parsed_11stage']))) + np.nan
+    # match running speeds per cue for every stage at once
+    stage_matches = match_trials_over_epochs(meta, lookups.staging['parsed_11stage'], search_epoch=search_epoch,
+                                             match_on='speed', tolerance=1)
     for si, stage in enumerate(lookups.staging['parsed_11stage']):
 
         # calculate change between two stages, matching distribution of running speeds per cue
-        s_had_match, matched_s = match_trials(meta, target_epoch=stage, search_epoch=search_epoch,
-                                              match_on='speed', tolerance=1)
+        s_had_match, matched_s = stage_matches[si][0]
 
         # if a mouse is missing a stage skip calculation
         if len(s_had_match) == 0 or len(matched_s) == 0:
@@ -121,18 +187,21 @@ def trial_match_diff_over_stages(meta, pref_tensor, search_epoch='L5 learning',
     return diff_mat
 
 
-def trial_match_frac_over_stages(meta, pref_tensor, search_epoch='L5 learning'):
+def trial_match_frac_over_stages(meta, pref_tensor, search_epoch='L5 learning', summary=None):
 
     # get mean trial response matrix, cells x trials
-    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True)
+    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True,
+                                                summary=summary)
 
     # preallocate
     diff_mat = np.zeros((mean_t_tensor.shape[0], len(lookups.staging['parsed_11stage']))) + np.nan
+    # match running speeds per cue for every stage at once
+    stage_matches = match_trials_over_epochs(meta, lookups.staging['parsed_11stage'], search_epoch=search_epoch,
+                                             match_on='speed', tolerance=1)
     for si, stage in enumerate(lookups.staging['parsed_11stage']):
 
         # calculate change between two stages, matching distribution of running speeds per cue
-        s_had_match, matched_s = match_trials(meta, target_epoch=stage, search_epoch=search_epoch,
-                                              match_on='speed', tolerance=1)
+        s_had_match, matched_s = stage_matches[si][0]
 
         # if a mouse is missing a stage skip calculation
         if len(s_had_match) == 0 or len(matched_s) == 0:
@@ -172,7 +241,7 @@ def trial_match_frac_over_stages(meta, pref_tensor, search_epoch='L5 learning'):
 
 
 def trial_match_statistical_frac_or_diff_over_stages(
-        meta, pref_tensor, search_epoch='L5 learning', min_trials=10, fractional_mm=False):
+        meta, pref_tensor, search_epoch='L5 learning', min_trials=10, fractional_mm=False, summary=None):
     """
     REVAMP
 
@@ -181,11 +250,13 @@ def trial_match_statistical_frac_or_diff_over_stages(
     :param search_epoch:
     :param min_trials:
     :param fractional_mm:
+    :param summary: utils.TensorSummary of pref_tensor, optional, reuses results between calls
     :return:
     """
 
     # get mean trial response matrix, cells x trials
-    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True)
+    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True,
+                                                summary=summary)
 
     # assume data is the usual 15.5 hz 7 sec 108 frame vector
     assert pref_tensor.shape[1] == 108
@@ -193,11 +264,13 @@ def trial_match_statistical_frac_or_diff_over_stages(
 
     # preallocate
     diff_mat = np.zeros((mean_t_tensor.shape[0], len(lookups.staging['parsed_11stage']))) + np.nan
+    # match running speeds per cue for every stage at once
+    stage_matches = match_trials_over_epochs(meta, lookups.staging['parsed_11stage'], search_epoch=search_epoch,
+                                             match_on='speed', tolerance=5)
     for si, stage in enumerate(lookups.staging['parsed_11stage']):
 
         # calculate change between two stages, matching distribution of running speeds per cue
-        s_had_match, matched_s = match_trials(meta, target_epoch=stage, search_epoch=search_epoch,
-                                              match_on='speed', tolerance=5)
+        s_had_match, matched_s = stage_matches[si][0]
         print(f'{utils.meta_mouse(meta)}: Trial matching target: {stage} n={np.sum(s_had_match > 0)} '
               f'possible trials, search {search_epoch} n={np.sum(matched_s > 0)} possible trials')
         # TODO use hmm or other binarization for running rather than a cm/s tolerance
@@ -289,29 +362,17 @@ def run_controlled_reversal_mismatch_traces(meta, pref_tensor, filter_licking=No
         post_rev = meta.reset_index()['date'].isin([post_rev_date]).values
         post_rev[np.where(post_rev)[0][100:]] = False
     elif match_trials:
-        # match_distribution of running values by matching trials
-        post_rev = meta.parsed_11stage.isin(['L1 reversal']).values
-        possible_pre = meta.parsed_11stage.isin(['L5 learning']).values
-        speed_copy = deepcopy(meta.speed.values)
-        speed_copy[~possible_pre] = np.nan  # nan all values that you can't draw from
-        running_dist_post = sorted(meta.speed.loc[post_rev].values)
-        pool_pre = np.sort(speed_copy)
-        pool_pos_pre = np.argsort(speed_copy)  # actual position in the full vector
-
-        matched_s = np.zeros(len(meta))
-        available = np.zeros(len(meta)) == 0
-        for s_to_match in running_dist_post:
-            best_match_pos = pool_pos_pre[(pool_pre <= s_to_match) & available]
-            best_match_speed = pool_pre[pool_pre <= s_to_match & available]
-
-            # must be within 10% of original speed
-            if (len(best_match_pos) > 0) & (best_match_speed < s_to_match * 1.1) & (
-                    best_match_speed > s_to_match * 0.9):
-                matched_s[best_match_pos] = 1
-                available[pool_pos_pre == best_match_pos] = False  # set used position to unavailable
-            else:
-                print(f'Unmatched trial speed: {s_to_match} cm/s, best match {best_match_speed} cm/s')
-        pre_rev = matched_s == 1
+        # match running speed per cue of post reversal trials to late learning trials, without replacement
+        # (the match_trials argument shadows the function, so call the epoch matcher)
+        s_had_match, matched_s = match_trials_over_epochs(
+            meta, ['L1 reversal1'], search_epoch='L5 learning', match_on='speed', tolerance=1)[0][0]
+        if len(s_had_match) == 0:
+            out = np.zeros(pref_tensor.shape[0])
+            out[:] = np.nan
+            print(f'Mouse {mouse} did not have any reversal.')
+            return out
+        pre_rev = matched_s > 0
+        post_rev = s_had_match > 0
     else:
         learning_vec = meta.reset_index()['learning_state'].isin(['learning']).values
         rev_date = meta.reset_index().loc[learning_vec, 'date'].iloc[-1]
@@ -380,7 +441,7 @@ def run_controlled_reversal_mismatch(meta, pref_tensor, filter_licking=None, fil
                                      filter_hmm_engaged=True, force_same_day_reversal=False,
                                      match_trials=True,
                                      use_stages_for_reversal=False, skew_stages_for_reversal=False,
-                                     boot=False):
+                                     boot=False, summary=None):
     """
     Calculate a mismatch binning running and calculating between matched bins, then averaging across bins
 
@@ -390,6 +451,7 @@ def run_controlled_reversal_mismatch(meta, pref_tensor, filter_licking=None, fil
     :param filter_licking:
     :param filter_hmm_engaged:
     :param force_same_day_reversal:
+    :param summary: utils.TensorSummary of pref_tensor, optional, reuses results between calls
     :return:
     reversal_mismatch
     """
@@ -397,7 +459,8 @@ def run_controlled_reversal_mismatch(meta, pref_tensor, filter_licking=None, fil
     # get mouse from metadata
     mouse = meta.reset_index()['mouse'].unique()[0]
 
-    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True)
+    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True,
+                                                summary=summary)
 
     # get day of reversal
     if force_same_day_reversal:
@@ -428,56 +491,12 @@ def run_controlled_reversal_mismatch(meta, pref_tensor, filter_licking=None, fil
         post_rev[np.where(post_rev)[0][100:]] = False
         # TODO limit pre rev to the first 1000 trials
     elif match_trials:
-        # set up trials post reversal as target
-        possible_post = meta.parsed_11stage.isin(['L1 reversal1']).values
-        if np.sum(possible_post) == 0:
+        # match running speed per cue of post reversal trials to late learning trials, without replacement
+        # (the match_trials argument shadows the function, so call the epoch matcher)
+        s_had_match, matched_s = match_trials_over_epochs(
+            meta, ['L1 reversal1'], search_epoch='L5 learning', match_on='speed', tolerance=1)[0][0]
+        if len(s_had_match) == 0:
             return np.zeros(mean_t_tensor.shape[0]) + np.nan  # return np.nan vec if no reversal
-        speed_copy_post = deepcopy(meta.speed.values)
-        speed_copy_post[~possible_post] = np.nan  # nan all values that you can't draw from
-        post_inds_to_check = np.where(possible_post)[0]
-        np.random.shuffle(post_inds_to_check)  # shuffle inds for for loop
-
-        # set up trials pre reversal to search over
-        possible_pre = meta.parsed_11stage.isin(['L5 learning']).values
-        speed_copy_pre = deepcopy(meta.speed.values)
-        speed_copy_pre[~possible_pre] = np.nan  # nan all values that you can't draw from
-
-        # get copies of speed vectors for each cue
-        speed_copy_plus_pre = deepcopy(speed_copy_pre)
-        speed_copy_plus_pre[~meta.initial_condition.isin(['plus'])] = np.nan
-        speed_copy_minus_pre = deepcopy(speed_copy_pre)
-        speed_copy_minus_pre[~meta.initial_condition.isin(['minus'])] = np.nan
-        speed_copy_neut_pre = deepcopy(speed_copy_pre)
-        speed_copy_neut_pre[~meta.initial_condition.isin(['neutral'])] = np.nan
-        speed_dict_pre = {'plus': speed_copy_plus_pre, 'minus': speed_copy_minus_pre, 'neutral': speed_copy_neut_pre, }
-
-        # preallocate
-        matched_s = np.zeros(len(meta))
-        s_had_match = np.zeros(len(meta))
-        match_counter = 1
-        for indi in post_inds_to_check:
-
-            # for each index match speed and cue type
-            c_to_match = meta.initial_condition.values[indi]
-            s_to_match = meta.speed.values[indi]
-
-            # find closest matched speed
-            difference_to_target = speed_dict_pre[c_to_match] - s_to_match
-            if all(np.isnan(difference_to_target)):
-                continue
-            closest_matched_ind = np.nanargmin(np.abs(difference_to_target))
-            closest_matched_speed = speed_dict_pre[c_to_match][closest_matched_ind]
-
-            # only use closest matched speed within 1 cm/s
-            if (closest_matched_speed < s_to_match + 1) & (closest_matched_speed > s_to_match - 1):
-                # TODO could make this a counter so trials are matched so you could match cell by cell for trial count 
-                matched_s[closest_matched_ind] = match_counter
-                s_had_match[indi] = match_counter
-                speed_dict_pre[c_to_match][closest_matched_ind] = np.nan  # no replacement, blank trial
-                match_counter += 1
-            # else:
-            #     print(f'Unmatched trial speed: {s_to_match} cm/s, best match {closest_matched_speed} cm/s')
-
         pre_rev = matched_s > 0
         post_rev = s_had_match > 0
     else:
@@ -581,7 +600,7 @@ def run_controlled_reversal_mismatch(meta, pref_tensor, filter_licking=None, fil
 
 
 def run_controlled_naive_mismatch(meta, pref_tensor, filter_licking=None, filter_running=None,
-                                  filter_hmm_engaged=False, boot=True, account_for_offset=True):
+                                  filter_hmm_engaged=False, boot=True, account_for_offset=True, summary=None):
     """
     Calculate a mismatch binning running and calculating between matched bins, then averaging across bins. Look at the
     period surround initial learning onset and reversal.
@@ -592,6 +611,7 @@ def run_controlled_naive_mismatch(meta, pref_tensor, filter_licking=None, filter
     :param filter_licking:
     :param filter_hmm_engaged:
     :param force_same_day_reversal:
+    :param summary: utils.TensorSummary of pref_tensor, optional, reuses results between calls
     :return:
     reversal_mismatch
     """
@@ -601,7 +621,7 @@ def run_controlled_naive_mismatch(meta, pref_tensor, filter_licking=None, filter
 
     # get mean response per cue
     mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False,
-                                                account_for_offset=account_for_offset)
+                                                account_for_offset=account_for_offset, summary=summary)
 
     # 1000 trials pre, 100 trials post reversal
     pre_rev = meta.parsed_11stage.isin(['L5 learning']).values
@@ -745,7 +765,7 @@ def run_controlled_naive_mismatch(meta, pref_tensor, filter_licking=None, filter
 def calculate_reversal_mismatch(meta, pref_tensor, filter_running=None, filter_licking=None,
                                 filter_hmm_engaged=False, force_same_day_reversal=False,
                                 use_stages_for_reversal=False, skew_stages_for_reversal=False,
-                                account_for_offset=True):
+                                account_for_offset=True, summary=None):
     """
     Calculate a mismatch score (difference in zscore) for cells that we have across reversal.
 
@@ -755,6 +775,7 @@ def calculate_reversal_mismatch(meta, pref_tensor, filter_running=None, filter_l
     :param filter_licking:
     :param filter_hmm_engaged:
     :param force_same_day_reversal:
+    :param summary: utils.TensorSummary of pref_tensor, optional, reuses results between calls
     :return:
     reversal_mismatch
     """
@@ -763,7 +784,7 @@ def calculate_reversal_mismatch(meta, pref_tensor, filter_running=None, filter_l
     mouse = meta.reset_index()['mouse'].unique()[0]
 
     mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False,
-                                                account_for_offset=account_for_offset)
+                                                account_for_offset=account_for_offset, summary=summary)
 
     # get day of reversal
     if force_same_day_reversal:
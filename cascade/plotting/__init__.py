@@ -1,3 +1,21 @@
-from . import tca, xday, stitch, cluster, correlate, reconstruct, var, pillow, plot_utils
-from . import trialhistory, adaptation
-from . import behavior, mismatch
+"""Plotting modules are imported lazily on first attribute access,
+i.e., cascade.plotting.tca, see cascade/__init__.py."""
+import importlib
+
+_modules = ('tca', 'xday', 'stitch', 'cluster', 'correlate', 'reconstruct',
+            'var', 'pillow', 'plot_utils', 'trialhistory', 'adaptation',
+            'behavior', 'mismatch')
+
+__all__ = list(_modules)
+
+
+def __getattr__(name):
+    if name in __all__:
+        module = importlib.import_module('.' + name, __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
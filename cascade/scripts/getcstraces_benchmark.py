@@ -0,0 +1,129 @@
+""" Micro-benchmark of the batched preprocessing kernels in utils.getcstraces
+against the per-trial and per-cell loops they replaced.
+
+Run from a shell:
+    python cascade/scripts/getcstraces_benchmark.py
+Synthetic data are used so no Trace2P files are needed. Each step checks that
+both paths give numerically equivalent output before timing them.
+
+Artifact dilation uses shifted ors of the whole array in place of per-row
+np.convolve. Smoothing only filters the whole array with scipy.ndimage for
+windows where that is faster (deconvolved data), session traces are still
+smoothed one row at a time, so expect those steps to be near 1x.
+"""
+import timeit
+import warnings
+import numpy as np
+from cascade import utils
+
+# parameters
+ncells = 400
+nframes = 60000  # full session at 31 Hz
+ntimes = 216  # triggered trial length at 31 Hz
+ntrials = 300
+smooth_win = 6
+smooth_win_dec = 12
+repeats = 3
+
+rs = np.random.RandomState(42)
+session = rs.randn(ncells, nframes)
+session[rs.rand(ncells, nframes) < 0.0005] = np.nan
+trials = rs.rand(ncells, ntimes, ntrials) * 3
+trials[rs.rand(ncells, ntimes, ntrials) < 0.001] = np.nan
+
+
+# ------------------ loops from the previous getcstraces ------------------
+def loop_smooth(traces, win):
+    kernel = np.ones(win, dtype=np.float64) / win
+    smoothed = np.empty(np.shape(traces), dtype=np.float64)
+    for cell in range(np.shape(traces)[0]):
+        smoothed[cell, :] = np.convolve(traces[cell, :], kernel, 'same')
+    return smoothed
+
+
+def loop_dilate(traces, thresh=2.5):
+    nanpad = np.zeros(np.shape(traces))
+    nanpad[np.abs(traces) > thresh] = 1
+    for cell in range(np.shape(traces)[0]):
+        nanpad[cell, :] = np.convolve(nanpad[cell, :], np.ones(3), mode='same')
+    return nanpad != 0
+
+
+def loop_bin(run_traces, factor, func):
+    sz = np.shape(run_traces)
+    ds_traces = np.zeros((sz[0], int(sz[1] / factor), sz[2]))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for trial in range(sz[2]):
+                a = run_traces[:, :, trial].reshape(sz[0], int(sz[1] / factor), factor)
+                ds_traces[:, :, trial] = func(a, axis=2)
+    return ds_traces
+
+
+def loop_cap(run_traces):
+    run_traces = run_traces.copy()
+    run_traces[run_traces > 2] = 2
+    trial_mins = run_traces.min(axis=1)
+    for rt_cells in range(trial_mins.shape[0]):
+        for rt_trials in range(trial_mins.shape[1]):
+            if trial_mins[rt_cells, rt_trials] == 2:
+                run_traces[rt_cells, :, rt_trials] = np.nan
+    return run_traces
+
+
+# ------------------------- batched replacements --------------------------
+def batch_dilate(traces, thresh=2.5):
+    with np.errstate(invalid='ignore'):
+        crossings = np.abs(traces) > thresh
+    return utils._dilate_frames(crossings)
+
+
+def batch_cap(run_traces):
+    run_traces = run_traces.copy()
+    run_traces[run_traces > 2] = 2
+    trial_mins = run_traces.min(axis=1)
+    run_traces[np.broadcast_to((trial_mins == 2)[:, None, :], run_traces.shape)] = np.nan
+    return run_traces
+
+
+dec = trials.reshape(ncells, ntimes * ntrials)
+session_finite = np.nan_to_num(session)
+capped = np.where(rs.rand(ncells, 1, ntrials) < 0.1, 5, trials)
+steps = [
+    ('downsample mean',
+     lambda: loop_bin(trials, 2, np.nanmean),
+     lambda: utils._bin_frames(trials, 2, np.nanmean)),
+    ('downsample max',
+     lambda: loop_bin(trials, 2, np.nanmax),
+     lambda: utils._bin_frames(trials, 2, np.nanmax)),
+    ('bin deconvolved',
+     lambda: loop_bin(trials, 4, np.nansum),
+     lambda: utils._bin_frames(trials, 4, np.nansum)),
+    ('cap',
+     lambda: loop_cap(capped),
+     lambda: batch_cap(capped)),
+    ('smooth session',
+     lambda: loop_smooth(session, smooth_win),
+     lambda: utils._boxcar_smooth(session, smooth_win)),
+    ('smooth session, no nans',
+     lambda: loop_smooth(session_finite, smooth_win),
+     lambda: utils._boxcar_smooth(session_finite, smooth_win)),
+    ('smooth session, 15 Hz',
+     lambda: loop_smooth(session, int(smooth_win / 2)),
+     lambda: utils._boxcar_smooth(session, int(smooth_win / 2))),
+    ('smooth deconv',
+     lambda: loop_smooth(dec, smooth_win_dec),
+     lambda: utils._boxcar_smooth(dec, smooth_win_dec)),
+    ('dilate',
+     lambda: loop_dilate(session),
+     lambda: batch_dilate(session)),
+]
+
+print('{:<26} {:>10} {:>10} {:>8}'.format('step', 'loop (s)', 'batch (s)', 'speedup'))
+for name, loop_func, batch_func in steps:
+    assert np.allclose(loop_func(), batch_func(), equal_nan=True, rtol=0, atol=1e-12), name
+    t_loop = min(timeit.repeat(loop_func, number=1, repeat=repeats))
+    t_batch = min(timeit.repeat(batch_func, number=1, repeat=repeats))
+    print('{:<26} {:>10.4f} {:>10.4f} {:>7.1f}x'.format(
+        name, t_loop, t_batch, t_loop / t_batch))
@@ -0,0 +1,48 @@
+""" Time a cold `import cascade` and check that heavy backends stay unloaded.
+
+Run from a shell so CI or a batch job can fail on regressions:
+    python cascade/scripts/import_benchmark.py
+Each repeat runs in a fresh interpreter so nothing is cached in sys.modules.
+"""
+import sys
+import json
+import subprocess
+import numpy as np
+
+# parameters
+repeats = 5
+max_seconds = 1.0  # median cold `import cascade` must stay under this
+heavy = ['tensorflow', 'matplotlib', 'seaborn', 'statsmodels']
+# statements that must not load heavy modules, i.e., batch jobs that only load
+statements = ['import cascade', 'import cascade.load']
+
+failed = False
+for statement in statements:
+    probe = (
+        'import time, sys, json; t0 = time.perf_counter(); %s; '
+        'dt = time.perf_counter() - t0; '
+        'print(json.dumps({"seconds": dt, '
+        '"loaded": [m for m in %r if m in sys.modules]}))' % (statement, heavy))
+
+    times = []
+    loaded = set()
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', probe], check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        times.append(result['seconds'])
+        loaded.update(result['loaded'])
+
+    print('{}: median {:.3f}s, min {:.3f}s, max {:.3f}s over {} cold runs'.format(
+        statement, np.median(times), np.min(times), np.max(times), repeats))
+
+    if statement == 'import cascade' and np.median(times) > max_seconds:
+        print('FAIL: median import time above {:.1f}s'.format(max_seconds))
+        failed = True
+    if len(loaded) > 0:
+        print('FAIL: heavy modules loaded by {}: {}'.format(statement, sorted(loaded)))
+        failed = True
+
+if not failed:
+    print('OK')
+sys.exit(1 if failed else 0)
@@ -19,11 +19,12 @@ from . import utils, lookups
 
 
 def trial_history_sensory(meta, pref_tensor, epoch='parsed_11stage', filter_running=None, filter_licking=None,
-                          filter_hmm_engaged=True):
+                          filter_hmm_engaged=True, summary=None):
     # get mouse from metadata
     mouse = meta.reset_index()['mouse'].unique()[0]
 
-    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True)
+    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True,
+                                                summary=summary)
 
     # get vector saying if previous stimulus was the same or different
     # flipped_stim_order = meta.initial_condition.values[::-1]
@@ -114,12 +115,13 @@ def trial_history_sensory(meta, pref_tensor, epoch='parsed_11stage', filter_runn
 
 
 def lick_modulation(meta, pref_tensor, epoch='parsed_11stage', filter_running=None, filter_licking=None,
-                    filter_hmm_engaged=True):
+                    filter_hmm_engaged=True, summary=None):
     # get mouse from metadata
     mouse = meta.reset_index()['mouse'].unique()[0]
 
     # get mean response per trial accounting for offset
-    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True)
+    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True,
+                                                summary=summary)
 
     # get previous same accounting for dropped pavlovians
     prev_same = meta.pre_licks.gt(1).values
@@ -201,12 +203,13 @@ def lick_modulation(meta, pref_tensor, epoch='parsed_11stage', filter_running=No
 
 
 def run_modulation(meta, pref_tensor, epoch='parsed_11stage', filter_running=None, filter_licking=None,
-                   filter_hmm_engaged=True):
+                   filter_hmm_engaged=True, summary=None):
     # get mouse from metadata
     mouse = meta.reset_index()['mouse'].unique()[0]
 
     # get mean response per trial accounting for offset
-    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True)
+    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True,
+                                                summary=summary)
 
     # get previous same accounting for dropped pavlovians
     prev_same = meta.pre_speed.gt(4).values
@@ -287,11 +290,12 @@ def run_modulation(meta, pref_tensor, epoch='parsed_11stage', filter_running=Non
 
 
 def trial_history_sensory_blank(meta, pref_tensor, epoch='parsed_11stage', filter_running=None, filter_licking=None,
-                                filter_hmm_engaged=True):
+                                filter_hmm_engaged=True, summary=None):
     # get mouse from metadata
     mouse = meta.reset_index()['mouse'].unique()[0]
 
-    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True)
+    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True,
+                                                summary=summary)
 
     # get vector of previous blanks
     prev_same = meta.prev_blank.values
@@ -365,11 +369,12 @@ def trial_history_sensory_blank(meta, pref_tensor, epoch='parsed_11stage', filte
 
 
 def trial_history_reward(meta, pref_tensor, epoch='parsed_11stage', filter_running=None, filter_licking=None,
-                         filter_hmm_engaged=True):
+                         filter_hmm_engaged=True, summary=None):
     # get mouse from metadata
     mouse = meta.reset_index()['mouse'].unique()[0]
 
-    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True)
+    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True,
+                                                summary=summary)
 
     # get vector saying if previous stimulus was the same or different
     # flipped_stim_order = meta.initial_condition.values[::-1]
@@ -459,11 +464,12 @@ def trial_history_reward(meta, pref_tensor, epoch='parsed_11stage', filter_runni
 
 
 def trial_history_punishment(meta, pref_tensor, epoch='parsed_11stage', filter_running=None, filter_licking=None,
-                             filter_hmm_engaged=True):
+                             filter_hmm_engaged=True, summary=None):
     # get mouse from metadata
     mouse = meta.reset_index()['mouse'].unique()[0]
 
-    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True)
+    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True,
+                                                summary=summary)
 
     # get vector saying if previous stimulus was the same or different
     # flipped_stim_order = meta.initial_condition.values[::-1]
@@ -553,7 +559,7 @@ def trial_history_punishment(meta, pref_tensor, epoch='parsed_11stage', filter_r
     return new_mat
 
 
-def latency_to_half_peak(meta, pref_tensor, epoch='day'):
+def latency_to_half_peak(meta, pref_tensor, epoch='day', summary=None):
     """
     Get cells peak and half peak latency relative to the onset or offset of the stimulus. Only relative to offset for
     cells that are offset responsive. Units are still in frames (i.e. 15.5 Hz frames), so conversion to seconds still
@@ -563,13 +569,14 @@ def latency_to_half_peak(meta, pref_tensor, epoch='day'):
     :param pref_tensor: numpy.ndarray
         A tensor the exact size of the tensor input, now containing nans for un-preferred stimulus presentations.
     :param epoch: str, 'day' or staging type to take averages overs
+    :param summary: utils.TensorSummary of pref_tensor, optional, reuses results between calls
     :return: peak_time, half_peak_time, numpy.ndarrays
         cells x stages/days/epochs matrices of peak latency RELATIVE TO STIMULUS ONSET OR OFFSET depending
         on type of cell.
     """
 
     # determine cells with offset responses
-    offset_bool = utils.get_offset_cells(meta, pref_tensor)
+    offset_bool = utils.get_offset_cells(meta, pref_tensor, summary=summary)
 
     # define windows for checking peak
     mouse = meta.reset_index()['mouse'].unique()[0]
@@ -619,7 +626,7 @@ def latency_to_half_peak(meta, pref_tensor, epoch='day'):
 
 
 def sustainedness95(meta, pref_tensor, epoch='day', full_trial_window=False,
-                    filter_running='low_speed_only', filter_licking=None, filter_hmm_engaged=True):
+                    filter_running='low_speed_only', filter_licking=None, filter_hmm_engaged=True, summary=None):
     """
     Get cell's sustainedness, SI = (mean response / 95th percentile response). Accounts offset or can make calc for
     onset to response window close. Benefit of this method is that it is not making any assumptions about the
@@ -636,13 +643,15 @@ def sustainedness95(meta, pref_tensor, epoch='day', full_trial_window=False,
         'day' or staging type to take averages overs
     :param full_trial_window: boolean
         Use the stimulus window + response window to calculate transientness.
+    :param summary: utils.TensorSummary
+        Optional summary of pref_tensor to reuse results between calls.
     :return: peak_time, half_peak_time, numpy.ndarrays
         cells x stages/days/epochs matrices of peak latency RELATIVE TO STIMULUS ONSET OR OFFSET depending
         on type of cell.
     """
 
     # determine cells with offset responses
-    offset_bool = utils.get_offset_cells(meta, pref_tensor)
+    offset_bool = utils.get_offset_cells(meta, pref_tensor, summary=summary)
 
     # define windows for checking peak
     mouse = meta.reset_index()['mouse'].unique()[0]
@@ -705,12 +714,13 @@ def sustainedness95(meta, pref_tensor, epoch='day', full_trial_window=False,
     return s_index
 
 
-def fano_factor_mean_days(meta, pref_tensor, min_denom=0.01):
+def fano_factor_mean_days(meta, pref_tensor, min_denom=0.01, summary=None):
     """
 
     :param meta: pandas.DataFrame, trial metadata
     :param pref_tensor: numpy.ndarray, a cells x times X trials; should contain NaNs for trials that are not a cells
     preferred stimulus.
+    :param summary: utils.TensorSummary of pref_tensor, optional, reuses results between calls
 
     :return:
     """
@@ -729,7 +739,7 @@ def fano_factor_mean_days(meta, pref_tensor, min_denom=0.01):
     response_bool = (times > lookups.stim_length[mouse] + 0.3) & (times < lookups.stim_length[mouse] + 2)
 
     # determine cells with offset responses
-    offset_bool = utils.get_offset_cells(meta, pref_tensor)
+    offset_bool = utils.get_offset_cells(meta, pref_tensor, summary=summary)
 
     # get mean across epoch
     mean_tensor = utils.simple_mean_per_day(meta, pref_tensor)
@@ -749,8 +759,9 @@ def fano_factor_mean_days(meta, pref_tensor, min_denom=0.01):
     return fano
 
 
-def fano_factor_trials(meta, pref_tensor, epoch='parsed_11stage', min_denom=0.01):
-    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True)
+def fano_factor_trials(meta, pref_tensor, epoch='parsed_11stage', min_denom=0.01, summary=None):
+    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True,
+                                                summary=summary)
 
     if epoch == 'days':
         days = meta.reset_index()['date'].unique()
@@ -969,8 +980,9 @@ def correlate_epochs_wall_control(meta, pref_tensor, epoch='parsed_11stage'):
     return corr2_avgs
 
 
-def correlation_noise(meta, pref_tensor, epoch='parsed_11stage', min_denom=0.01):
-    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True)
+def correlation_noise(meta, pref_tensor, epoch='parsed_11stage', min_denom=0.01, summary=None):
+    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True,
+                                                summary=summary)
 
     if epoch == 'days':
         days = meta.reset_index()['date'].unique()
@@ -1006,9 +1018,9 @@ def correlation_noise(meta, pref_tensor, epoch='parsed_11stage', min_denom=0.01)
 
 
 def correlate_wrunning_per_trial(meta, pref_tensor, epoch='parsed_11stage', account_for_offset=True,
-                                 running_type='speed'):
+                                 running_type='speed', summary=None):
     mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False,
-                                                account_for_offset=account_for_offset)
+                                                account_for_offset=account_for_offset, summary=summary)
 
     if epoch == 'days':
         days = meta.reset_index()['date'].unique()
@@ -1079,9 +1091,9 @@ def correlate_wrunning_per_trial(meta, pref_tensor, epoch='parsed_11stage', acco
     return new_mat
 
 
-def correlate_pre_running_per_trial(meta, pref_tensor, epoch='parsed_11stage', account_for_offset=True):
+def correlate_pre_running_per_trial(meta, pref_tensor, epoch='parsed_11stage', account_for_offset=True, summary=None):
     mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False,
-                                                account_for_offset=account_for_offset)
+                                                account_for_offset=account_for_offset, summary=summary)
 
     if epoch == 'days':
         days = meta.reset_index()['date'].unique()
@@ -1152,7 +1164,8 @@ def correlate_pre_running_per_trial(meta, pref_tensor, epoch='parsed_11stage', a
     return new_mat
 
 
-def correlate_baseline_activity(meta, tensor, epoch='parsed_11stage', corr_w='pre_speed', nan_licking=False):
+def correlate_baseline_activity(meta, tensor, epoch='parsed_11stage', corr_w='pre_speed', nan_licking=False,
+                                summary=None):
     """
     Function to correlate the baseline activity (hint, probably for a non-baselined tensor) with a variable
     from the metadata dataframe.
@@ -1167,12 +1180,14 @@ def correlate_baseline_activity(meta, tensor, epoch='parsed_11stage', corr_w='pr
         meta dataframe column to use for correlation
     :param nan_licking: boolean
         optionally nan licking
+    :param summary: utils.TensorSummary
+        Optional summary of tensor to reuse results between calls.
     :return: new_mat, numpy.ndarray
         cell x epochs/stages/days matrix of Pearson correlation coefficients.
     """
 
     # get baseline firing for all trials per cell, cells x trials is returned
-    baseline_mat = utils.tensor_mean_baselines_per_trial(meta, tensor, nan_licking=nan_licking)
+    baseline_mat = utils.tensor_mean_baselines_per_trial(meta, tensor, nan_licking=nan_licking, summary=summary)
 
     # variable for correlation msut exist in columns of meta dataframe
     assert corr_w in meta.columns
@@ -1246,8 +1261,9 @@ def correlate_baseline_activity(meta, tensor, epoch='parsed_11stage', corr_w='pr
     return new_mat
 
 
-def correlate_wlicking_per_trial(meta, pref_tensor, epoch='parsed_11stage'):
-    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True)
+def correlate_wlicking_per_trial(meta, pref_tensor, epoch='parsed_11stage', summary=None):
+    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True,
+                                                summary=summary)
 
     if epoch == 'days':
         days = meta.reset_index()['date'].unique()
@@ -1318,8 +1334,9 @@ def correlate_wlicking_per_trial(meta, pref_tensor, epoch='parsed_11stage'):
     return new_mat
 
 
-def correlate_wlickingonset_per_trial(meta, pref_tensor, epoch='parsed_11stage'):
-    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True)
+def correlate_wlickingonset_per_trial(meta, pref_tensor, epoch='parsed_11stage', summary=None):
+    mean_t_tensor = utils.tensor_mean_per_trial(meta, pref_tensor, nan_licking=False, account_for_offset=True,
+                                                summary=summary)
 
     if epoch == 'days':
         days = meta.reset_index()['date'].unique()
@@ -1428,7 +1445,7 @@ def mean_stim_and_response(meta, pref_tensor, epoch='parsed_11stage', full_trial
     return stimulus_response, offset_response
 
 
-def sine_fit_stage_response(meta, pref_tensor, epoch='parsed_11stage', plot_please=False):
+def sine_fit_stage_response(meta, pref_tensor, epoch='parsed_11stage', plot_please=False, summary=None):
     """
     Fit a sinusoidal function to the sustained persiod of a stimulus driven cell's response.
 
@@ -1440,11 +1457,13 @@ def sine_fit_stage_response(meta, pref_tensor, epoch='parsed_11stage', plot_plea
         'day' or staging type to take averages overs
     :param full_trial_window: boolean
         Use the stimulus window + response window to calculate transientness.
+    :param summary: utils.TensorSummary
+        Optional summary of pref_tensor to reuse results between calls.
     :return: 
     """
 
     # determine cells with offset responses
-    offset_bool = utils.get_offset_cells(meta, pref_tensor)
+    offset_bool = utils.get_offset_cells(meta, pref_tensor, summary=summary)
 
     # get mean across epoch
     if epoch == 'day':
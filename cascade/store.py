@@ -0,0 +1,528 @@
+"""Functions for memory-mapped, trial-chunked storage of large tensors and
+per-rank storage of TCA factors, fit statistics, and fit checkpoints."""
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+
+def chunk_dir(path):
+    """
+    Directory that holds the trial chunks for a tensor saved at path.
+
+    :param path: str, path to the .npy file of a tensor
+    :return: str, path of chunk directory
+    """
+
+    return os.path.splitext(path)[0] + '_chunks'
+
+
+def tensor_exists(path):
+    """
+    Check if a tensor has been saved at path either as a single .npy
+    file or as a directory of trial chunks.
+
+    :param path: str, path to the .npy file of a tensor
+    :return: boolean
+    """
+
+    return os.path.exists(path) or os.path.isfile(
+        os.path.join(chunk_dir(path), 'index.json'))
+
+
+def save_tensor(path, tensor, dtype=None, chunk_trials=None):
+    """
+    Save a tensor (cells x times x trials, or any array with trials as the
+    last axis). Optionally cast it to a smaller dtype (i.e., float32) and
+    split it into chunks along the trial axis so that reading a subset of
+    trials only touches the chunks that contain them.
+
+    Only one format is kept on disk for a path, saving in one format removes
+    the other.
+
+    :param path: str, path to the .npy file of a tensor
+    :param tensor: numpy.ndarray
+    :param dtype: numpy.dtype or str, optionally cast tensor before saving
+    :param chunk_trials: int, number of trials per chunk. None saves a single
+        .npy file exactly like np.save.
+    :return: str, path of saved file or chunk directory
+    """
+
+    if dtype is not None:
+        tensor = np.asarray(tensor, dtype=dtype)
+
+    # single file, remove stale chunks
+    if not chunk_trials:
+        if os.path.isdir(chunk_dir(path)):
+            shutil.rmtree(chunk_dir(path))
+        np.save(path, tensor)
+        return path
+
+    # chunked, remove stale single file
+    if os.path.exists(path):
+        os.remove(path)
+    save_dir = chunk_dir(path)
+    if os.path.isdir(save_dir):
+        shutil.rmtree(save_dir)
+    os.mkdir(save_dir)
+
+    # save each chunk of trials as its own contiguous array
+    ntrials = tensor.shape[-1]
+    bounds = list(range(0, ntrials, chunk_trials)) + [ntrials]
+    files = []
+    for c, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        file_name = 'chunk_{:04d}.npy'.format(c)
+        np.save(os.path.join(save_dir, file_name),
+                np.ascontiguousarray(tensor[..., start:end]))
+        files.append(file_name)
+
+    # save index last so that partially written stores are never opened
+    index = {'shape': list(tensor.shape), 'dtype': str(tensor.dtype),
+             'bounds': bounds, 'files': files}
+    with open(os.path.join(save_dir, 'index.json'), 'w') as file:
+        file.write(json.dumps(index))
+
+    return save_dir
+
+
+def load_tensor(path, mmap=False):
+    """
+    Load a tensor saved with save_tensor (or np.save).
+
+    :param path: str, path to the .npy file of a tensor
+    :param mmap: boolean, return a memory-mapped, read-only view of the tensor.
+        Chunked tensors are returned as a TensorStore, single files as a
+        numpy.memmap. If False the full tensor is read into memory.
+    :return: numpy.ndarray, numpy.memmap, or TensorStore
+    """
+
+    if os.path.isfile(os.path.join(chunk_dir(path), 'index.json')):
+        tensor = TensorStore(path)
+        return tensor if mmap else tensor.to_array()
+
+    if mmap:
+        return np.load(path, mmap_mode='r')
+    return np.load(path)
+
+
+def take_trials(tensor, meta, dates=None, stages=None,
+                staging='parsed_11stage', cells=None):
+    """
+    Index a tensor by day, stage, and/or cell using trial metadata. Works for
+    in memory tensors, memory-mapped tensors, and TensorStores. For the latter
+    two only the bytes for the requested trials are read.
+
+    :param tensor: numpy.ndarray, numpy.memmap or TensorStore, cells x times x trials
+    :param meta: pandas.DataFrame, trial metadata, same length as trial axis
+    :param dates: int or list of int, dates to keep
+    :param stages: str or list of str, stages to keep, must exist in meta[staging]
+    :param staging: str, column of meta defining stages
+    :param cells: boolean or int array, cells to keep
+    :return: numpy.ndarray, cells x times x selected trials
+    """
+
+    trial_bool = np.ones(len(meta), dtype=bool)
+    if dates is not None:
+        trial_bool &= meta.reset_index()['date'].isin(np.atleast_1d(dates)).values
+    if stages is not None:
+        assert staging in meta.columns
+        trial_bool &= meta[staging].isin(np.atleast_1d(stages)).values
+    trial_inds = np.flatnonzero(trial_bool)
+
+    if cells is None:
+        cells = slice(None)
+    if isinstance(tensor, TensorStore):
+        return tensor[cells, :, trial_inds]
+    if isinstance(cells, slice):
+        return np.asarray(tensor[cells, :, trial_inds])
+    cell_inds = np.arange(tensor.shape[0])[cells]
+    time_inds = np.arange(tensor.shape[1])
+    return np.asarray(tensor[np.ix_(cell_inds, time_inds, trial_inds)])
+
+
+class TensorStore(object):
+    """
+    Read-only, memory-mapped view of a tensor saved in trial chunks by
+    save_tensor. Behaves like a numpy array for indexing, but only loads the
+    chunks that contain the requested trials.
+
+    Note: the trial (last) axis is indexed independently of the other axes,
+    i.e., store[cell_bool, :, trial_inds] returns all selected trials for all
+    selected cells, like np.ix_.
+    """
+
+    def __init__(self, path):
+        self.path = path if os.path.isdir(path) else chunk_dir(path)
+        with open(os.path.join(self.path, 'index.json'), 'r') as file:
+            index = json.load(file)
+        self.shape = tuple(index['shape'])
+        self.dtype = np.dtype(index['dtype'])
+        self.bounds = np.array(index['bounds'])
+        self.files = index['files']
+        self._chunks = [None] * len(self.files)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return 'TensorStore(shape={}, dtype={}, chunks={})'.format(
+            self.shape, self.dtype, len(self.files))
+
+    def __array__(self, dtype=None, copy=None):
+        tensor = self.to_array()
+        return tensor if dtype is None else tensor.astype(dtype)
+
+    def _chunk(self, c):
+        """Lazily memory-map a single chunk."""
+        if self._chunks[c] is None:
+            self._chunks[c] = np.load(
+                os.path.join(self.path, self.files[c]), mmap_mode='r')
+        return self._chunks[c]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            ell = [c for c, k in enumerate(key) if k is Ellipsis][0]
+            fill = (slice(None),) * (self.ndim - len(key) + 1)
+            key = key[:ell] + fill + key[ell + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        lead_key, trial_key = key[:-1], key[-1]
+
+        # normalize trial indexing (slice, int, bool, or int array) to ints
+        trial_inds = np.arange(self.shape[-1])[trial_key]
+        scalar_trial = np.ndim(trial_inds) == 0
+        trial_inds = np.atleast_1d(trial_inds)
+
+        # nothing selected, return an empty array of the correct shape
+        if len(trial_inds) == 0:
+            return np.empty(self.shape[:-1] + (0,), dtype=self.dtype)[lead_key]
+
+        # read consecutive trials from the same chunk together, preserving order
+        chunk_ids = np.searchsorted(self.bounds, trial_inds, side='right') - 1
+        splits = np.flatnonzero(np.diff(chunk_ids)) + 1
+        pieces = []
+        for group in np.split(np.arange(len(trial_inds)), splits):
+            c = chunk_ids[group[0]]
+            local = trial_inds[group] - self.bounds[c]
+            lo, hi = local.min(), local.max() + 1
+            piece = self._chunk(c)[lead_key + (slice(lo, hi),)]
+            pieces.append(np.asarray(piece[..., local - lo]))
+        tensor = np.concatenate(pieces, axis=-1)
+
+        if scalar_trial:
+            tensor = tensor[..., 0]
+        return tensor
+
+    def to_array(self):
+        """Read the full tensor into memory."""
+        return self[..., :]
+
+
+def factor_dir(path):
+    """
+    Directory that holds the per-rank factor files for a TCA decomposition
+    saved at path.
+
+    :param path: str, path to the .npy file of a pickled TCA ensemble
+    :return: str, path of factor directory
+    """
+
+    return os.path.splitext(path)[0] + '_factors'
+
+
+def _read_factor_index(path):
+    """Read the factor index for a decomposition, empty if none exists."""
+
+    index_path = os.path.join(factor_dir(path), 'index.json')
+    if not os.path.isfile(index_path):
+        return {}
+    with open(index_path, 'r') as file:
+        return json.load(file)
+
+
+def fit_stats(path, method, variant='fit'):
+    """
+    Objective, iteration count, fit time, and initialization of every saved
+    replicate of a decomposition, i.e., to compare warm-started and random
+    fits across a rank sweep.
+
+    :param path: str, path to the .npy file of a pickled TCA ensemble
+    :param method: str, fit method, i.e., 'ncp_hals'
+    :param variant: str, 'fit' or 'sorted'
+    :return: pandas.DataFrame, one row per rank and replicate. replicate is
+        the index after the replicates of a rank were sorted by objective
+        (best first, as in tensortools.Ensemble), not the order they were fit.
+    """
+
+    method_index = _read_factor_index(path).get(method, {}).get(variant, {})
+    rows = []
+    for r in sorted([int(s) for s in method_index.keys()]):
+        rank_index = method_index[str(r)]
+        n_reps = rank_index['replicates']
+        for i in range(n_reps):
+            rows.append({
+                'rank': r,
+                'replicate': i,
+                'init': rank_index.get('init', ['rand']*n_reps)[i],
+                'obj': rank_index['obj'][i],
+                'iterations': rank_index.get('iterations', [np.nan]*n_reps)[i],
+                'total_time': rank_index.get('total_time', [np.nan]*n_reps)[i]})
+
+    return pd.DataFrame(rows, columns=[
+        'rank', 'replicate', 'init', 'obj', 'iterations', 'total_time'])
+
+
+def factor_ranks(path, method, variant='fit'):
+    """
+    Ranks saved for a method and variant of a decomposition.
+
+    :param path: str, path to the .npy file of a pickled TCA ensemble
+    :param method: str, fit method, i.e., 'ncp_hals'
+    :param variant: str, 'fit' for raw factors, 'sorted' for rebalanced and
+        sorted factors
+    :return: list of int
+    """
+
+    index = _read_factor_index(path)
+    ranks = index.get(method, {}).get(variant, {}).keys()
+    return sorted([int(s) for s in ranks])
+
+
+def factors_exist(path, method, ranks=None, variant='fit'):
+    """
+    Check if factors have been saved for a method, variant, and set of ranks.
+
+    :param path: str, path to the .npy file of a pickled TCA ensemble
+    :param method: str, fit method, i.e., 'ncp_hals'
+    :param ranks: int or list of int, ranks that must exist. None only checks
+        that any rank exists.
+    :param variant: str, 'fit' or 'sorted'
+    :return: boolean
+    """
+
+    saved_ranks = factor_ranks(path, method, variant=variant)
+    if ranks is None:
+        return len(saved_ranks) > 0
+    return all([r in saved_ranks for r in np.atleast_1d(ranks)])
+
+
+def save_factors(path, ensemble, variant='fit', sorts=None):
+    """
+    Save the factor matrices of every rank and replicate of a TCA ensemble
+    as separate arrays, one .npz file per method and rank, with a small json
+    index of objectives and similarities. Ranks can then be loaded without
+    unpickling the whole ensemble.
+
+    :param path: str, path to the .npy file of a pickled TCA ensemble
+    :param ensemble: dict of tensortools.Ensemble, keys are fit methods
+    :param variant: str, 'fit' for raw factors, 'sorted' for rebalanced
+        factors with cell sort orders
+    :param sorts: dict of list, optional cell sort order for each method,
+        ordered like ensemble[method].results (see utils.sortfactors)
+    :return: str, path of factor directory
+    """
+
+    save_dir = factor_dir(path)
+    if not os.path.isdir(save_dir):
+        os.mkdir(save_dir)
+    index = _read_factor_index(path)
+
+    for method in ensemble:
+
+        # newly fit factors invalidate any cached sorted factors
+        if variant == 'fit':
+            stale = index.get(method, {}).pop('sorted', {})
+            for rank_index in stale.values():
+                stale_path = os.path.join(save_dir, rank_index['file'])
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+
+        method_index = index.setdefault(method, {}).setdefault(variant, {})
+        for c, r in enumerate(ensemble[method].results):
+            results = ensemble[method].results[r]
+            arrays = {}
+            for i, res in enumerate(results):
+                for n, factor in enumerate(res.factors):
+                    arrays['rep{}_mode{}'.format(i, n)] = factor
+            if sorts is not None:
+                arrays['sort'] = sorts[method][c]
+            file_name = '{}_{}_rank{}.npz'.format(method, variant, r)
+            np.savez(os.path.join(save_dir, file_name), **arrays)
+            method_index[str(r)] = {
+                'file': file_name,
+                'replicates': len(results),
+                'modes': results[0].factors.ndim if results else 0,
+                'obj': [float(getattr(res, 'obj', np.nan)) for res in results],
+                'similarity': [float(getattr(res, 'similarity', np.nan)) for res in results],
+                'iterations': [int(getattr(res, 'iterations', len(res.obj_hist)))
+                               for res in results],
+                'total_time': [np.nan if getattr(res, 'total_time', None) is None
+                               else float(res.total_time) for res in results],
+                'init': [getattr(res, 'init', 'rand') for res in results]}
+
+    # save index last so that partially written ranks are never loaded
+    with open(os.path.join(save_dir, 'index.json'), 'w') as file:
+        file.write(json.dumps(index))
+
+    return save_dir
+
+
+def load_factors(path, method, ranks=None, replicates=None, variant='fit'):
+    """
+    Load factors saved with save_factors into a tensortools.Ensemble, only
+    reading the requested ranks and replicates.
+
+    :param path: str, path to the .npy file of a pickled TCA ensemble
+    :param method: str, fit method, i.e., 'ncp_hals'
+    :param ranks: int or list of int, ranks to load. None loads all ranks.
+    :param replicates: int or list of int, replicates to load. None loads all.
+    :param variant: str, 'fit' or 'sorted'
+    :return: ensemble, tensortools.Ensemble with results for requested ranks
+             sorts, list of cell sort orders for each rank (None if not saved)
+    """
+
+    import tensortools as tt
+    from tensortools.tensors import KTensor
+
+    method_index = _read_factor_index(path).get(method, {}).get(variant, {})
+    if ranks is None:
+        ranks = sorted([int(s) for s in method_index.keys()])
+    ranks = [int(r) for r in np.atleast_1d(ranks)]
+
+    ensemble = tt.Ensemble(fit_method=method, fit_options={})
+    sorts = []
+    for r in ranks:
+        if str(r) not in method_index:
+            raise ValueError('No {} models of rank-{} have been saved for: {}'.format(
+                variant, r, path))
+        rank_index = method_index[str(r)]
+        reps = range(rank_index['replicates']) if replicates is None \
+            else np.atleast_1d(replicates)
+        rank_file = np.load(os.path.join(factor_dir(path), rank_index['file']))
+        results = []
+        for i in reps:
+            factors = [rank_file['rep{}_mode{}'.format(i, n)]
+                       for n in range(rank_index['modes'])]
+            res = tt.optimize.FitResult(KTensor(factors), method, verbose=False)
+            res.obj = rank_index['obj'][i]
+            res.similarity = rank_index['similarity'][i]
+            if 'iterations' in rank_index:
+                res.iterations = rank_index['iterations'][i]
+                res.total_time = rank_index['total_time'][i]
+                res.init = rank_index['init'][i]
+            results.append(res)
+        ensemble.results[r] = results
+        sorts.append(rank_file['sort'] if 'sort' in rank_file.files else None)
+
+    if all([s is None for s in sorts]):
+        sorts = None
+
+    return ensemble, sorts
+
+
+def checkpoint_dir(path):
+    """
+    Directory that holds single-fit checkpoints for a TCA decomposition that
+    is being fit at path.
+
+    :param path: str, path to the .npy file of a pickled TCA ensemble
+    :return: str, path of checkpoint directory
+    """
+
+    return os.path.splitext(path)[0] + '_checkpoints'
+
+
+def _checkpoint_file(path, method, rank, replicate):
+    """Path of the checkpoint for a single method, rank, and replicate."""
+
+    return os.path.join(checkpoint_dir(path), '{}_rank{}_rep{}.npz'.format(
+        method, rank, replicate))
+
+
+def save_fit_checkpoint(path, method, rank, replicate, result, fingerprint=None):
+    """
+    Save a single fit result (one method, rank, and replicate) so that an
+    interrupted fit can be resumed. The file is written to a temporary name
+    and then moved into place so a killed process never leaves a partial
+    checkpoint behind.
+
+    :param path: str, path to the .npy file of a pickled TCA ensemble
+    :param method: str, fit method, i.e., 'ncp_hals'
+    :param rank: int, rank of the model
+    :param replicate: int, replicate number
+    :param result: tensortools.optimize.FitResult
+    :param fingerprint: str, optional key of the data and options the model
+        was fit with, checked by load_fit_checkpoint
+    :return: str, path of checkpoint file
+    """
+
+    save_dir = checkpoint_dir(path)
+    os.makedirs(save_dir, exist_ok=True)
+    arrays = {'mode{}'.format(n): factor for n, factor in enumerate(result.factors)}
+    arrays['obj'] = result.obj
+    arrays['obj_hist'] = np.array(result.obj_hist)
+    arrays['iterations'] = getattr(result, 'iterations', len(result.obj_hist))
+    arrays['total_time'] = np.nan if result.total_time is None else result.total_time
+    arrays['init'] = getattr(result, 'init', 'rand')
+    if fingerprint is not None:
+        arrays['fingerprint'] = fingerprint
+    file_path = _checkpoint_file(path, method, rank, replicate)
+    tmp_path = file_path[:-4] + '_tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, file_path)
+
+    return file_path
+
+
+def load_fit_checkpoint(path, method, rank, replicate, fingerprint=None):
+    """
+    Load a single fit result saved with save_fit_checkpoint. If fingerprint
+    is given, checkpoints saved with a different (or no) fingerprint were fit
+    to other data or options and are ignored.
+
+    :param path: str, path to the .npy file of a pickled TCA ensemble
+    :param method: str, fit method, i.e., 'ncp_hals'
+    :param rank: int, rank of the model
+    :param replicate: int, replicate number
+    :param fingerprint: str, optional key the checkpoint must have been saved with
+    :return: tensortools.optimize.FitResult, None if no matching checkpoint exists
+    """
+
+    import tensortools as tt
+    from tensortools.tensors import KTensor
+
+    file_path = _checkpoint_file(path, method, rank, replicate)
+    if not os.path.isfile(file_path):
+        return None
+    checkpoint = np.load(file_path)
+    if fingerprint is not None:
+        if 'fingerprint' not in checkpoint.files \
+                or str(checkpoint['fingerprint']) != fingerprint:
+            return None
+    n_modes = len([k for k in checkpoint.files if k.startswith('mode')])
+    factors = [checkpoint['mode{}'.format(n)] for n in range(n_modes)]
+    res = tt.optimize.FitResult(KTensor(factors), method, verbose=False)
+    res.obj = float(checkpoint['obj'])
+    res.obj_hist = list(checkpoint['obj_hist'])
+    res.iterations = int(checkpoint['iterations'])
+    res.total_time = float(checkpoint['total_time'])
+    res.init = str(checkpoint['init'])
+
+    return res
+
+
+def clear_fit_checkpoints(path):
+    """
+    Remove all single-fit checkpoints for a decomposition.
+
+    :param path: str, path to the .npy file of a pickled TCA ensemble
+    """
+
+    if os.path.isdir(checkpoint_dir(path)):
+        shutil.rmtree(checkpoint_dir(path))
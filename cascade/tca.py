@@ -1,16 +1,19 @@
 """Functions for running tensor component analysis (TCA)."""
 
-import tensortools as tt
-
 import numpy as np
 import flow
 import pool
 import pandas as pd
 import os
+import zlib
+import hashlib
 from . import utils
 from . import paths
+from . import store
+from . import cache
 from . import lookups
 from copy import deepcopy
+from collections import OrderedDict
 from functools import reduce
 
 
@@ -72,6 +75,8 @@ def singleday_tca(
 
     """
 
+    import tensortools as tt
+
     # create folder structure and save dir
     if fit_options is None:
         fit_options = {'tol': 0.0001, 'max_iter': 500, 'verbose': False}
@@ -270,6 +275,8 @@ def pairday_tca(
 
     """
 
+    import tensortools as tt
+
     # create folder structure and save dir
     if fit_options is None:
         fit_options = {'tol': 0.0001, 'max_iter': 500, 'verbose': False}
@@ -499,6 +506,8 @@ def pairday_tca_2(
 
     """
 
+    import tensortools as tt
+
     # create folder structure and save dir
     if fit_options is None:
         fit_options = {'tol': 0.0001, 'max_iter': 500, 'verbose': False}
@@ -715,6 +724,8 @@ def triday_tca(
 
     """
 
+    import tensortools as tt
+
     # create folder structure and save dir
     if fit_options is None:
         fit_options = {'tol': 0.0001, 'max_iter': 500, 'verbose': False}
@@ -967,6 +978,7 @@ def groupday_tca(
         skip_modes=[],
         negative_modes=[],
         tensor_init='rand',
+        warm_start=False,
 
         # grouping params
         group_by='all2',
@@ -1006,6 +1018,16 @@ def groupday_tca(
         cv=False,
         train_test_split=0.8,
 
+        # parallel params
+        n_jobs=1,
+        seed=None,
+        resume=True,
+
+        # saving params
+        save_dtype=None,
+        chunk_trials=None,
+        cache_budget=None,
+
         # force fit/save
         force=False):
 
@@ -1034,6 +1056,44 @@ def groupday_tca(
     replicates, int
         number of initializations/iterations fitting for each rank
 
+    warm_start, bool
+        initialize the first replicate of each rank from the best fit of the
+        previous rank plus a new random component, see fit_ensemble. Other
+        replicates use tensor_init. Iteration counts and fit times for every
+        replicate are saved with the factors, see store.fit_stats.
+
+    n_jobs, int
+        number of worker processes used to extract triggered traces,
+        behavior traces, and trial metadata for each day. 1 runs serially,
+        -1 uses all cores. Days are always merged in date order. Also
+        used to fit each method, rank, and replicate in parallel.
+
+    seed, int
+        base random seed for fitting, see fit_ensemble. None is random.
+
+    resume, bool
+        resume an interrupted fit from the single-fit checkpoints saved next
+        to the decomposition. False discards old checkpoints and refits.
+
+    save_dtype, str or numpy.dtype
+        optionally cast input, behavior, and test tensors before saving,
+        i.e., 'float32'.
+
+    chunk_trials, int
+        optionally save input, behavior, and test tensors in chunks of this
+        many trials so they can be memory-mapped and sliced by trial without
+        reading the whole file. See store.save_tensor.
+
+    cache_budget, int
+        optional disk budget in bytes for all cached artifacts of this mouse.
+        Least recently used artifacts from other runs are evicted after
+        saving. See cache.evict.
+
+    Cached artifacts (meta, tensors, ids, test tensor, and model) are keyed
+    on the complete set of parameters that determine them, see cache.py. If
+    the tensors for these data parameters were already built, they are
+    reused and only the model is refit.
+
     Returns
     -------
 
@@ -1222,6 +1282,17 @@ def groupday_tca(
         pars['removed_stim_corr'] = True
     if len(negative_modes) > 0:
         pars['negative_modes'] = negative_modes,
+    # other options that change the model (but not the tensors) also name the
+    # folder when they are not the defaults, so a refit never overwrites a
+    # model fit with different options
+    if len(skip_modes) > 0:
+        pars['skip_modes'] = skip_modes
+    if tensor_init != 'rand':
+        pars['tensor_init'] = tensor_init
+    if warm_start:
+        pars['warm_start'] = True
+    if seed is not None:
+        pars['seed'] = seed
     group_pars = {'group_by': group_by, 'up_or_down': up_or_down,
                   'use_dprime': use_dprime,
                   'dprime_threshold': dprime_threshold}
@@ -1266,176 +1337,103 @@ def groupday_tca(
             days = [d for c, d in enumerate(days) if dprime[c]
                     <= dprime_threshold]
 
-    # preallocate for looping over a group of days/runs
+    # key cached artifacts on the complete set of parameters that determine
+    # them. Tensors only depend on the data parameters, so they are reused
+    # when only the model changes.
+    data_pars = {
+        'mouse': mouse, 'dates': [int(d.date) for d in days],
+        'pars': {k: v for k, v in pars.items() if k not in _fit_par_keys},
+        'group_pars': group_pars, 'nan_trial_threshold': nan_trial_threshold,
+        'score_threshold': score_threshold, 'cv': cv,
+        'train_test_split': train_test_split if cv else None,
+        'save_dtype': save_dtype}
+    fit_pars = {
+        'data': cache.artifact_key(data_pars), 'rank': rank, 'method': method,
+        'replicates': replicates, 'negative_modes': negative_modes,
+        'fit_options': {k: v for k, v in fit_options.items() if k != 'mask'},
+        'skip_modes': skip_modes, 'tensor_init': tensor_init,
+        'warm_start': warm_start, 'seed': seed}
+    data_kinds = ['meta', 'tensor', 'bhv', 'ids'] + (['test'] if cv else [])
+    cached = {k: cache.lookup(mouse, k, data_pars) for k in data_kinds}
+    if all([v is not None for v in cached.values()]) and not force:
+        cached_decomp = cache.lookup(mouse, 'decomp', fit_pars)
+        if cached_decomp is not None:
+            print('All artifacts cached, force not set. Skipping save and decomposition.\n')
+            for p in list(cached.values()) + [cached_decomp]:
+                print(f'    {p}')
+            print(' \n')
+            return
+        if not update_meta:
+            # keep cached tensors, only refit the model. Link the tensors into
+            # save_dir so loaders find them next to the new model.
+            print('Cached tensors found, force not set. Refitting model only.')
+            cache_keys = []
+            for k in data_kinds:
+                cache_keys.append(cache.register(
+                    mouse, k, data_pars, cache.link_to(cached[k], save_dir)))
+            group_tensor = np.array(store.load_tensor(cached['tensor']), dtype=np.float32)
+            output_tensor_path = os.path.join(save_dir, os.path.basename(
+                cached['tensor']).replace('_group_tensor_', '_group_decomp_'))
+            _groupday_fit(
+                group_tensor, output_tensor_path, rank=rank, method=method,
+                replicates=replicates, fit_options=fit_options,
+                skip_modes=skip_modes, negative_modes=negative_modes,
+                tensor_init=tensor_init, warm_start=warm_start, n_jobs=n_jobs,
+                seed=seed, resume=resume, force=force, data_pars=data_pars,
+                verbose=verbose)
+            cache_keys.append(cache.register(
+                mouse, 'decomp', fit_pars, output_tensor_path))
+            if cache_budget is not None:
+                cache.evict(mouse, cache_budget, keep=cache_keys)
+            if verbose:
+                print(str(mouse) + ': group_by=' + str(group_by) + ': done.')
+            return
+
+    # select cells and sort ids for each day, cross-day ids are only
+    # calculated once for the full group of days
+    day_jobs, score_tag = _group_day_id_filters(
+        days, driven=driven, drive_css=drive_css,
+        drive_threshold=drive_threshold, drive_type=drive_type,
+        score_threshold=score_threshold, verbose=verbose)
+
+    # build tensors for all correct runs and trials after filtering,
+    # optionally extracting days in parallel across worker processes
+    day_args = [
+        (day1.mouse, day1.date, d1_ids_bool, d1_sorter, cs, trace_type,
+         start_time, end_time, downsample, clean_artifacts, thresh, warp,
+         smooth, smooth_win, exclude_tags, exclude_conds, verbose)
+        for day1, d1_ids_bool, d1_sorter, _ in day_jobs]
+    day_results = utils.process_map(
+        _groupday_tensor_from_day, day_args, n_jobs=n_jobs)
+
+    # preallocate for looping over a group of days/runs, merging in date order
     meta_list = []
     tensor_list = []
     bhv_list = []
     id_list = []
-    for c, day1 in enumerate(days, 0):
+    for (day1, _, _, ids), day_result in zip(day_jobs, day_results):
 
-        # get cell_ids
-        d1_ids = flow.xday._read_crossday_ids(day1.mouse, day1.date)
-        # skip empty if there is no crossday alignment file
-        if len(d1_ids) == 0:
+        # if you did not add any runs for the day, continue
+        if day_result is None:
             continue
-        d1_ids = np.array([int(s) for s in d1_ids])
-
-        # filter cells based on visual/trial drive across all cs, prevent
-        # breaking when only pavs are shown
-        if driven:
-            good_ids = _group_drive_ids(days, drive_css, drive_threshold, drive_type=drive_type)
-            # filter for being able to check for quality of xday alignment
-            if score_threshold > 0:
-                orig_num_ids = len(good_ids)
-                highscore_ids = _group_ids_score(days, score_threshold)
-                good_ids = np.intersect1d(good_ids, highscore_ids)
-                if verbose and c == 0:
-                    print('Cell score threshold ' + str(score_threshold) + ':'
-                          + ' ' + str(len(highscore_ids)) + ' above threshold:'
-                          + ' good_ids updated to ' + str(len(good_ids)) + '/'
-                          + str(orig_num_ids) + ' cells.')
-                # update saving tag
-                score_tag = '_score0pt' + str(int(score_threshold*10))
-            else:
-                score_tag = ''
-            d1_ids_bool = np.isin(d1_ids, good_ids)
-            d1_sorter = np.argsort(d1_ids[d1_ids_bool])
-        else:
-            good_ids = d1_ids
-            # filter for being able to check for quality of xday alignment
-            if score_threshold > 0:
-                orig_num_ids = len(good_ids)
-                highscore_ids = _group_ids_score(days, score_threshold)
-                good_ids = np.intersect1d(good_ids, highscore_ids)
-                if verbose and c == 0:
-                    print('Cell score thresh ' + str(score_threshold) + ':'
-                          + ' ' + str(len(highscore_ids)) + ' above thresh:'
-                          + ' good_ids updated to ' + str(len(good_ids)) + '/'
-                          + str(orig_num_ids) + ' cells.')
-                # update saving tag
-                score_tag = '_score0pt' + str(int(score_threshold*10))
-            else:
-                score_tag = ''
-            d1_ids_bool = np.isin(d1_ids, good_ids)
-            d1_sorter = np.argsort(d1_ids[d1_ids_bool])
-        ids = d1_ids[d1_ids_bool][d1_sorter]
-
-        # get all runs for both days
-        d1_runs = day1.runs(exclude_tags=['bad'], run_types='training')
+        day_tensors, day_bhv_tensors, meta = day_result
 
-        # filter for only runs without certain tags
-        d1_runs = [run for run in d1_runs if not
-                   any(np.isin(run.tags, exclude_tags))]
+        meta_list.append(meta)
+        tensor_list.append(day_tensors)
+        bhv_list.extend(day_bhv_tensors)
+        id_list.append(ids)
 
-        # build tensors for all correct runs and trials after filtering
-        if d1_runs:
-            d1_tensor_list = []
-            d1_bhv_list = []
-            d1_meta = []
-            for run in d1_runs:
-                t2p = run.trace2p()
-                # trigger all trials around stimulus onsets
-                run_traces = utils.getcstraces(
-                    run, cs=cs, trace_type=trace_type,
-                    start_time=start_time, end_time=end_time,
-                    downsample=downsample, clean_artifacts=clean_artifacts,
-                    thresh=thresh, warp=warp, smooth=smooth,
-                    smooth_win=smooth_win, exclude_tags=exclude_tags)
-                bhv_traces = _get_speed_pupil_npil_traces(
-                    run,
-                    cs=cs,
-                    start_time=start_time,
-                    end_time=end_time,
-                    downsample=downsample,
-                    cutoff_before_lick_ms=-1)
-
-                # filter and sort
-                run_traces = run_traces[d1_ids_bool, :, :][d1_sorter, :, :]
-                # get matched trial metadata/variables
-                dfr = _trialmetafromrun(run)
-                # skip runs with no stimulus presentations
-                if len(dfr) == 0:
-                    continue
-                # skip runs with only one type of stimulus presentation
-                ori_to_match = np.unique(dfr['orientation'].values)
-                ori_wo_blanks = len(ori_to_match) - np.sum(ori_to_match == -1)
-                if cs == '' and ori_wo_blanks <= 2:
-                    if verbose:
-                        print('Skipping, only {} ori presented: '.format(ori_wo_blanks), run)
-                    continue
-                # subselect metadata if you are only running certain cs
-                if cs != '':
-                    if cs == 'plus' or cs == 'minus' or cs == 'neutral':
-                        run_traces = run_traces[:, :, (~dfr['condition'].isin([cs]))]
-                        bhv_traces = bhv_traces[:, :, (~dfr['condition'].isin([cs]))]
-                        dfr = dfr.loc[(dfr['condition'].isin([cs])), :]
-                    elif cs == '0' or cs == '135' or cs == '270':
-                        run_traces = run_traces[:, :, (~dfr['orientation'].isin([cs]))]
-                        bhv_traces = bhv_traces[:, :, (~dfr['orientation'].isin([cs]))]
-                        dfr = dfr.loc[(dfr['orientation'].isin([cs])), :]
-                    else:
-                        print('ERROR: cs called - "' + cs + '" - is not\
-                              a valid option.')
-
-                # subselect metadata to remove certain conditions
-                if len(exclude_conds) > 0:
-                    run_traces = run_traces[:, :, (~dfr['condition'].isin(exclude_conds))]
-                    bhv_traces = bhv_traces[:, :, (~dfr['condition'].isin(exclude_conds))]
-                    dfr = dfr.loc[(~dfr['condition'].isin(exclude_conds)), :]
-
-                # assertions that your filtering worked
-                if 'blank' in exclude_conds:
-                    assert np.sum(dfr['orientation'].isin([-1])) == 0
-
-                # drop trials with nans and add to lists
-                keep = np.sum(np.sum(np.isnan(run_traces), axis=0,
-                              keepdims=True),
-                              axis=1, keepdims=True).flatten() == 0
-                dfr = dfr.iloc[keep, :]
-                d1_tensor_list.append(run_traces[:, :, keep])
-                d1_bhv_list.append(bhv_traces[:, :, keep])
-                d1_meta.append(dfr)
-
-            # if you did not add any runs for the day, continue
-            if len(d1_tensor_list) == 0:
-                continue
-
-            # concatenate matched cells across trials 3rd dim (aka, 2)
-            tensor = np.concatenate(d1_tensor_list, axis=2)
-
-            # concatenate matched cells across trials 3rd dim (aka, 2)
-            bhv_tensor = np.concatenate(d1_bhv_list, axis=2)
-
-            # concatenate all trial metadata in pd dataframe
-            meta = pd.concat(d1_meta, axis=0)
-
-            meta_list.append(meta)
-            tensor_list.append(tensor)
-            bhv_list.append(bhv_tensor)
-            id_list.append(ids)
-
-    # get total trial number across all days/runs
+    # concatenate all trial metadata across days/runs
     meta = pd.concat(meta_list, axis=0)
-    trial_num = len(meta.reset_index()['trial_idx'])
 
     # get union of ids. Use these for indexing and splicing tensors together
     id_union = np.unique(np.concatenate(id_list, axis=0))
-    cell_num = len(id_union)
 
     # build final behavior trace tensor
     group_bhv_tensor = np.concatenate(bhv_list, axis=2)
 
     # build a single large tensor leaving nans where cell is not found
-    trial_start = 0
-    trial_end = 0
-    group_tensor = np.zeros((cell_num, np.shape(tensor_list[0])[1], trial_num))
-    group_tensor[:] = np.nan
-    for i in range(len(tensor_list)):
-        trial_end += np.shape(tensor_list[i])[2]
-        for c, k in enumerate(id_list[i]):
-            celln_all_trials = tensor_list[i][c, :, :]
-            group_tensor[(id_union == k), :, trial_start:trial_end] = celln_all_trials
-        trial_start += np.shape(tensor_list[i])[2]
+    group_tensor = _scatter_group_tensor(tensor_list, id_list, id_union)
 
     # special case for focusing on reversal transition
     if group_by.lower() in ['l_vs_r1_tight', 'all100']:
@@ -1481,10 +1479,13 @@ def groupday_tca(
         test_tensor_path = os.path.join(
             save_dir, str(day1.mouse) + '_' + str(group_by) + score_tag + nt_tag + cv_tag +
                       '_test_tensor_' + str(trace_type) + '.npy')
-        if not os.path.exists(test_tensor_path) or force:
-            np.save(test_tensor_path, test_tensor)
+        if not store.tensor_exists(test_tensor_path) or force:
+            store.save_tensor(test_tensor_path, test_tensor, dtype=save_dtype,
+                              chunk_trials=chunk_trials)
+        cache_keys = [cache.register(mouse, 'test', data_pars, test_tensor_path)]
     else:
         cv_tag = ''
+        cache_keys = []
 
     # just so you have a clue how big the tensor is
     if verbose:
@@ -1508,50 +1509,38 @@ def groupday_tca(
         save_dir, str(day1.mouse) + '_' + str(group_by) + score_tag + nt_tag + cv_tag +
         '_group_decomp_' + str(trace_type) + '.npy')
     all_paths = [meta_path, input_tensor_path, input_bhv_path, input_ids_path, output_tensor_path]
-    if all([os.path.exists(p) for p in all_paths]) and not force:
+    data_paths = {'meta': meta_path, 'tensor': input_tensor_path,
+                  'bhv': input_bhv_path, 'ids': input_ids_path}
+    if all([store.tensor_exists(p) for p in all_paths]) and not force:
         print(f'All paths exist, force not set. Skipping save and decomposition.\n')
         for p in all_paths:
             print(f'    {p}')
         print(' \n')
+        # files are not registered in the artifact cache: their names do not
+        # encode the dates or save_dtype, so they may not match data_pars
         return
     meta.to_pickle(meta_path)
-    np.save(input_tensor_path, group_tensor)
+    store.save_tensor(input_tensor_path, group_tensor, dtype=save_dtype,
+                      chunk_trials=chunk_trials)
     np.save(input_ids_path, id_union)
-    np.save(input_bhv_path, group_bhv_tensor)
+    store.save_tensor(input_bhv_path, group_bhv_tensor, dtype=save_dtype,
+                      chunk_trials=chunk_trials)
+    for k, p in data_paths.items():
+        cache_keys.append(cache.register(mouse, k, data_pars, p))
 
     # run TCA - iterate over different fitting methods
     if not update_meta:  # only run full TCA when not updating metadata
-        if np.isin('mcp_als', method) | \
-           np.isin('mncp_hals', method) | \
-           np.isin('ncp_hals', method):
-            mask = ~np.isnan(group_tensor)
-            # allow for normal ncp_hals to run with no mask if the tensor
-            # has no empties
-            if np.sum(mask.flatten()) == len(mask.flatten()):
-                fit_options['mask'] = None
-            else:
-                fit_options['mask'] = mask
-            # allow for fitting with only certain negative dimesions
-            if len(negative_modes) > 0:
-                fit_options['negative_modes'] = negative_modes
-            # allow for fitting with only certain negative dimesions
-            if tensor_init.lower() != 'rand':
-                fit_options['init'] = tensor_init
-            if len(skip_modes) > 0:
-                fit_options['skip_modes'] = skip_modes
-        group_tensor[np.isnan(group_tensor)] = 0
-        ensemble = {}
-        for m in method:
-            ensemble[m] = tt.Ensemble(
-                fit_method=m, fit_options=deepcopy(fit_options))
-            # Optionally take a list of particular ranks to run, default to first 20
-            if isinstance(rank, list):
-                ensemble[m].fit(group_tensor, ranks=rank,
-                                replicates=replicates, verbose=verbose)
-            else:
-                ensemble[m].fit(group_tensor, ranks=range(1, rank+1),
-                                replicates=replicates, verbose=verbose)
-        np.save(output_tensor_path, ensemble)
+        _groupday_fit(
+            group_tensor, output_tensor_path, rank=rank, method=method,
+            replicates=replicates, fit_options=fit_options,
+            skip_modes=skip_modes, negative_modes=negative_modes,
+            tensor_init=tensor_init, warm_start=warm_start, n_jobs=n_jobs,
+            seed=seed, resume=resume, force=force, data_pars=data_pars,
+            verbose=verbose)
+        cache_keys.append(cache.register(
+            mouse, 'decomp', fit_pars, output_tensor_path))
+    if cache_budget is not None:
+        cache.evict(mouse, cache_budget, keep=cache_keys)
 
     # print output so you don't go crazy waiting
     if verbose:
@@ -1591,6 +1580,207 @@ def test_set_from_tensor(tensor, train_test_split=0.8):
     return tensor, test_tensor
 
 
+def fit_ensemble(
+        tensor,
+        method=('ncp_hals',),
+        ranks=range(1, 21),
+        replicates=3,
+        fit_options=None,
+        n_jobs=1,
+        seed=None,
+        warm_start=False,
+        checkpoint_path=None,
+        checkpoint_pars=None,
+        verbose=True):
+    """
+    Fit TCA ensembles for each method, rank, and replicate, optionally
+    spreading single fits across a pool of worker processes. Returns the same
+    structure as running tt.Ensemble.fit for each method: replicates are
+    sorted by objective, best models are aligned across ranks, and lesser
+    replicates are aligned to the best model of their rank.
+
+    Parameters
+    ----------
+    tensor : numpy.ndarray
+        Tensor to fit, with no nans.
+    method : tuple of str
+        Fit methods, i.e., ('ncp_hals',).
+    ranks : list or range of int
+        Ranks to fit.
+    replicates : int
+        Number of initializations fit for each rank.
+    fit_options : dict
+        Options passed to each fit, i.e., tol, max_iter, mask.
+    n_jobs : int
+        Number of worker processes. 1 runs serially, -1 uses all cores.
+    seed : int
+        Base random seed. Each fit is seeded from (seed, method, rank,
+        replicate) so results do not depend on n_jobs or on the order fits
+        finish. None draws a base seed from np.random.
+    warm_start : bool
+        Initialize the first replicate of each rank from the best model of the
+        previous rank plus one new random component (see _warm_start_init).
+        Other replicates are still randomly initialized for comparison. Ranks
+        are then fit one after another, parallelizing over methods and
+        replicates only.
+    checkpoint_path : str
+        Optional path of the .npy file the ensemble will be saved to. Each
+        finished fit is checkpointed next to it (see store.save_fit_checkpoint)
+        and fits with an existing checkpoint are loaded instead of refit.
+        Checkpoints are only loaded if they were saved for the same tensor,
+        fit_options, seed, and checkpoint_pars (see _fit_fingerprint).
+    checkpoint_pars : dict
+        Optional parameters that produced the tensor, i.e., groupday_tca
+        data_pars, added to the checkpoint fingerprint.
+    verbose : bool
+        Print a summary for each rank.
+
+    Returns
+    -------
+    ensemble : dict of tensortools.Ensemble
+        Keys are fit methods. Each fit result also has an init attribute,
+        'warm' or 'rand', and iterations and total_time from the fit.
+    """
+
+    import tensortools as tt
+
+    if fit_options is None:
+        fit_options = {'tol': 0.0001, 'max_iter': 500, 'verbose': False}
+    fingerprint = None
+    if checkpoint_path is not None:
+        fingerprint = _fit_fingerprint(tensor, fit_options, seed, checkpoint_pars)
+    if seed is None:
+        seed = np.random.randint(2**31)
+    ranks = list(ranks)
+
+    # warm starts depend on the previous rank, otherwise fit all ranks at once
+    rank_groups = [[r] for r in ranks] if warm_start else [ranks]
+
+    results = {}
+    n_resumed = 0
+    for rank_group in rank_groups:
+
+        # load finished fits, queue everything else
+        fit_args = []
+        for m in method:
+            for r in rank_group:
+                for i in range(replicates):
+                    res = None
+                    if checkpoint_path is not None:
+                        res = store.load_fit_checkpoint(
+                            checkpoint_path, m, r, i, fingerprint=fingerprint)
+                    if res is not None:
+                        results[(m, r, i)] = res
+                        n_resumed += 1
+                        continue
+                    init = None
+                    prev_rank = ranks[ranks.index(r) - 1] if ranks.index(r) > 0 else None
+                    if warm_start and i == 0 and prev_rank is not None:
+                        best = min([results[(m, prev_rank, k)] for k in range(replicates)],
+                                   key=lambda res: res.obj)
+                        init = _warm_start_init(
+                            best.factors, r, _fit_seed(seed, m, r, i))
+                    fit_args.append(
+                        (m, r, i, _fit_seed(seed, m, r, i), checkpoint_path, init,
+                         fingerprint))
+        if len(fit_args) == 0:
+            continue
+
+        fits = utils.process_map(
+            _fit_one, fit_args, n_jobs=n_jobs, initializer=_init_fit_worker,
+            initargs=(tensor, fit_options))
+        for args, res in zip(fit_args, fits):
+            results[args[:3]] = res
+    _fit_worker_state.clear()
+    if verbose and n_resumed > 0:
+        print('Resumed {} checkpointed fits.'.format(n_resumed))
+
+    # gather into ensembles, sorting and aligning like tt.Ensemble.fit
+    ensemble = {}
+    for m in method:
+        ensemble[m] = tt.Ensemble(fit_method=m, fit_options=deepcopy(fit_options))
+        for r in ranks:
+            rank_results = [results[(m, r, i)] for i in range(replicates)]
+            ensemble[m].results[r] = sorted(rank_results, key=lambda res: res.obj)
+            if verbose:
+                objs = [res.obj for res in rank_results]
+                elapsed = np.nansum([res.total_time for res in rank_results])
+                iters = ', '.join(['{} {}'.format(res.init, res.iterations)
+                                   for res in rank_results])
+                print('{} rank-{} models:  min obj, {:.2f};  max obj, {:.2f};  '
+                      'time to fit, {:.1f}s;  iterations, {}'.format(
+                          m, r, np.min(objs), np.max(objs), elapsed, iters))
+        for c in reversed(range(1, len(ranks))):
+            U = ensemble[m].results[ranks[c-1]][0].factors
+            V = ensemble[m].results[ranks[c]][0].factors
+            tt.kruskal_align(U, V, permute_U=True)
+        for r in ranks:
+            U = ensemble[m].results[r][0].factors
+            ensemble[m].results[r][0].similarity = 1.0
+            for res in ensemble[m].results[r][1:]:
+                res.similarity = tt.kruskal_align(U, res.factors, permute_V=True)
+
+    return ensemble
+
+
+def _groupday_fit(
+        group_tensor,
+        output_tensor_path,
+        rank=20,
+        method=('ncp_hals',),
+        replicates=3,
+        fit_options=None,
+        skip_modes=[],
+        negative_modes=[],
+        tensor_init='rand',
+        warm_start=False,
+        n_jobs=1,
+        seed=None,
+        resume=True,
+        force=False,
+        data_pars=None,
+        verbose=True):
+    """
+    Fit a groupday_tca ensemble to a group tensor (nans are missing data) and
+    save it, along with per-rank factors, to output_tensor_path. Checkpoints
+    of an interrupted fit are resumed unless resume is False or force is set.
+    data_pars identify the data in the checkpoint fingerprint.
+    """
+
+    if np.isin('mcp_als', method) | \
+       np.isin('mncp_hals', method) | \
+       np.isin('ncp_hals', method):
+        mask = ~np.isnan(group_tensor)
+        # allow for normal ncp_hals to run with no mask if the tensor
+        # has no empties
+        if np.sum(mask.flatten()) == len(mask.flatten()):
+            fit_options['mask'] = None
+        else:
+            fit_options['mask'] = mask
+        # allow for fitting with only certain negative dimesions
+        if len(negative_modes) > 0:
+            fit_options['negative_modes'] = negative_modes
+        # allow for fitting with only certain negative dimesions
+        if tensor_init.lower() != 'rand':
+            fit_options['init'] = tensor_init
+        if len(skip_modes) > 0:
+            fit_options['skip_modes'] = skip_modes
+    group_tensor[np.isnan(group_tensor)] = 0
+    # Optionally take a list of particular ranks to run, default to first 20
+    ranks = rank if isinstance(rank, list) else range(1, rank+1)
+    if force or not resume:
+        store.clear_fit_checkpoints(output_tensor_path)
+    ensemble = fit_ensemble(
+        group_tensor, method=method, ranks=ranks, replicates=replicates,
+        fit_options=fit_options, n_jobs=n_jobs, seed=seed,
+        warm_start=warm_start, checkpoint_path=output_tensor_path,
+        checkpoint_pars=data_pars, verbose=verbose)
+    np.save(output_tensor_path, ensemble)
+    # also save each rank separately so single ranks can be loaded lazily
+    store.save_factors(output_tensor_path, ensemble)
+    store.clear_fit_checkpoints(output_tensor_path)
+
+
 def _get_speed_pupil_npil_traces(
         run,
         cs='',
@@ -1777,6 +1967,93 @@ def _three_point_temporal_trace(tensor, metadata):
     return new_tensor
 
 
+# cross-day index caches, shared across calls for the same mouse/date and
+# bounded to the most recently used days
+_crossday_id_cache = OrderedDict()
+_crossday_drive_cache = OrderedDict()
+_crossday_cache_size = 128
+
+
+def clear_crossday_cache():
+    """
+    Clear cross-day cell ids, alignment scores, and drive scores cached by
+    groupday_tca, i.e., after a cross-day alignment was rerun.
+    """
+
+    _crossday_id_cache.clear()
+    _crossday_drive_cache.clear()
+
+
+def _cache_crossday(cache, key, value):
+    """Add a day to a cross-day cache, dropping the least recently used."""
+
+    cache[key] = value
+    while len(cache) > _crossday_cache_size:
+        cache.popitem(last=False)
+
+
+def _crossday_day_ids(day1):
+    """
+    Read the cross-day cell ids and alignment scores for a single day once.
+    Results are cached per (mouse, date) until clear_crossday_cache is called
+    or the day is one of the least recently used.
+
+    Returns
+    -------
+    ids : numpy.ndarray of int
+    scores : numpy.ndarray of float
+    """
+
+    key = (day1.mouse, day1.date)
+    if key in _crossday_id_cache:
+        _crossday_id_cache.move_to_end(key)
+        return _crossday_id_cache[key]
+
+    d1_ids = flow.xday._read_crossday_ids(day1.mouse, day1.date)
+    d1_scores = flow.xday._read_crossday_scores(day1.mouse, day1.date)
+    d1_ids = np.array([int(s) for s in d1_ids])
+    d1_scores = np.array([float(s) for s in d1_scores])
+    _cache_crossday(_crossday_id_cache, key, (d1_ids, d1_scores))
+
+    return d1_ids, d1_scores
+
+
+def _crossday_day_drive(day1, drive_css, drive_type='visual'):
+    """
+    Get the max drive score across drive_css for each cell on a single day.
+    Results are cached per (mouse, date, drive_css, drive_type) like
+    _crossday_day_ids.
+    """
+
+    key = (day1.mouse, day1.date, tuple(drive_css), drive_type.lower())
+    if key in _crossday_drive_cache:
+        _crossday_drive_cache.move_to_end(key)
+        return _crossday_drive_cache[key]
+
+    d1_drive = []
+    for dcs in drive_css:
+        try:
+            if drive_type.lower() == 'trial':
+                d1_drive.append(
+                    pool.calc.driven.trial(day1, dcs))
+            elif drive_type.lower() == 'trial_abs':
+                d1_drive.append(
+                    pool.calc.driven.trial_abs(day1, dcs))
+            elif drive_type.lower() == 'visual':
+                d1_drive.append(
+                    pool.calc.driven.visually(day1, dcs))
+            elif drive_type.lower() == 'inhib':
+                    d1_drive.append(
+                        pool.calc.driven.visually_inhib(day1, dcs))
+        except KeyError:
+            print(str(day1) + ' requested ' + dcs + ' ' + drive_type +
+                  ': no match to what was shown (probably pav only).')
+    d1_drive = np.max(d1_drive, axis=0)
+    _cache_crossday(_crossday_drive_cache, key, d1_drive)
+
+    return d1_drive
+
+
 def _group_drive_ids(days, drive_css, drive_threshold, drive_type='visual'):
     """
     Get an array of all unique ids driven on any day for a given DaySorter.
@@ -1785,32 +2062,12 @@ def _group_drive_ids(days, drive_css, drive_threshold, drive_type='visual'):
     good_ids = []
     for day1 in days:
         # get cell_ids
-        d1_ids = flow.xday._read_crossday_ids(day1.mouse, day1.date)
+        d1_ids, _ = _crossday_day_ids(day1)
         # skip empty if there is no crossday alignment file
         if len(d1_ids) == 0:
             continue
-        d1_ids = np.array([int(s) for s in d1_ids])
         # filter cells based on visual/trial drive across all cs
-        d1_drive = []
-        for dcs in drive_css:
-            try:
-                if drive_type.lower() == 'trial':
-                    d1_drive.append(
-                        pool.calc.driven.trial(day1, dcs))
-                elif drive_type.lower() == 'trial_abs':
-                    d1_drive.append(
-                        pool.calc.driven.trial_abs(day1, dcs))
-                elif drive_type.lower() == 'visual':
-                    d1_drive.append(
-                        pool.calc.driven.visually(day1, dcs))
-                elif drive_type.lower() == 'inhib':
-                        d1_drive.append(
-                            pool.calc.driven.visually_inhib(day1, dcs))
-            except KeyError:
-                print(str(day1) + ' requested ' + dcs + ' ' + drive_type +
-                      ': no match to what was shown (probably pav only).')
-
-        d1_drive = np.max(d1_drive, axis=0)
+        d1_drive = _crossday_day_drive(day1, drive_css, drive_type=drive_type)
         d1_drive_ids = d1_ids[np.array(d1_drive) > drive_threshold]
         good_ids.extend(d1_drive_ids)
 
@@ -1826,13 +2083,10 @@ def _group_ids_score(days, score_threshold):
     good_ids = []
     for day1 in days:
         # get cell_ids
-        d1_ids = flow.xday._read_crossday_ids(day1.mouse, day1.date)
-        d1_scores = flow.xday._read_crossday_scores(day1.mouse, day1.date)
+        d1_ids, d1_scores = _crossday_day_ids(day1)
         # skip empty if there is no crossday alignment file
         if len(d1_ids) == 0 or len(d1_scores) == 0:
             continue
-        d1_ids = np.array([int(s) for s in d1_ids])
-        d1_scores = np.array([float(s) for s in d1_scores])
         # filter cells based on visual/trial drive across all cs
         d1_highscore_ids = d1_ids[np.array(d1_scores) > score_threshold]
         good_ids.extend(d1_highscore_ids)
@@ -1840,6 +2094,305 @@ def _group_ids_score(days, score_threshold):
     return np.unique(good_ids)
 
 
+def _group_day_id_filters(
+        days, driven=True, drive_css=('0', '135', '270'), drive_threshold=1.31,
+        drive_type='trial', score_threshold=0.8, verbose=True):
+    """
+    Select cells for each day of a group tensor in a single pass over days.
+    Cross-day drive and alignment score ids are computed once for the whole
+    group of days rather than once per day.
+
+    Returns
+    -------
+    day_filters : list of tuple
+        (day1, d1_ids_bool, d1_sorter, ids) for each day with a crossday
+        alignment file.
+    score_tag : str
+        Saving tag for the score threshold.
+    """
+
+    # ids that pass across all days, only calculated once
+    if driven:
+        good_ids = _group_drive_ids(
+            days, drive_css, drive_threshold, drive_type=drive_type)
+    if score_threshold > 0:
+        highscore_ids = _group_ids_score(days, score_threshold)
+        score_tag = '_score0pt' + str(int(score_threshold*10))
+    else:
+        score_tag = ''
+
+    day_filters = []
+    for day1 in days:
+
+        # get cell_ids
+        d1_ids, _ = _crossday_day_ids(day1)
+        # skip empty if there is no crossday alignment file
+        if len(d1_ids) == 0:
+            continue
+
+        # filter cells based on visual/trial drive across all cs, prevent
+        # breaking when only pavs are shown
+        day_good_ids = good_ids if driven else d1_ids
+        # filter for being able to check for quality of xday alignment
+        if score_threshold > 0:
+            orig_num_ids = len(day_good_ids)
+            day_good_ids = np.intersect1d(day_good_ids, highscore_ids)
+            if verbose and len(day_filters) == 0:
+                print('Cell score threshold ' + str(score_threshold) + ':'
+                      + ' ' + str(len(highscore_ids)) + ' above threshold:'
+                      + ' good_ids updated to ' + str(len(day_good_ids)) + '/'
+                      + str(orig_num_ids) + ' cells.')
+        d1_ids_bool = np.isin(d1_ids, day_good_ids)
+        d1_sorter = np.argsort(d1_ids[d1_ids_bool])
+        ids = d1_ids[d1_ids_bool][d1_sorter]
+        day_filters.append((day1, d1_ids_bool, d1_sorter, ids))
+
+    return day_filters, score_tag
+
+
+def _groupday_tensor_from_day(
+        mouse, date, d1_ids_bool, d1_sorter, cs='', trace_type='zscore_day',
+        start_time=-1, end_time=6, downsample=True, clean_artifacts=None,
+        thresh=20, warp=False, smooth=True, smooth_win=6,
+        exclude_tags=('disengaged', 'orientation_mapping', 'contrast', 'retinotopy', 'sated'),
+        exclude_conds=('blank', 'blank_reward', 'pavlovian', 'monitor'),
+        verbose=True):
+    """
+    Build the triggered trace tensor, behavior tensor, and trial metadata
+    for a single day of a group tensor. Cells are filtered and sorted using
+    d1_ids_bool and d1_sorter. Defined at the module level so that days can be
+    sent to worker processes.
+
+    Returns
+    -------
+    (tensor, bhv_tensor, meta) or None if no runs were kept for the day.
+    """
+
+    day1 = flow.Date(mouse=mouse, date=date)
+
+    # get all runs for the day
+    d1_runs = day1.runs(exclude_tags=['bad'], run_types='training')
+
+    # filter for only runs without certain tags
+    d1_runs = [run for run in d1_runs if not
+               any(np.isin(run.tags, exclude_tags))]
+
+    # build tensors for all correct runs and trials after filtering
+    if not d1_runs:
+        return None
+    d1_tensor_list = []
+    d1_bhv_list = []
+    d1_meta = []
+    for run in d1_runs:
+        t2p = run.trace2p()
+        # trigger all trials around stimulus onsets
+        run_traces = utils.getcstraces(
+            run, cs=cs, trace_type=trace_type,
+            start_time=start_time, end_time=end_time,
+            downsample=downsample, clean_artifacts=clean_artifacts,
+            thresh=thresh, warp=warp, smooth=smooth,
+            smooth_win=smooth_win, exclude_tags=exclude_tags)
+        bhv_traces = _get_speed_pupil_npil_traces(
+            run,
+            cs=cs,
+            start_time=start_time,
+            end_time=end_time,
+            downsample=downsample,
+            cutoff_before_lick_ms=-1)
+
+        # filter and sort
+        run_traces = run_traces[d1_ids_bool, :, :][d1_sorter, :, :]
+        # get matched trial metadata/variables
+        dfr = _trialmetafromrun(run)
+        # skip runs with no stimulus presentations
+        if len(dfr) == 0:
+            continue
+        # skip runs with only one type of stimulus presentation
+        ori_to_match = np.unique(dfr['orientation'].values)
+        ori_wo_blanks = len(ori_to_match) - np.sum(ori_to_match == -1)
+        if cs == '' and ori_wo_blanks <= 2:
+            if verbose:
+                print('Skipping, only {} ori presented: '.format(ori_wo_blanks), run)
+            continue
+        # subselect metadata if you are only running certain cs
+        if cs != '':
+            if cs == 'plus' or cs == 'minus' or cs == 'neutral':
+                run_traces = run_traces[:, :, (~dfr['condition'].isin([cs]))]
+                bhv_traces = bhv_traces[:, :, (~dfr['condition'].isin([cs]))]
+                dfr = dfr.loc[(dfr['condition'].isin([cs])), :]
+            elif cs == '0' or cs == '135' or cs == '270':
+                run_traces = run_traces[:, :, (~dfr['orientation'].isin([cs]))]
+                bhv_traces = bhv_traces[:, :, (~dfr['orientation'].isin([cs]))]
+                dfr = dfr.loc[(dfr['orientation'].isin([cs])), :]
+            else:
+                print('ERROR: cs called - "' + cs + '" - is not\
+                      a valid option.')
+
+        # subselect metadata to remove certain conditions
+        if len(exclude_conds) > 0:
+            run_traces = run_traces[:, :, (~dfr['condition'].isin(exclude_conds))]
+            bhv_traces = bhv_traces[:, :, (~dfr['condition'].isin(exclude_conds))]
+            dfr = dfr.loc[(~dfr['condition'].isin(exclude_conds)), :]
+
+        # assertions that your filtering worked
+        if 'blank' in exclude_conds:
+            assert np.sum(dfr['orientation'].isin([-1])) == 0
+
+        # drop trials with nans and add to lists
+        keep = np.sum(np.sum(np.isnan(run_traces), axis=0,
+                      keepdims=True),
+                      axis=1, keepdims=True).flatten() == 0
+        dfr = dfr.iloc[keep, :]
+        d1_tensor_list.append(run_traces[:, :, keep])
+        d1_bhv_list.append(bhv_traces[:, :, keep])
+        d1_meta.append(dfr)
+
+    # if you did not add any runs for the day, skip it
+    if len(d1_tensor_list) == 0:
+        return None
+
+    # concatenate all trial metadata in pd dataframe, run tensors are left
+    # as a list to be written directly into the group tensor
+    meta = pd.concat(d1_meta, axis=0)
+
+    return d1_tensor_list, d1_bhv_list, meta
+
+
+def _scatter_group_tensor(tensor_lists, id_list, id_union, dtype=np.float32):
+    """
+    Write a list of per-day lists of run tensors (cells x times x trials) into
+    a single preallocated group tensor, leaving nans where a cell was not
+    found on a day. Rows for each day are found with a single searchsorted
+    on id_union so that each run is written with one indexed assignment.
+
+    Parameters
+    ----------
+    tensor_lists : list of list of numpy.ndarray
+        Run tensors for each day, in trial order.
+    id_list : list of numpy.ndarray
+        Sorted cell ids for each day, matching axis 0 of that day's tensors.
+    id_union : numpy.ndarray
+        Sorted union of all cell ids. Defines axis 0 of the group tensor.
+    dtype : numpy.dtype
+        dtype of the group tensor.
+
+    Returns
+    -------
+    group_tensor : numpy.ndarray
+        cells x times x trials
+    """
+
+    trial_num = np.sum([rt.shape[2] for day_list in tensor_lists for rt in day_list])
+    n_times = tensor_lists[0][0].shape[1]
+    group_tensor = np.full((len(id_union), n_times, trial_num), np.nan, dtype=dtype)
+
+    trial_start = 0
+    for day_list, ids in zip(tensor_lists, id_list):
+        rows = np.searchsorted(id_union, ids)
+        for run_tensor in day_list:
+            trial_end = trial_start + run_tensor.shape[2]
+            group_tensor[rows, :, trial_start:trial_end] = run_tensor
+            trial_start = trial_end
+
+    return group_tensor
+
+
+_fit_par_keys = ('rank', 'method', 'replicates', 'fit_options', 'negative_modes',
+                 'skip_modes', 'tensor_init', 'warm_start', 'seed')
+_fit_worker_state = {}
+
+
+def _init_fit_worker(tensor, fit_options):
+    """
+    Share the tensor and fit options with a fit worker once, rather than
+    pickling them for every single fit.
+    """
+
+    _fit_worker_state['tensor'] = tensor
+    _fit_worker_state['fit_options'] = fit_options
+
+
+def _fit_fingerprint(tensor, fit_options, seed, checkpoint_pars=None):
+    """
+    Key of everything a single fit depends on besides method, rank, and
+    replicate: the tensor shape and data, fit options, base seed (as passed,
+    so a None seed still resumes), and the parameters that built the tensor.
+    """
+
+    h = hashlib.sha1()
+    h.update(str(np.shape(tensor)).encode())
+    h.update(np.ascontiguousarray(tensor).data)
+    for k in sorted(fit_options):
+        v = fit_options[k]
+        h.update(str(k).encode())
+        if isinstance(v, np.ndarray):
+            h.update(str(v.shape).encode())
+            h.update(np.ascontiguousarray(v).data)
+        else:
+            h.update(str(v).encode())
+    h.update(str(seed).encode())
+    if checkpoint_pars is not None:
+        h.update(cache.artifact_key(checkpoint_pars).encode())
+
+    return h.hexdigest()
+
+
+def _fit_seed(seed, method, rank, replicate):
+    """Deterministic seed for a single fit."""
+
+    return zlib.crc32('{}_{}_{}_{}'.format(seed, method, rank, replicate).encode())
+
+
+def _warm_start_init(factors, rank, seed):
+    """
+    Initial KTensor for a rank-r fit built from a rank-(r-1) solution plus
+    new uniform random components. Each new column is scaled to the mean norm
+    of the existing columns of its mode so it can compete with them.
+
+    :param factors: KTensor, best fit of the previous rank
+    :param rank: int, rank to initialize
+    :param seed: int, seed for the new components
+    :return: KTensor
+    """
+
+    from tensortools.tensors import KTensor
+
+    rs = np.random.RandomState(seed)
+    n_new = rank - factors.rank
+    init = []
+    for f in factors:
+        new = rs.rand(f.shape[0], n_new)
+        scale = np.mean(np.linalg.norm(f, axis=0)) / np.linalg.norm(new, axis=0)
+        init.append(np.hstack([f, new*scale]))
+
+    return KTensor(init)
+
+
+def _fit_one(method, rank, replicate, seed, checkpoint_path=None, init=None,
+             fingerprint=None):
+    """
+    Fit a single TCA model with the tensor and options set by
+    _init_fit_worker, checkpointing the result if checkpoint_path is given.
+    init optionally overrides the initialization with a KTensor.
+    fingerprint is saved with the checkpoint (see _fit_fingerprint).
+    """
+
+    import tensortools as tt
+
+    fit_options = dict(_fit_worker_state['fit_options'])
+    fit_options['random_state'] = seed
+    if init is not None:
+        fit_options['init'] = init
+    res = getattr(tt.optimize, method)(
+        _fit_worker_state['tensor'], rank, **fit_options)
+    res.init = 'rand' if init is None else 'warm'
+    if checkpoint_path is not None:
+        store.save_fit_checkpoint(checkpoint_path, method, rank, replicate, res,
+                                  fingerprint=fingerprint)
+
+    return res
+
+
 def _triggerfromrun(run, trace_type='zscore_day', cs='', downsample=True,
             start_time=-1, end_time=6, clean_artifacts='interp',
             thresh=20, warp=False, smooth=True, smooth_win=6,
@@ -1913,18 +2466,9 @@ def _triggerfromrun(run, trace_type='zscore_day', cs='', downsample=True,
         run_traces = run_traces[range(0,len(cell_ids)), :, :]
         warnings.warn(str(run) + ': You have more cell traces than cell_idx: skipping extra cells.')
 
-    # build matrices to match cell, trial, time variables to traces
-    trial_mat = np.ones(np.shape(run_traces))
-    for trial in range(np.shape(run_traces)[2]):
-        trial_mat[:, :, trial] = trial
-
-    cell_mat = np.ones(np.shape(run_traces))
-    for cell in range(np.shape(run_traces)[0]):
-        cell_mat[cell, :, :] = cell_ids[cell]
-
-    time_mat = np.ones(np.shape(run_traces))
-    for timept in range(np.shape(run_traces)[1]):
-        time_mat[:, timept, :] = timestamps[timept]
+    # match cell, trial, time variables to traces
+    trial_vec, cell_vec, time_vec = utils.trace_index_arrays(
+        run_traces.shape, cell_ids, timestamps)
 
     # reshape and build df
     vec_sz = run_traces.size
@@ -1932,9 +2476,9 @@ def _triggerfromrun(run, trace_type='zscore_day', cs='', downsample=True,
         [run.mouse] * vec_sz,
         [run.date] * vec_sz,
         [run.run] * vec_sz,
-        trial_mat.reshape(vec_sz),
-        cell_mat.reshape(vec_sz),
-        time_mat.reshape(vec_sz)
+        trial_vec.astype(float),
+        cell_vec.astype(float),
+        time_vec
         ],
         names=['mouse', 'date', 'run', 'trial_idx',
                'cell_idx', 'timestamp'])
@@ -12,7 +12,7 @@ import scipy as sp
 
 
 def cell_tuning(meta, tensor, model=None, rank=15, by_stage=False, by_reversal=False, nan_lick=False, nan_running=False,
-                staging='parsed_11stage', tuning_type='initial', force_stim_avg=False):
+                staging='parsed_11stage', tuning_type='initial', force_stim_avg=False, summary=None):
     """
     Function for calculating tuning for different stages of learning for the components
     from TCA.
@@ -29,6 +29,7 @@ def cell_tuning(meta, tensor, model=None, rank=15, by_stage=False, by_reversal=F
     :param nan_running: boolean, choose to nan periods of high speed running (and baseline)
     :param staging: str, binning used to define stages of learning
     :param tuning_type: str, way to define stimulus type. 'initial', 'orientation', or defaults to 'condition'
+    :param summary: utils.TensorSummary of tensor, optional, reuses results between calls
     :return: stage_tuning_df: pandas.DataFrame, columns are stages
     """
 
@@ -52,7 +53,7 @@ def cell_tuning(meta, tensor, model=None, rank=15, by_stage=False, by_reversal=F
         num_components = np.zeros(tensor.shape[0]) + np.nan
         any_offset_activity = np.zeros(tensor.shape[0]) + np.nan
         offset = np.zeros(tensor.shape[0]) + np.nan
-        offset_cells = utils.get_offset_cells(meta, tensor)
+        offset_cells = utils.get_offset_cells(meta, tensor, summary=summary)
     else:
         best_components = utils.define_high_weight_cell_factors(model, rank, threshold=1)
         num_components = utils.count_high_weight_cell_factors(model, rank, threshold=1)
@@ -1,11 +1,114 @@
 """Functions for general calculations and data management."""
+import re
+import hashlib
 import flow
 import pool
 import numpy as np
 import warnings
 import pandas as pd
+from scipy import ndimage
 from . import lookups, bias, tca
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+
+
+_trial_group_cache = OrderedDict()
+
+
+def trial_groups(meta, by, labels=None, sort=False):
+    """
+    Integer group offsets of trials, i.e., the day, run, stage or cue of each
+    trial. Built once per meta and grouping and cached, so it can be reused by
+    every reduction over the trial axis (see group_reduce).
+
+    :param meta: pandas.DataFrame, trial metadata
+    :param by: str or list of str, columns or index levels to group trials
+        by, i.e., 'date', ['mouse', 'date', 'run'], 'parsed_11stage', or
+        'initial_condition'
+    :param labels: list, optional, groups in output order (i.e.,
+        lookups.staging[staging]), trials in any other group get -1
+    :param sort: boolean, order groups by label instead of first appearance
+    :return: codes: numpy.ndarray of int, group of each trial
+             groups: pandas.Index, label of each group
+    """
+
+    by = [by] if isinstance(by, str) else list(by)
+    cols = [_meta_column(meta, b) for b in by]
+    h = hashlib.sha1()
+    for vals in cols:
+        h.update(pd.util.hash_array(np.asarray(vals)).tobytes())
+    key = (tuple(by), None if labels is None else tuple(labels), sort,
+           len(meta), h.hexdigest())
+    if key in _trial_group_cache:
+        _trial_group_cache.move_to_end(key)
+        return _trial_group_cache[key]
+
+    if len(by) == 1:
+        keys = pd.Index(cols[0], name=by[0])
+    else:
+        keys = pd.MultiIndex.from_arrays(cols, names=by)
+    if labels is None:
+        codes, groups = pd.factorize(keys, sort=sort)
+    else:
+        groups = pd.Index(labels)
+        codes = groups.get_indexer(keys)
+
+    _trial_group_cache[key] = (codes, groups)
+    while len(_trial_group_cache) > 32:
+        _trial_group_cache.popitem(last=False)
+
+    return codes, groups
+
+
+def group_reduce(tensor, codes, n_groups, stat='nanmean', trial_bool=None):
+    """
+    Reduce the trial (last) axis of a tensor within groups of trials in one
+    pass. Runs of consecutive trials from the same group (i.e., a day of a
+    tensor sorted by date) are reduced as segments with ufunc.reduceat and
+    then summed per group, instead of making a masked copy for each group.
+
+    :param tensor: numpy.ndarray, i.e., cells x times x trials
+    :param codes: numpy.ndarray of int, group of each trial, -1 to skip
+    :param n_groups: int, number of groups
+    :param stat: str, 'nanmean', 'nanvar', or 'count' of non-nan values
+    :param trial_bool: boolean numpy.ndarray, optional, trials to include
+    :return: numpy.ndarray, tensor.shape[:-1] + (n_groups,), nan for groups
+             without trials (0 for count)
+    """
+
+    assert stat in ['nanmean', 'nanvar', 'count'], 'Unknown stat: {}'.format(stat)
+    codes = np.asarray(codes)
+    keep = codes >= 0
+    if trial_bool is not None:
+        keep &= np.asarray(trial_bool, dtype=bool)
+    if not np.all(keep):
+        tensor = tensor[..., keep]
+        codes = codes[keep]
+    if len(codes) == 0:
+        new_tensor = np.zeros(tensor.shape[:-1] + (n_groups,))
+        if stat != 'count':
+            new_tensor[:] = np.nan
+        return new_tensor
+
+    # segments of consecutive trials in the same group and the group of each
+    starts = np.append(0, np.where(np.diff(codes) != 0)[0] + 1)
+    seg_groups = np.zeros((len(starts), n_groups))
+    seg_groups[np.arange(len(starts)), codes[starts]] = 1
+
+    def _group_sum(x):
+        return np.add.reduceat(x, starts, axis=-1) @ seg_groups
+
+    finite = ~np.isnan(tensor)
+    count = _group_sum(finite.astype(np.float64))
+    if stat == 'count':
+        return count
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = _group_sum(np.where(finite, tensor, 0)) / count
+        if stat == 'nanmean':
+            return mean
+        dev = np.where(finite, tensor - mean[..., codes], 0)
+        return _group_sum(dev**2) / count
 
 
 def simple_mean_per_day(meta, tensor, meta_bool=None,
@@ -27,12 +130,8 @@ def simple_mean_per_day(meta, tensor, meta_bool=None,
                            filter_hmm_engaged=filter_hmm_engaged)
 
     # get average response per day
-    days = meta.reset_index()['date'].unique()
-    new_tensor = np.zeros((tensor.shape[0], tensor.shape[1], len(days)))
-    new_tensor[:] = np.nan
-    for c, di in enumerate(meta.reset_index()['date'].unique()):
-        day_boo = meta.reset_index()['date'].isin([di]).values
-        new_tensor[:, :, c] = np.nanmean(tensor[:, :, (day_boo & meta_bool)], axis=2)
+    codes, days = trial_groups(meta, 'date')
+    new_tensor = group_reduce(tensor, codes, len(days), trial_bool=meta_bool)
 
     return new_tensor
 
@@ -55,15 +154,9 @@ def simple_mean_per_run(meta, tensor, meta_bool=None,
                            filter_licking=filter_licking,
                            filter_hmm_engaged=filter_hmm_engaged)
 
-    # get average response per day
-    n_run_days = meta.groupby(['mouse', 'date', 'run']).nunique().shape[0]
-    new_tensor = np.zeros((tensor.shape[0], tensor.shape[1], n_run_days))
-    new_tensor[:] = np.nan
-
-    for c, (mdr, _) in enumerate(meta.groupby(['mouse', 'date', 'run'])):
-        day_boo = meta.reset_index()['date'].isin([mdr[1]]).values
-        run_boo = meta.reset_index()['run'].isin([mdr[2]]).values
-        new_tensor[:, :, c] = np.nanmean(tensor[:, :, (run_boo & day_boo & meta_bool)], axis=2)
+    # get average response per run
+    codes, runs = trial_groups(meta, ['mouse', 'date', 'run'], sort=True)
+    new_tensor = group_reduce(tensor, codes, len(runs), trial_bool=meta_bool)
 
     return new_tensor
 
@@ -91,12 +184,8 @@ def simple_mean_per_stage(meta, tensor, staging='parsed_11stage', meta_bool=None
                            filter_hmm_engaged=filter_hmm_engaged)
 
     # get average response per stage
-    stages = lookups.staging[staging]
-    new_tensor = np.zeros((tensor.shape[0], tensor.shape[1], len(stages)))
-    new_tensor[:] = np.nan
-    for c, di in enumerate(stages):
-        stage_boo = meta[staging].isin([di]).values
-        new_tensor[:, :, c] = np.nanmean(tensor[:, :, stage_boo & meta_bool], axis=2)
+    codes, stages = trial_groups(meta, staging, labels=lookups.staging[staging])
+    new_tensor = group_reduce(tensor, codes, len(stages), trial_bool=meta_bool)
 
     return new_tensor
 
@@ -123,19 +212,15 @@ def balanced_mean_per_stage(meta, tensor, staging='parsed_11stage', meta_bool=No
                            filter_licking=filter_licking,
                            filter_hmm_engaged=filter_hmm_engaged)
 
-    # get average response per stage
-    stages = lookups.staging[staging]
+    # get average response per day, then average the days of each stage
+    day_codes, days = trial_groups(meta, 'date')
+    stage_codes, stages = trial_groups(meta, staging, labels=lookups.staging[staging])
+    day_means = group_reduce(tensor, day_codes, len(days), trial_bool=meta_bool)
     new_tensor = np.zeros((tensor.shape[0], tensor.shape[1], len(stages)))
     new_tensor[:] = np.nan
-    for c, di in enumerate(stages):
-        stage_boo = meta[staging].isin([di]).values
-        stage_days = meta.loc[stage_boo, :].reset_index()['date'].unique()
-        day_means = np.zeros((tensor.shape[0], tensor.shape[1], len(stage_days)))
-        day_means[:] = np.nan
-        for c2, di2 in enumerate(stage_days):
-            day_boo = meta.reset_index()['date'].isin([di2]).values
-            day_means[:, :, c2] = np.nanmean(tensor[:, :, day_boo & meta_bool], axis=2)
-        new_tensor[:, :, c] = np.nanmean(day_means[:, :, :], axis=2)
+    for c in range(len(stages)):
+        stage_days = np.unique(day_codes[stage_codes == c])
+        new_tensor[:, :, c] = np.nanmean(day_means[:, :, stage_days], axis=2)
 
     return new_tensor
 
@@ -177,21 +262,18 @@ def tensor_mean_per_day(meta, tensor, initial_cue=True, cue='plus', ignore_cue=F
         ablated_tensor = tensor
 
     # get average response per day to a single cue
-    days = meta.reset_index()['date'].unique()
-    new_tensor = np.zeros((tensor.shape[0], tensor.shape[1], len(days)))
-    new_tensor[:] = np.nan
-    for c, di in enumerate(meta.reset_index()['date'].unique()):
-        day_boo = meta.reset_index()['date'].isin([di]).values
-        new_tensor[:, :, c] = np.nanmean(ablated_tensor[:, :, day_boo & cue_bool], axis=2)
+    codes, days = trial_groups(meta, 'date')
+    new_tensor = group_reduce(ablated_tensor, codes, len(days), trial_bool=cue_bool.values)
 
     return new_tensor
 
 
-def tensor_mean_per_trial(meta, tensor, nan_licking=False, account_for_offset=False):
+def tensor_mean_per_trial(meta, tensor, nan_licking=False, account_for_offset=False, summary=None):
     """
     Helper function to calculate mean per trial meta for a single mouse, correctly accounting for stimulus length.
     Optionally buffer times around licking. Can also choose to automatically parse if a cell's peak activity is
-    during the response window and use response window as the trial mean for that offset cells.
+    during the response window and use response window as the trial mean for that offset cells. Pass a
+    TensorSummary of the tensor as summary to reuse results between calls.
     """
 
     # meta can only be a DataFrame of a single mouse
@@ -204,20 +286,21 @@ def tensor_mean_per_trial(meta, tensor, nan_licking=False, account_for_offset=Fa
     stim_bool = (times > 0) & (times < lookups.stim_length[mouse])
     response_bool = (times > lookups.stim_length[mouse] + 0.0) & (times < lookups.stim_length[mouse] + 2)  # 0ms delay
 
+    # without licking ablation trial means can be reused from a summary
+    if not nan_licking:
+        return _summary_of(tensor, summary).trial_means(mouse, account_for_offset=account_for_offset).copy()
+
     # make sure that the date vec allows for 0.5 days at reversal and learning
     meta = update_meta_date_vec(meta)
 
     # optionally determine cells with offset responses
     if account_for_offset:
-        offset_bool = get_offset_cells(meta, tensor)
+        offset_bool = get_offset_cells(meta, tensor, summary=summary)
 
     # optionally nan all times after licking (median cs plus lick latency for non-lick trials)
-    if nan_licking:
-        mask = bias.get_lick_mask(meta, tensor)
-        ablated_tensor = deepcopy(tensor)
-        ablated_tensor[~mask] = np.nan
-    else:
-        ablated_tensor = tensor
+    mask = bias.get_lick_mask(meta, tensor)
+    ablated_tensor = deepcopy(tensor)
+    ablated_tensor[~mask] = np.nan
 
     # get average response per trial
     if account_for_offset:
@@ -232,10 +315,11 @@ def tensor_mean_per_trial(meta, tensor, nan_licking=False, account_for_offset=Fa
     return new_mat
 
 
-def tensor_mean_baselines_per_trial(meta, tensor, nan_licking=False):
+def tensor_mean_baselines_per_trial(meta, tensor, nan_licking=False, summary=None):
     """
     Helper function to calculate mean baseline per trial meta for a single mouse.
-    Optionally buffer times around licking.
+    Optionally buffer times around licking. Pass a TensorSummary of the tensor as summary to reuse results between
+    calls.
     """
 
     # meta can only be a DataFrame of a single mouse
@@ -246,6 +330,10 @@ def tensor_mean_baselines_per_trial(meta, tensor, nan_licking=False):
     times = np.arange(-1, 6, 1 / 15.5)[:108]
     base_bool = (times < 0)
 
+    # without licking ablation baselines can be reused from a summary
+    if not nan_licking:
+        return _summary_of(tensor, summary).window_mean(0, np.sum(base_bool)).copy()
+
     # make sure that the date vec allows for 0.5 days at reversal and learning
     meta = update_meta_date_vec(meta)
 
@@ -351,18 +439,14 @@ def tensor_mean_per_stage_filtered(meta, tensor, initial_cue=True, cue='plus', n
     else:
         ablated_tensor = tensor
 
-    # get average response per day to a single cue
-    stages = lookups.staging[staging]
-    new_tensor = np.zeros((tensor.shape[0], tensor.shape[1], len(stages)))
-    new_tensor[:] = np.nan
-    for c, di in enumerate(stages):
-        stage_boo = meta[staging].isin([di]).values
-        new_tensor[:, :, c] = np.nanmean(ablated_tensor[:, :, stage_boo & cue_bool], axis=2)
+    # get average response per stage to a single cue
+    codes, stages = trial_groups(meta, staging, labels=lookups.staging[staging])
+    new_tensor = group_reduce(ablated_tensor, codes, len(stages), trial_bool=cue_bool.values)
 
     return new_tensor
 
 
-def tensor_mean_per_stage_single_pt(meta, tensor, account_for_offset=True, **kwargs):
+def tensor_mean_per_stage_single_pt(meta, tensor, account_for_offset=True, summary=None, **kwargs):
     """
     Single data point for each trial. Take the mean of the stimulus window, or preferred window for that cell
     (i.e., offset cells are averaged following the stimulus offset, during the response window).
@@ -373,6 +457,8 @@ def tensor_mean_per_stage_single_pt(meta, tensor, account_for_offset=True, **kwa
         Matrix organized like this: tensor[cells, time points, trials].
     :param account_for_offset : boolean
         Optionally take mean of activity based on peak activity. Uses stimulus or response window.
+    :param summary: TensorSummary
+        Optional summary of tensor to reuse offset cells between calls.
     :param kwargs: takes kwargs for tensor_mean_per_stage, defaults:
         initial_cue=True, cue='plus', nan_licking=False, staging='parsed_11stage'
     :return: stage_matrix
@@ -394,7 +480,7 @@ def tensor_mean_per_stage_single_pt(meta, tensor, account_for_offset=True, **kwa
 
     # optionally determine cells with offset responses
     if account_for_offset:
-        offset_bool = get_offset_cells(meta, tensor)
+        offset_bool = get_offset_cells(meta, tensor, summary=summary)
         # trace_mean = np.nanmean(mtensor, axis=2)
         # offset_bool = np.argmax(trace_mean, axis=1) > 15.5 * (1 + lookups.stim_length[mouse])
 
@@ -409,9 +495,10 @@ def tensor_mean_per_stage_single_pt(meta, tensor, account_for_offset=True, **kwa
     return stage_matrix
 
 
-def get_offset_cells(meta, tensor, buffer_s=0.300):
+def get_offset_cells(meta, tensor, buffer_s=0.300, summary=None):
     """
-    Determine cells with offset responses.
+    Determine cells with offset responses. Pass a TensorSummary of the tensor
+    as summary to reuse results between calls.
 
     Note: meta is only used to determine mouse name.
 
@@ -423,29 +510,13 @@ def get_offset_cells(meta, tensor, buffer_s=0.300):
     assert len(meta.reset_index()['mouse'].unique()) == 1
     mouse = meta.reset_index()['mouse'].unique()[0]
 
-    # determine cells with offset responses
-    trace_mean = np.nanmean(tensor, axis=2)
-    stim_offset_buffer_start = int(np.floor(15.5 * (1 + lookups.stim_length[mouse] - buffer_s)))
-    stim_offset_buffer_end = int(np.floor(15.5 * (1 + lookups.stim_length[mouse] + buffer_s)))
-    trace_mean[:, stim_offset_buffer_start:stim_offset_buffer_end] = np.nan  # buffer around offset to avoid GECI tail
-    trace_mean[:, :18] = np.nan  # buffer baseline with a few extra frames, ~200 ms
-
-    # account for nans
-    offset_bool = np.zeros(trace_mean.shape[0])
-    offset_bool[:] = np.nan
-    nan_boo = ~np.isnan(trace_mean[:, 18])
-    offset_bool[nan_boo] = np.nanargmax(trace_mean[nan_boo, :], axis=1)
-    offset_bool = offset_bool > 15.5 * (1 + lookups.stim_length[mouse])
-    # WARNING using inverse will mean nans are counted as stimulus cells
-
-    return offset_bool
+    return _summary_of(tensor, summary).offset_cells(mouse, buffer_s=buffer_s).copy()
 
 
-def get_peak_times(tensor):
+def get_peak_times(tensor, summary=None):
     """
-    Determine peak response time
-
-    Note: meta is only used to determine mouse name.
+    Determine peak response time. Pass a TensorSummary of the tensor as
+    summary to reuse results between calls.
 
     :return: peak_times: float
         Peak time in seconds relative to stimulus onset
@@ -454,13 +525,145 @@ def get_peak_times(tensor):
     # tensor must be 15.5 Hz use a proxy assertion for now
     assert tensor.shape[1] == 108  # 108 is the number of frames for 15.5 Hz
 
-    # determine cells with offset responses
-    trace_mean = np.nanmean(tensor, axis=2)
-    trace_mean[:, :16] = np.nan  # buffer baseline
-    peak_frames = np.nanargmax(trace_mean, axis=1)
-    peak_times = (peak_frames - 15.5)/15.5
+    return _summary_of(tensor, summary).peak_times().copy()
+
+
+def _summary_of(tensor, summary=None):
+    """The summary passed by the caller, or a new one used for a single call."""
+
+    if summary is None:
+        return TensorSummary(tensor)
+    assert summary.tensor is tensor, 'summary was made for a different tensor.'
+    return summary
+
+
+class TensorSummary(object):
+    """
+    Trial-mean trace, offset cell classification, peak times, and per trial
+    window means of a cells x times x trials tensor. Each is computed once
+    on first use and reused.
+
+    The caller creates and owns the summary and passes it (summary=...) to
+    tensor_mean_per_trial, tensor_mean_baselines_per_trial,
+    get_offset_cells and get_peak_times to share results between calls. The
+    summary does not notice changes to the tensor, so make a new one (or
+    call clear) after editing the tensor in place.
+    """
+
+    def __init__(self, tensor):
+        """
+        :param tensor: numpy.ndarray or store.TensorStore, cells x times x trials
+        """
+
+        self.tensor = tensor
+        self._cache = {}
+
+    def clear(self):
+        """Forget all cached results, i.e., after the tensor was edited."""
+
+        self._cache = {}
+
+    def _cached(self, key, func):
+        if key not in self._cache:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                self._cache[key] = func()
+        return self._cache[key]
 
-    return peak_times
+    def trace_mean(self):
+        """
+        :return: numpy.ndarray, cells x times, mean across trials
+        """
+
+        return self._cached('trace_mean', lambda: np.nanmean(self.tensor, axis=2))
+
+    def window_mean(self, start, stop):
+        """
+        :param start: int, first frame of window
+        :param stop: int, frame after the last frame of window
+        :return: numpy.ndarray, cells x trials, mean across the window
+        """
+
+        return self._cached(('window_mean', start, stop),
+                            lambda: np.nanmean(self.tensor[:, start:stop, :], axis=1))
+
+    def offset_cells(self, mouse, buffer_s=0.300):
+        """
+        See get_offset_cells.
+
+        :return: boolean numpy.ndarray, true for offset cells
+        """
+
+        def _offset_cells():
+            # determine cells with offset responses
+            trace_mean = self.trace_mean().copy()
+            stim_offset_buffer_start = int(np.floor(15.5 * (1 + lookups.stim_length[mouse] - buffer_s)))
+            stim_offset_buffer_end = int(np.floor(15.5 * (1 + lookups.stim_length[mouse] + buffer_s)))
+            trace_mean[:, stim_offset_buffer_start:stim_offset_buffer_end] = np.nan  # buffer around offset to avoid GECI tail
+            trace_mean[:, :18] = np.nan  # buffer baseline with a few extra frames, ~200 ms
+
+            # account for nans
+            offset_bool = np.zeros(trace_mean.shape[0])
+            offset_bool[:] = np.nan
+            nan_boo = ~np.isnan(trace_mean[:, 18])
+            offset_bool[nan_boo] = np.nanargmax(trace_mean[nan_boo, :], axis=1)
+            # WARNING using inverse will mean nans are counted as stimulus cells
+            return offset_bool > 15.5 * (1 + lookups.stim_length[mouse])
+
+        return self._cached(('offset_cells', mouse, buffer_s), _offset_cells)
+
+    def peak_times(self):
+        """
+        See get_peak_times.
+
+        :return: numpy.ndarray, peak time of each cell in seconds relative to
+                 stimulus onset
+        """
+
+        def _peak_times():
+            trace_mean = self.trace_mean().copy()
+            trace_mean[:, :16] = np.nan  # buffer baseline
+            peak_frames = np.nanargmax(trace_mean, axis=1)
+            return (peak_frames - 15.5)/15.5
+
+        return self._cached('peak_times', _peak_times)
+
+    def trial_means(self, mouse, account_for_offset=False):
+        """
+        Mean of the stimulus window of each trial, or of the response window
+        for offset cells if account_for_offset. See tensor_mean_per_trial.
+
+        :return: numpy.ndarray, cells x trials
+        """
+
+        def _trial_means():
+            stim_win, response_win = _stim_response_windows(mouse)
+            stim_mean = self.window_mean(*stim_win)
+            if not account_for_offset:
+                return stim_mean
+            offset_bool = self.offset_cells(mouse)
+            new_mat = np.zeros(stim_mean.shape)
+            new_mat[offset_bool, :] = self.window_mean(*response_win)[offset_bool, :]
+            new_mat[~offset_bool, :] = stim_mean[~offset_bool, :]
+            return new_mat
+
+        return self._cached(('trial_means', mouse, account_for_offset), _trial_means)
+
+
+def _stim_response_windows(mouse):
+    """
+    Frames (start, stop) of the stimulus and response windows of a 108 frame
+    (15.5 Hz) trial, see tensor_mean_per_trial.
+    """
+
+    times = np.arange(-1, 6, 1 / 15.5)[:108]
+    stim_bool = (times > 0) & (times < lookups.stim_length[mouse])
+    response_bool = (times > lookups.stim_length[mouse] + 0.0) & (times < lookups.stim_length[mouse] + 2)  # 0ms delay
+    stim_frames = np.where(stim_bool)[0]
+    response_frames = np.where(response_bool)[0]
+
+    return ((stim_frames[0], stim_frames[-1] + 1),
+            (response_frames[0], response_frames[-1] + 1))
 
 
 def correct_nonneg(ensemble):
@@ -493,25 +696,7 @@ def add_dprime_to_meta(meta):
     column of the dprime calculated per day.
     """
 
-    # meta can only be a data frame of a single mouse
-    assert len(meta.reset_index()['mouse'].unique()) == 1
-
-    # collect useful variables
-    new_dprime = np.zeros(len(meta))
-    days = meta.reset_index()['date']
-    unique_days = days.unique()
-    mouse = meta.reset_index()['mouse']
-
-    # loop over unique days filling in dprime for all trial per day at once
-    for di in unique_days:
-        day_bool = days == di
-        mi = mouse[day_bool].unique()[0]
-        new_dprime[day_bool] = pool.calc.performance.dprime(
-            flow.Date(mouse=mi, date=di),
-            hmm_engaged=True)
-
-    # save new_dprime into meta
-    meta['dprime'] = new_dprime
+    meta['dprime'] = _meta_dprime(meta, {})['dprime']
 
     return meta
 
@@ -522,29 +707,7 @@ def add_dprime_run_to_meta(meta):
     column of the dprime calculated per day.
     """
 
-    # meta can only be a data frame of a single mouse
-    assert len(meta.reset_index()['mouse'].unique()) == 1
-
-    # collect useful variables
-    new_dprime = np.zeros(len(meta))
-    days = meta.reset_index()['date']
-    unique_days = days.unique()
-    mouse = meta.reset_index()['mouse']
-    runs = meta.reset_index()['run']
-
-    # loop over unique days filling in dprime for all trial per day at once
-    for di in unique_days:
-        day_bool = days == di
-        mi = mouse[day_bool].unique()[0]
-        for ri in runs[day_bool].unique():
-            run_bool = runs == ri
-            run_bool = day_bool & run_bool
-            new_dprime[run_bool] = pool.calc.performance.dprime_run(
-                flow.Run(mouse=mi, date=di, run=ri),
-                hmm_engaged=True)
-
-    # save new_dprime into meta
-    meta['dprime_run'] = new_dprime
+    meta['dprime_run'] = _meta_dprime_run(meta, {})['dprime_run']
 
     return meta
 
@@ -557,32 +720,7 @@ def add_firstlick_wmedian_to_meta(meta):
 
     # make sure that the date vec allows for 0.5 days at reversal and learning
     meta = update_meta_date_vec(meta)
-    mouse = meta.reset_index()['mouse'].unique()[0]
-
-    # buffer = 1/15.5*2 = 129 ms
-    buffer_ms = 2
-
-    # get lick latency in terms of frames
-    lick = meta['firstlick'].values
-    cs = meta['condition'].values
-    new_lick = np.zeros(len(lick))
-
-    # find median lick latency for all plus trials (looking across stim and response window)
-    last_trial_frame = (1 + 2 + lookups.stim_length[mouse]) * 15.5  # last frame of response window
-    last_stim_frame = (1 + lookups.stim_length[mouse]) * 15.5  # last frame of stimulus window
-    median_for_plus = np.nanmedian(lick[(lick < last_trial_frame) & np.isin(cs, 'plus')])
-    new_lick[:] = median_for_plus
-
-    # break if you will have less than 350 ms of datapoints for your bias calculation
-    assert median_for_plus > 21
-
-    # add in existing licks with 129 ms buffer before them, only update lick latency on plus trials
-    # for all other trials use the median lick latency of plus trials or first lick, whichever is sooner
-    lick_in_window_boo = lick < last_stim_frame
-    lick_before_median = lick < median_for_plus
-    new_lick[lick_in_window_boo & np.isin(cs, 'plus')] = lick[lick_in_window_boo & np.isin(cs, 'plus')] - buffer_ms
-    new_lick[lick_before_median & ~np.isin(cs, 'plus')] = lick[lick_before_median & ~np.isin(cs, 'plus')]
-    meta['firstlick_med'] = new_lick
+    meta['firstlick_med'] = _meta_firstlick_med(meta, {})['firstlick_med']
 
     return meta
 
@@ -595,32 +733,7 @@ def add_firstlickbout_wmedian_to_meta(meta):
 
     # make sure that the date vec allows for 0.5 days at reversal and learning
     meta = update_meta_date_vec(meta)
-    mouse = meta.reset_index()['mouse'].unique()[0]
-
-    # buffer = 1/15.5*2 = 129 ms
-    buffer_ms = 2
-
-    # get lick latency in terms of frames
-    lick = meta['firstlickbout'].values
-    cs = meta['condition'].values
-    new_lick = np.zeros(len(lick))
-
-    # find median lick latency for all plus trials (looking across stim and response window)
-    last_trial_frame = (1 + 2 + lookups.stim_length[mouse]) * 15.5  # last frame of response window
-    last_stim_frame = (1 + lookups.stim_length[mouse]) * 15.5  # last frame of stimulus window
-    median_for_plus = np.nanmedian(lick[(lick < last_trial_frame) & np.isin(cs, 'plus')])
-    new_lick[:] = median_for_plus
-
-    # break if you will have less than 350 ms of datapoints for your bias calculation
-    assert median_for_plus > 21
-
-    # add in existing licks with 129 ms buffer before them, only update lick latency on plus trials
-    # for all other trials use the median lick latency of plus trials or first lick, whichever is sooner
-    lick_in_window_boo = lick < last_stim_frame
-    lick_before_median = lick < median_for_plus
-    new_lick[lick_in_window_boo & np.isin(cs, 'plus')] = lick[lick_in_window_boo & np.isin(cs, 'plus')] - buffer_ms
-    new_lick[lick_before_median & ~np.isin(cs, 'plus')] = lick[lick_before_median & ~np.isin(cs, 'plus')]
-    meta['firstlickbout_med'] = new_lick
+    meta['firstlickbout_med'] = _meta_firstlickbout_med(meta, {})['firstlickbout_med']
 
     return meta
 
@@ -635,41 +748,7 @@ def add_firstlick_wmedian_run_to_meta(meta):
 
     # make sure that the date vec allows for 0.5 days at reversal and learning
     meta = update_meta_date_vec(meta)
-    mouse = meta.reset_index()['mouse'].unique()[0]
-
-    # buffer = 1/15.5*2 = 129 ms
-    buffer_ms = 2
-
-    # get vector for looping over
-    u_days = np.unique(meta.reset_index()['date'])
-    all_days = meta.reset_index()['date'].values
-
-    # get lick latency in terms of frames
-    lick = meta['firstlick'].values
-    cs = meta['condition'].values
-    new_lick = np.zeros(len(lick))
-
-    # find median lick latency for all plus trials
-    median_for_plus = np.zeros(len(meta))
-    last_trial_frame = (1 + 2 + lookups.stim_length[mouse]) * 15.5
-    last_stim_frame = (1 + lookups.stim_length[mouse]) * 15.5
-    day_vec = meta.reset_index()['date']
-    run_vec = meta.reset_index()['run']
-    for di in day_vec.unique():
-        day_bool = day_vec.isin([di])
-        curr_runs = run_vec.iloc[day_bool.values]
-        for ri in curr_runs.unique():
-            run_bool = day_bool & run_vec.isin([ri])
-            median_for_plus[run_bool] = np.nanmedian(lick[(lick < last_trial_frame) & np.isin(cs, 'plus') & run_bool])
-    new_lick = median_for_plus
-
-    # break if you will have less than 300 ms of datapoints for your bias calculation
-    assert np.nanmin(median_for_plus) > 21
-
-    # add in existing licks with 129 ms buffer before them
-    lick_in_window_boo = lick < last_stim_frame
-    new_lick[lick_in_window_boo] = lick[lick_in_window_boo] - buffer_ms
-    meta['firstlick_med_run'] = new_lick
+    meta['firstlick_med_run'] = _meta_firstlick_med_run(meta, {})['firstlick_med_run']
 
     return meta
 
@@ -684,23 +763,7 @@ def add_prev_ori_cols_to_meta(meta):
     create similar columns for orientation presentations. 
     """
 
-    # meta can only be a data frame of a single mouse
-    assert len(meta.reset_index()['mouse'].unique()) == 1
-
-    # boolean for cues preceded by the same cue
-    prev_same_boo = (meta['prev_same_plus'].gt(0)
-                     | meta['prev_same_neutral'].gt(0)
-                     | meta['prev_same_minus'].gt(0))
-
-    # create column for each ori if it was preceded by the same ori
-    for ori in [0, 135, 270]:
-        curr_ori_bool = meta['orientation'].isin([ori]).values
-        new_meta = {f'prev_same_{ori}': np.zeros(len(meta))}
-        new_meta[f'prev_same_{ori}'][prev_same_boo & curr_ori_bool] = 1
-        new_meta_df = pd.DataFrame(data=new_meta, index=meta.index)
-        meta = pd.concat([meta, new_meta_df], axis=1)
-
-    return meta
+    return meta.assign(**_meta_prev_same_ori(meta, {}))
 
 
 def add_reversal_mismatch_condition_to_meta(meta):
@@ -711,40 +774,7 @@ def add_reversal_mismatch_condition_to_meta(meta):
     Possible types: 'becomes_rewarded', 'becomes_unrewarded', 'remains_unrewarded'.
     """
 
-    # meta can only be a data frame of a single mouse
-    assert len(meta.reset_index()['mouse'].unique()) == 1
-
-    # must have a reversal to add a mismatch column
-    if not meta['learning_state'].isin(['reversal1']).any():
-        meta['mismatch_condition'] = ['none'] * len(meta)
-        return meta
-
-    # create column for each ori if it was preceded by the same ori
-    new_mapping = {}
-    for ori in [0, 135, 270]:
-        curr_ori_bool = meta['orientation'].isin([ori]).values
-        list_of_conds = meta['condition'].loc[curr_ori_bool].unique()  # pandas unique is in order of appearance
-        list_of_conds = [s for s in list_of_conds if 'naive' != s]
-
-        # get new naming convention
-        if len(list_of_conds) == 2:
-            if list_of_conds[0] == 'plus':
-                new_mapping[ori] = 'becomes_unrewarded'
-            else:
-                if list_of_conds[1] == 'plus':
-                    new_mapping[ori] = 'becomes_rewarded'
-                else:
-                    new_mapping[ori] = 'remains_unrewarded'
-        elif len(list_of_conds) == 1:
-            # deal with sub-case where Arthur's mice keep same minus cue across reversal
-            assert list_of_conds[0] == 'minus'
-            new_mapping[ori] = 'remains_unrewarded'
-        else:
-            raise NotImplementedError
-
-    # add column to meta
-    new_mismatch_conditions = [new_mapping[s] for s in meta['orientation'].values]
-    meta['mismatch_condition'] = new_mismatch_conditions
+    meta['mismatch_condition'] = _meta_mismatch_condition(meta, {})['mismatch_condition']
 
     return meta
 
@@ -755,113 +785,7 @@ def add_cue_prob_to_meta(meta):
     trial history. 
     """
 
-    # meta can only be a data frame of a single mouse
-    assert len(meta.reset_index()['mouse'].unique()) == 1
-    mouse = meta.reset_index()['mouse'].unique()[0]
-
-    # add a binary column for choice, 1 for go 0 for nogo
-    new_meta = {}
-    new_meta['go'] = np.zeros(len(meta))
-    new_meta['go'][meta['trialerror'].isin([0, 3, 5, 7]).values] = 1
-    new_meta_df1 = pd.DataFrame(data=new_meta, index=meta.index)
-    # new_meta_df1 = pd.concat([new_meta_df1, new_meta_df], axis=1)
-
-    # add a binary column for reward
-    new_meta = {}
-    new_meta['reward'] = np.zeros(len(new_meta_df1))
-    new_meta['reward'][meta['trialerror'].isin([0]).values] = 1
-    new_meta_df = pd.DataFrame(data=new_meta, index=meta.index)
-    new_meta_df1 = pd.concat([new_meta_df1, new_meta_df], axis=1)
-
-    # add a binary column for punishment
-    new_meta = {}
-    new_meta['punishment'] = np.zeros(len(new_meta_df1))
-    new_meta['punishment'][meta['trialerror'].isin([5]).values] = 1
-    new_meta_df = pd.DataFrame(data=new_meta, index=meta.index)
-    new_meta_df1 = pd.concat([new_meta_df1, new_meta_df], axis=1)
-
-    # add a binary column for reward
-    # new_meta = {}
-    # new_meta['prev_reward'] = np.zeros(len(new_meta_df1))
-    # new_meta['prev_reward'][meta['prev_reward'].values] = 1
-    # new_meta_df = pd.DataFrame(data=new_meta, index=meta.index)
-    # new_meta_df1 = pd.concat([new_meta_df1, new_meta_df], axis=1)
-    #
-    # # add a binary column for punishment
-    # new_meta = {}
-    # new_meta['prev_punishment'] = np.zeros(len(new_meta_df1))
-    # new_meta['prev_punishment'][meta['prev_punishment'].values] = 1
-    # new_meta_df = pd.DataFrame(data=new_meta, index=meta.index)
-    # new_meta_df1 = pd.concat([new_meta_df1, new_meta_df], axis=1)
-
-    # rename oris according to their meaning during learning
-    for ori in ['plus', 'minus', 'neutral']:
-        new_meta = {}
-        new_meta['initial_{}'.format(ori)] = np.zeros(len(new_meta_df1))
-        new_meta['initial_{}'.format(ori)][meta['orientation'].isin([lookups.lookup[mouse][ori]]).values] = 1
-        new_meta_df = pd.DataFrame(data=new_meta, index=meta.index)
-        new_meta_df1 = pd.concat([new_meta_df1, new_meta_df], axis=1)
-
-    # create epochs since last reward
-    c = 0
-    vec = []
-    for s in new_meta_df1['reward'].values:
-        if s == 0:
-            vec.append(c)
-        else:
-            vec.append(c)
-            c += 1
-    new_meta_df1['reward_cum'] = vec
-
-    # since last go
-    c = 0
-    vec = []
-    for s in new_meta_df1['go'].values:
-        if s == 0:
-            vec.append(c)
-        else:
-            vec.append(c)
-            c += 1
-    new_meta_df1['go_cum'] = vec
-
-    # since last of same cue type
-    for ori in ['plus', 'minus', 'neutral']:
-        c = 0
-        vec = []
-        for s in new_meta_df1['initial_{}'.format(ori)].values:
-            if s == 0:
-                vec.append(c)
-            else:
-                vec.append(c)
-                c += 1
-        new_meta_df1['initial_{}_cum'.format(ori)] = vec
-
-    # vec of ones for finding denominator across a number of trials
-    new_meta_df1['trial_number'] = np.ones((len(new_meta_df1)))
-
-    # loop over different accumulators to get full length interaction terms
-    p_cols = []
-    for aci in ['initial_plus', 'initial_minus', 'initial_neutral', 'go', 'reward']:
-        accumulated_df = new_meta_df1.groupby('{}_cum'.format(aci)).sum()
-        prob_since_last = accumulated_df.divide(accumulated_df['trial_number'], axis=0)
-        for vali in ['initial_plus', 'initial_minus', 'initial_neutral', 'go', 'reward']:
-            new_vec = np.zeros(len(new_meta_df1))
-            new_vec[:] = np.nan
-            new_bool = new_meta_df1[aci].gt(0).values
-            new_vec[new_bool] = prob_since_last[vali].values[0:np.sum(new_bool)]  # use only matched trials
-            new_meta_df1['p_{}_since_last_{}'.format(vali, aci)] = new_vec
-            p_cols.append('p_{}_since_last_{}'.format(vali, aci))
-
-    # turn go, reward, punishment into boolean
-    grp_df = new_meta_df1.loc[:, ['go', 'reward', 'punishment']].gt(0)
-
-    # get only columns for probability 
-    p_df = new_meta_df1.loc[:, p_cols]
-
-    # add new columns to original df
-    new_dfr = pd.concat([meta, grp_df, p_df], axis=1)
-
-    return new_dfr
+    return meta.assign(**_meta_cue_prob(meta, {}))
 
 
 def update_meta_date_vec(meta):
@@ -871,15 +795,16 @@ def update_meta_date_vec(meta):
     """
 
     day_vec = np.array(meta.reset_index()['date'].values, dtype='float')
-    days = np.unique(day_vec)
     ls = meta['learning_state'].values
-    for di in days:
-        dboo = np.isin(day_vec, di)
-        states_vec = ls[dboo]
-        u_states = np.unique(states_vec)
-        if len(u_states) > 1:
-            second_state = dboo & (ls == u_states[1])
-            day_vec[second_state] += 0.5
+
+    # on days with more than one learning state, shift the second (sorted)
+    # state by half a day
+    pairs = pd.DataFrame({'date': day_vec, 'ls': ls}).drop_duplicates()
+    pairs = pairs.sort_values(['date', 'ls'])
+    second_state = pairs.loc[pairs.groupby('date').cumcount().values == 1]
+    shift = pd.MultiIndex.from_arrays([day_vec, ls]).isin(
+        pd.MultiIndex.from_frame(second_state))
+    day_vec[shift] += 0.5
 
     # replace
     new_meta = meta.reset_index()
@@ -901,22 +826,9 @@ def add_sub_stages_to_meta(meta, staging='parsed_11stage', bins_per_stage=10):
     if staging not in meta.columns:
         meta = add_stages_to_meta(meta, staging)
 
-    bin_vec = np.zeros(len(meta))
-    for stage in meta[staging].unique():
-        stage_boo = meta[staging].isin([stage])
-        stage_inds = np.where(stage_boo)[0]
-        bin_size = int(np.floor(len(stage_inds)/bins_per_stage))
-        # bins = np.arange(stage_inds[0], stage_inds[-1] + bin_size, bin_size)
-        for bi in range(bins_per_stage):
-
-            # account for floor rounding above for last bin
-            if bi == bins_per_stage - 1:
-                ind_chunk = stage_inds[bi * bin_size:] 
-            else:
-                ind_chunk = stage_inds[bi * bin_size:(bi+1) * bin_size]
-            bin_vec[ind_chunk] = bi
+    pars = {'staging': staging, 'bins_per_stage': bins_per_stage}
+    meta['stage_bins'] = _meta_stage_bins(meta, pars)['stage_bins']
 
-    meta['stage_bins'] = bin_vec
     return meta
 
 
@@ -931,11 +843,7 @@ def add_numeric_stages_to_meta(meta, staging='parsed_11stage'):
     if staging not in meta.columns:
         meta = add_stages_to_meta(meta, staging)
 
-    bin_vec = np.zeros(len(meta))
-    for c, stage in enumerate(lookups.staging[staging]):
-        stage_boo = meta[staging].isin([stage])
-        bin_vec[stage_boo] = c
-    meta['numeric_stage'] = bin_vec
+    meta['numeric_stage'] = _meta_numeric_stage(meta, {'staging': staging})['numeric_stage']
 
     return meta
 
@@ -983,112 +891,423 @@ def add_5stages_to_meta(meta, dp_by_run=True):
         meta = add_dprime_run_to_meta(meta)
     meta = update_meta_date_vec(meta)
 
-    ls = meta['learning_state'].values
-    if dp_by_run:
-        dp = meta['dprime_run'].values
-    else:
-        dp = meta['dprime'].values
+    meta['parsed_stage'] = _meta_parsed_stage(meta, {'dp_by_run': dp_by_run})['parsed_stage']
+
+    return meta
+
+
+def add_11stages_to_meta(meta, dp_by_run=True, bin_scale=0.75):
+    """
+    Helper function to add the stage of learning to metadata. Uses evenly spaced dprime bins.
+    Naive is treated as a single bin.
+    """
+
+    if 'dprime' not in meta.columns:
+        meta = add_dprime_to_meta(meta)
+    if 'dprime_run' not in meta.columns:
+        meta = add_dprime_run_to_meta(meta)
+    meta = update_meta_date_vec(meta)
+
+    pars = {'dp_by_run': dp_by_run, 'bin_scale': bin_scale}
+    meta['parsed_11stage'] = _meta_parsed_11stage(meta, pars)['parsed_11stage']
+
+    return meta
+
+
+def add_10stages_to_meta(meta, simple=False, dp_by_run=True):
+    """
+    Helper function to add the stage of learning to metadata breaking
+    each of the 5 major stages ['naive', 'low_dp learning', 'high_dp learning',
+    'low_dp reversal1', 'high_dp reversal1'] into an early and late stages.
+    
+    Can choose to divide trials in half or days in half.
+
+    simple=True: Divide trials in a stage right down the middle.
+
+    simple=False: Divide days. Single days are NOT broken in half. They are
+    attributed to the later period. This is to prevent groups of cells that
+    change dramatically within a day from affecting results if they are highly
+    responsive at the beginning of the day but not at the end.
+
+    """
+
+    # make sure parsed stage exists so you can loop over this.
+    if 'parsed_stage' not in meta.columns:
+        meta = add_5stages_to_meta(meta, dp_by_run=dp_by_run)
+    meta = update_meta_date_vec(meta)
+
+    pars = {'dp_by_run': dp_by_run, 'simple': simple}
+    meta['parsed_10stage'] = _meta_parsed_10stage(meta, pars)['parsed_10stage']
+
+    return meta
+
+
+def enrich_meta(meta, enrichments, force=False, verbose=False, **pars):
+    """
+    Add derived trial columns (see meta_enrichments) to trial metadata in
+    one pass. Enrichments that others depend on are added first, i.e.,
+    'parsed_10stage' also adds 'dprime', 'dprime_run' and 'parsed_stage'.
+
+    Each enrichment that runs is recorded in meta.attrs['enrichments']
+    with a fingerprint of its input columns and parameters. Enrichments
+    whose columns exist and whose fingerprint is unchanged are skipped, so
+    calling this again (or on meta reloaded with its enriched columns) only
+    recomputes stale columns. See stale_meta_columns.
+
+    :param meta: pandas.DataFrame, trial metadata of a single mouse
+    :param enrichments: list of str, names of enrichments to add
+    :param force: boolean, recompute enrichments even if they are current
+    :param verbose: boolean, print the enrichments that run
+    :param pars: parameters of enrichments, see _meta_enrichment_pars
+    :return: meta, with new columns (and an updated date vector if any
+             enrichment needs it, see update_meta_date_vec)
+    """
+
+    pars = dict(_meta_enrichment_pars, **pars)
+    record = dict(meta.attrs.get('enrichments', {}))
+
+    # add dependencies, keeping registry order
+    needed = set()
+
+    def _require(name):
+        assert name in meta_enrichments, 'Unknown enrichment: {}'.format(name)
+        for req in meta_enrichments[name]['requires']:
+            _require(req.format(**pars))
+        needed.add(name)
+    for name in enrichments:
+        _require(name)
+
+    date_vec = False
+    for name, spec in meta_enrichments.items():
+        if name not in needed:
+            continue
+        if spec['date_vec'] and not date_vec:
+            meta = update_meta_date_vec(meta)
+            date_vec = True
+        columns = [c.format(**pars) for c in spec['columns']]
+        key = _meta_enrichment_key(meta, spec, pars)
+        if (not force and name in record and record[name]['key'] == key
+                and all([c in meta.columns for c in columns])):
+            continue
+        if verbose:
+            print('Enriching meta: {}'.format(name))
+        for col, vals in spec['func'](meta, pars).items():
+            meta[col] = vals
+        record[name] = {'key': key, 'columns': columns,
+                        'pars': {p: pars[p] for p in spec['pars']}}
+
+    meta.attrs['enrichments'] = record
+
+    return meta
+
+
+def stale_meta_columns(meta):
+    """
+    Find columns added by enrich_meta whose inputs have changed since they
+    were computed (i.e., after update_naive_meta changes naive trialerror).
+
+    :param meta: pandas.DataFrame, trial metadata
+    :return: list of str, stale columns
+    """
+
+    stale = []
+    for name, rec in meta.attrs.get('enrichments', {}).items():
+        spec = meta_enrichments[name]
+        pars = dict(_meta_enrichment_pars, **rec['pars'])
+        missing = [c for c in rec['columns'] if c not in meta.columns]
+        if len(missing) > 0 or _meta_enrichment_key(meta, spec, pars) != rec['key']:
+            stale.extend(rec['columns'])
+
+    return stale
+
+
+def _meta_enrichment_key(meta, spec, pars):
+    """
+    Fingerprint of the input columns and parameters of an enrichment. Dates
+    are floored so that the .5 days added by update_meta_date_vec do not
+    change it.
+    """
+
+    h = hashlib.sha1()
+    for col in spec['inputs']:
+        col = col.format(**pars)
+        vals = _meta_column(meta, col)
+        if col == 'date':
+            vals = np.floor(vals.astype(float))
+        h.update(pd.util.hash_array(np.asarray(vals)).tobytes())
+    h.update(repr([(p, pars[p]) for p in spec['pars']]).encode())
+
+    return h.hexdigest()
+
+
+def _meta_column(meta, col):
+    """Values of a column or index level of trial metadata."""
+
+    if col in meta.columns:
+        return meta[col].values
+    return meta.index.get_level_values(col).values
+
+
+def _meta_dprime(meta, pars):
+    """Dprime per day, computed once for each day."""
+
+    mouse = meta_mouse(meta)
+    days = np.floor(_meta_column(meta, 'date').astype(float)).astype(int)
+    u_days, inverse = np.unique(days, return_inverse=True)
+    dprime = np.array([
+        pool.calc.performance.dprime(flow.Date(mouse=mouse, date=int(di)), hmm_engaged=True)
+        for di in u_days])
+
+    return {'dprime': dprime[inverse]}
+
+
+def _meta_dprime_run(meta, pars):
+    """Dprime per run, computed once for each run."""
+
+    mouse = meta_mouse(meta)
+    days = np.floor(_meta_column(meta, 'date').astype(float)).astype(int)
+    runs = _meta_column(meta, 'run')
+    codes, u_runs = pd.factorize(pd.MultiIndex.from_arrays([days, runs]))
+    dprime = np.array([
+        pool.calc.performance.dprime_run(
+            flow.Run(mouse=mouse, date=int(di), run=int(ri)), hmm_engaged=True)
+        for di, ri in u_runs])
+
+    return {'dprime_run': dprime[codes]}
+
+
+def _firstlick_med(lick, cs, mouse):
+    """
+    Lick latency (in frames) of plus trials with a 129 ms buffer, using the
+    median plus trial latency for slow or missing licks and for other cues.
+    """
+
+    # buffer = 1/15.5*2 = 129 ms
+    buffer_ms = 2
+
+    # find median lick latency for all plus trials (looking across stim and response window)
+    last_trial_frame = (1 + 2 + lookups.stim_length[mouse]) * 15.5  # last frame of response window
+    last_stim_frame = (1 + lookups.stim_length[mouse]) * 15.5  # last frame of stimulus window
+    plus = np.isin(cs, 'plus')
+    median_for_plus = np.nanmedian(lick[(lick < last_trial_frame) & plus])
+    new_lick = np.zeros(len(lick))
+    new_lick[:] = median_for_plus
+
+    # break if you will have less than 350 ms of datapoints for your bias calculation
+    assert median_for_plus > 21
+
+    # add in existing licks with 129 ms buffer before them, only update lick latency on plus trials
+    # for all other trials use the median lick latency of plus trials or first lick, whichever is sooner
+    lick_in_window_boo = lick < last_stim_frame
+    lick_before_median = lick < median_for_plus
+    new_lick[lick_in_window_boo & plus] = lick[lick_in_window_boo & plus] - buffer_ms
+    new_lick[lick_before_median & ~plus] = lick[lick_before_median & ~plus]
+
+    return new_lick
+
+
+def _meta_firstlick_med(meta, pars):
+    """First lick with the median plus latency for slow or missing licks."""
+
+    return {'firstlick_med': _firstlick_med(
+        meta['firstlick'].values, meta['condition'].values, meta_mouse(meta))}
+
+
+def _meta_firstlickbout_med(meta, pars):
+    """First lick bout with the median plus latency for slow or missing licks."""
+
+    return {'firstlickbout_med': _firstlick_med(
+        meta['firstlickbout'].values, meta['condition'].values, meta_mouse(meta))}
+
+
+def _meta_firstlick_med_run(meta, pars):
+    """First lick with the median plus latency of each run for slow or missing licks."""
+
+    mouse = meta_mouse(meta)
+
+    # buffer = 1/15.5*2 = 129 ms
+    buffer_ms = 2
+
+    # get lick latency in terms of frames
+    lick = meta['firstlick'].values
+    cs = meta['condition'].values
+    last_trial_frame = (1 + 2 + lookups.stim_length[mouse]) * 15.5
+    last_stim_frame = (1 + lookups.stim_length[mouse]) * 15.5
+
+    # find median lick latency for all plus trials of each run
+    plus_lick = np.where((lick < last_trial_frame) & np.isin(cs, 'plus'), lick, np.nan)
+    median_for_plus = pd.Series(plus_lick).groupby(
+        [_meta_column(meta, 'date'), _meta_column(meta, 'run')]).transform('median').values
+    new_lick = np.array(median_for_plus, dtype=float)
+
+    # break if you will have less than 300 ms of datapoints for your bias calculation
+    assert np.nanmin(median_for_plus) > 21
+
+    # add in existing licks with 129 ms buffer before them
+    lick_in_window_boo = lick < last_stim_frame
+    new_lick[lick_in_window_boo] = lick[lick_in_window_boo] - buffer_ms
+
+    return {'firstlick_med_run': new_lick}
+
+
+def _meta_prev_same_ori(meta, pars):
+    """Binary columns for each orientation if it was preceded by the same cue."""
+
+    # meta can only be a data frame of a single mouse
+    assert len(meta.reset_index()['mouse'].unique()) == 1
+
+    # boolean for cues preceded by the same cue
+    prev_same_boo = (meta['prev_same_plus'].gt(0)
+                     | meta['prev_same_neutral'].gt(0)
+                     | meta['prev_same_minus'].gt(0)).values
+
+    # create column for each ori if it was preceded by the same ori
+    new_meta = {}
+    for ori in [0, 135, 270]:
+        curr_ori_bool = meta['orientation'].isin([ori]).values
+        new_meta[f'prev_same_{ori}'] = (prev_same_boo & curr_ori_bool).astype(float)
+
+    return new_meta
+
+
+def _meta_mismatch_condition(meta, pars):
+    """Orientations renamed by the type of mismatch that occurs at reversal."""
+
+    # meta can only be a data frame of a single mouse
+    assert len(meta.reset_index()['mouse'].unique()) == 1
+
+    # must have a reversal to add a mismatch column
+    if not meta['learning_state'].isin(['reversal1']).any():
+        return {'mismatch_condition': ['none'] * len(meta)}
+
+    # create column for each ori if it was preceded by the same ori
+    new_mapping = {}
+    for ori in [0, 135, 270]:
+        curr_ori_bool = meta['orientation'].isin([ori]).values
+        list_of_conds = meta['condition'].loc[curr_ori_bool].unique()  # pandas unique is in order of appearance
+        list_of_conds = [s for s in list_of_conds if 'naive' != s]
+
+        # get new naming convention
+        if len(list_of_conds) == 2:
+            if list_of_conds[0] == 'plus':
+                new_mapping[ori] = 'becomes_unrewarded'
+            else:
+                if list_of_conds[1] == 'plus':
+                    new_mapping[ori] = 'becomes_rewarded'
+                else:
+                    new_mapping[ori] = 'remains_unrewarded'
+        elif len(list_of_conds) == 1:
+            # deal with sub-case where Arthur's mice keep same minus cue across reversal
+            assert list_of_conds[0] == 'minus'
+            new_mapping[ori] = 'remains_unrewarded'
+        else:
+            raise NotImplementedError
+
+    return {'mismatch_condition': meta['orientation'].map(new_mapping).values}
+
+
+_cue_prob_events = ('initial_plus', 'initial_minus', 'initial_neutral', 'go', 'reward')
+
 
-    stage_vec = []
-    for lsi, dpi in zip(ls, dp):
-
-        if 'naive' in lsi:
-            stage_vec.append('naive')
-        elif 'learning' in lsi:
-            if dpi < 2:
-                stage_vec.append('low_dp learning')
-            elif dpi >= 2:
-                stage_vec.append('high_dp learning')
-        elif 'reversal1' in lsi:
-            if dpi < 2:
-                stage_vec.append('low_dp reversal1')
-            elif dpi >= 2:
-                stage_vec.append('high_dp reversal1')
-
-    meta['parsed_stage'] = stage_vec
+def _meta_cue_prob(meta, pars):
+    """
+    Boolean go, reward and punishment columns and the probability of each
+    event type over the trials since the last event of each type.
+    """
 
-    return meta
+    # meta can only be a data frame of a single mouse
+    assert len(meta.reset_index()['mouse'].unique()) == 1
+    mouse = meta.reset_index()['mouse'].unique()[0]
 
+    # binary vectors for choice (1 for go 0 for nogo), reward, punishment,
+    # and oris renamed according to their meaning during learning
+    events = {}
+    for ori in ['plus', 'minus', 'neutral']:
+        events['initial_{}'.format(ori)] = meta['orientation'].isin(
+            [lookups.lookup[mouse][ori]]).values.astype(float)
+    events['go'] = meta['trialerror'].isin([0, 3, 5, 7]).values.astype(float)
+    events['reward'] = meta['trialerror'].isin([0]).values.astype(float)
+    punishment = meta['trialerror'].isin([5]).values.astype(float)
+    new_meta = {'go': events['go'] > 0, 'reward': events['reward'] > 0,
+                'punishment': punishment > 0}
+
+    # for each accumulator, the epoch of every trial is the number of events
+    # before it. The nth event trial gets the probability of each event
+    # over epoch n.
+    for aci in _cue_prob_events:
+        epoch = (np.cumsum(events[aci]) - events[aci]).astype(int)
+        n_trials = np.bincount(epoch)
+        aci_bool = events[aci] > 0
+        for vali in _cue_prob_events:
+            prob_since_last = np.bincount(epoch, weights=events[vali]) / n_trials
+            new_vec = np.zeros(len(meta))
+            new_vec[:] = np.nan
+            new_vec[aci_bool] = prob_since_last[0:np.sum(aci_bool)]  # use only matched trials
+            new_meta['p_{}_since_last_{}'.format(vali, aci)] = new_vec
 
-def add_11stages_to_meta(meta, dp_by_run=True, bin_scale=0.75):
+    return new_meta
+
+
+def _stage_labels(ls, conditions):
     """
-    Helper function to add the stage of learning to metadata. Uses evenly spaced dprime bins.
-    Naive is treated as a single bin.
+    Label trials with the first stage name whose condition is True, given
+    (learning state substring, condition, stage name) tuples.
     """
 
-    if 'dprime' not in meta.columns:
-        meta = add_dprime_to_meta(meta)
-    if 'dprime_run' not in meta.columns:
-        meta = add_dprime_run_to_meta(meta)
-    meta = update_meta_date_vec(meta)
+    labels = np.empty(len(ls), dtype=object)
+    labels[:] = np.nan
+    ls = pd.Series(ls).astype(str)
+    taken = np.zeros(len(ls), dtype=bool)
+    for state in ['naive', 'learning', 'reversal1']:
+        state_boo = ls.str.contains(state).values & ~taken
+        for substr, cond, name in conditions:
+            if substr == state:
+                labels[state_boo & cond] = name
+        taken |= state_boo
 
-    ls = meta['learning_state'].values
-    if dp_by_run:
-        dp = meta['dprime_run'].values
-    else:
-        dp = meta['dprime'].values
+    return labels
 
-    stage_vec = []
-    for lsi, dpi in zip(ls, dp):
-
-        if 'naive' in lsi:
-            stage_vec.append('L0 naive')
-        elif 'learning' in lsi:
-            if dpi <= 1 * bin_scale:
-                stage_vec.append('L1 learning')
-            elif 1 * bin_scale < dpi <= 2 * bin_scale:
-                stage_vec.append('L2 learning')
-            elif 2 * bin_scale < dpi <= 3 * bin_scale:
-                stage_vec.append('L3 learning')
-            elif 3 * bin_scale < dpi <= 4 * bin_scale:
-                stage_vec.append('L4 learning')
-            elif dpi > 4 * bin_scale:
-                stage_vec.append('L5 learning')
-        elif 'reversal1' in lsi:
-            if dpi <= 1 * bin_scale:
-                stage_vec.append('L1 reversal1')
-            elif 1 * bin_scale < dpi <= 2 * bin_scale:
-                stage_vec.append('L2 reversal1')
-            elif 2 * bin_scale < dpi <= 3 * bin_scale:
-                stage_vec.append('L3 reversal1')
-            elif 3 * bin_scale < dpi <= 4 * bin_scale:
-                stage_vec.append('L4 reversal1')
-            elif dpi > 4 * bin_scale:
-                stage_vec.append('L5 reversal1')
-
-    meta['parsed_11stage'] = stage_vec
 
-    return meta
+def _meta_parsed_stage(meta, pars):
+    """Naive or low/high dprime learning and reversal stages."""
 
+    ls = meta['learning_state'].values
+    dp = meta['dprime_run'].values if pars['dp_by_run'] else meta['dprime'].values
+    allv = np.ones(len(dp), dtype=bool)
+    conditions = [('naive', allv, 'naive'),
+                  ('learning', dp < 2, 'low_dp learning'),
+                  ('learning', dp >= 2, 'high_dp learning'),
+                  ('reversal1', dp < 2, 'low_dp reversal1'),
+                  ('reversal1', dp >= 2, 'high_dp reversal1')]
 
-def add_10stages_to_meta(meta, simple=False, dp_by_run=True):
-    """
-    Helper function to add the stage of learning to metadata breaking
-    each of the 5 major stages ['naive', 'low_dp learning', 'high_dp learning',
-    'low_dp reversal1', 'high_dp reversal1'] into an early and late stages.
-    
-    Can choose to divide trials in half or days in half.
+    return {'parsed_stage': _stage_labels(ls, conditions)}
 
-    simple=True: Divide trials in a stage right down the middle.
 
-    simple=False: Divide days. Single days are NOT broken in half. They are
-    attributed to the later period. This is to prevent groups of cells that
-    change dramatically within a day from affecting results if they are highly
-    responsive at the beginning of the day but not at the end.
+def _meta_parsed_11stage(meta, pars):
+    """Naive or one of five evenly spaced dprime bins of learning and reversal."""
 
-    """
+    ls = meta['learning_state'].values
+    dp = meta['dprime_run'].values if pars['dp_by_run'] else meta['dprime'].values
+    edges = np.arange(1, 5) * pars['bin_scale']
+    level = np.searchsorted(edges, dp, side='left') + 1
+    valid = ~np.isnan(dp)
+    conditions = [('naive', np.ones(len(dp), dtype=bool), 'L0 naive')]
+    for state in ['learning', 'reversal1']:
+        for li in range(1, 6):
+            conditions.append((state, valid & (level == li), 'L{} {}'.format(li, state)))
+
+    return {'parsed_11stage': _stage_labels(ls, conditions)}
 
-    # make sure parsed stage exists so you can loop over this.
-    if 'parsed_stage' not in meta.columns:
-        meta = add_5stages_to_meta(meta, dp_by_run=dp_by_run)
-    meta = update_meta_date_vec(meta)
+
+def _meta_parsed_10stage(meta, pars):
+    """Each of the 5 major stages broken into early and late stages."""
 
     # get days and parsed stages of learning
     u_stages = meta['parsed_stage'].unique()
     parse = meta['parsed_stage']
 
     # get days or run-days if dp is being set by training run/session
-    if dp_by_run:
+    if pars['dp_by_run']:
         # run number must be less than 10 for decimals for runs to work (+.2 for run 2, etc)
         assert all(meta.reset_index()['run'].unique() < 10)
         all_days = meta.reset_index()['date'] + meta.reset_index()['run'] / 10
@@ -1100,46 +1319,116 @@ def add_10stages_to_meta(meta, simple=False, dp_by_run=True):
 
         # simple=False; break a stage in half but assign shared days to later
         # period. i.e., if there are 3 days, 1 day is early and 2 are late.
-        if simple:
-            stage_bool = parse.isin([istage]).values
-            stage_inds = np.where(stage_bool)[0]
-            midpoint = int(np.ceil(len(stage_inds) / 2))
-            first_half = stage_inds[:midpoint]
-            last_half = stage_inds[midpoint:]
-
-            # add the appropriate number of stage values to the list
-            # s is not used, it is just important that the loop run this many iteration
-            for s in first_half:
-                stage_vec.append('early {}'.format(istage))
-            for s in last_half:
-                stage_vec.append('late {}'.format(istage))
+        stage_bool = parse.isin([istage]).values
+        if pars['simple']:
+            n_trials = np.sum(stage_bool)
+            midpoint = int(np.ceil(n_trials / 2))
+            n_first, n_last = midpoint, n_trials - midpoint
         else:
-            stage_bool = parse.isin([istage]).values
             stage_days = all_days.iloc[stage_bool].unique()
-            day_bool = np.isin(all_days.values, stage_days)
 
             # if a stage only has one day consider it late
             if len(stage_days) == 1:
-                stage_inds = np.where(day_bool)[0]
-                for s in stage_inds:
-                    stage_vec.append('late {}'.format(istage))
+                n_first = 0
+                n_last = np.sum(np.isin(all_days.values, stage_days))
             else:
                 day_mid = int(np.floor(len(stage_days) / 2))
-                first_days = stage_days[:day_mid]
-                last_days = stage_days[day_mid:]
-                day_bool1 = np.isin(all_days.values, first_days)
-                day_bool2 = np.isin(all_days.values, last_days)
-                clean_first_inds = np.where(day_bool1)[0]
-                clean_last_inds = np.where(day_bool2)[0]
-                # s is not used, it is just important that the loop run this many iteration
-                for s in clean_first_inds:
-                    stage_vec.append('early {}'.format(istage))
-                for s in clean_last_inds:
-                    stage_vec.append('late {}'.format(istage))
-
-    meta['parsed_10stage'] = stage_vec
-
-    return meta
+                n_first = np.sum(np.isin(all_days.values, stage_days[:day_mid]))
+                n_last = np.sum(np.isin(all_days.values, stage_days[day_mid:]))
+        stage_vec.extend(['early {}'.format(istage)] * n_first)
+        stage_vec.extend(['late {}'.format(istage)] * n_last)
+
+    return {'parsed_10stage': stage_vec}
+
+
+def _meta_stage_bins(meta, pars):
+    """Each stage broken into bins of equal numbers of trials."""
+
+    bins_per_stage = pars['bins_per_stage']
+    stages = meta[pars['staging']]
+    grouped = stages.groupby(stages.values, sort=False)
+    position = grouped.cumcount().values
+    bin_size = np.floor(grouped.transform('size').values / bins_per_stage).astype(int)
+
+    # account for floor rounding for last bin
+    bin_vec = np.full(len(meta), bins_per_stage - 1)
+    has_bins = bin_size > 0
+    bin_vec[has_bins] = np.minimum(position[has_bins] // bin_size[has_bins],
+                                   bins_per_stage - 1)
+
+    return {'stage_bins': bin_vec.astype(float)}
+
+
+def _meta_numeric_stage(meta, pars):
+    """Stages numbered in the order of lookups.staging."""
+
+    staging = pars['staging']
+    order = {stage: c for c, stage in enumerate(lookups.staging[staging])}
+
+    return {'numeric_stage': meta[staging].map(order).fillna(0).values.astype(float)}
+
+
+# default parameters of enrichments
+_meta_enrichment_pars = {'dp_by_run': True, 'bin_scale': 0.75, 'simple': False,
+                         'staging': 'parsed_11stage', 'bins_per_stage': 10}
+
+
+def _enrichment(func, inputs, columns, requires=(), pars=(), date_vec=False):
+    """Registry entry of an enrichment, see meta_enrichments."""
+
+    return {'func': func, 'inputs': inputs, 'columns': columns,
+            'requires': requires, 'pars': pars, 'date_vec': date_vec}
+
+
+# Trial metadata enrichments applied in order by enrich_meta. Each func
+# (meta, pars) returns a dict of new columns computed from its inputs (columns
+# or index levels) and pars (names of parameters it uses). requires lists
+# enrichments that must run first and date_vec marks enrichments that need
+# update_meta_date_vec. '{staging}' is filled in from pars.
+meta_enrichments = OrderedDict([
+    ('dprime', _enrichment(
+        _meta_dprime, ('mouse', 'date'), ('dprime',))),
+    ('dprime_run', _enrichment(
+        _meta_dprime_run, ('mouse', 'date', 'run'), ('dprime_run',))),
+    ('firstlick_med', _enrichment(
+        _meta_firstlick_med, ('mouse', 'date', 'learning_state', 'condition', 'firstlick'),
+        ('firstlick_med',), date_vec=True)),
+    ('firstlickbout_med', _enrichment(
+        _meta_firstlickbout_med, ('mouse', 'date', 'learning_state', 'condition', 'firstlickbout'),
+        ('firstlickbout_med',), date_vec=True)),
+    ('firstlick_med_run', _enrichment(
+        _meta_firstlick_med_run,
+        ('mouse', 'date', 'run', 'learning_state', 'condition', 'firstlick'),
+        ('firstlick_med_run',), date_vec=True)),
+    ('prev_same_ori', _enrichment(
+        _meta_prev_same_ori,
+        ('prev_same_plus', 'prev_same_neutral', 'prev_same_minus', 'orientation'),
+        ('prev_same_0', 'prev_same_135', 'prev_same_270'))),
+    ('mismatch_condition', _enrichment(
+        _meta_mismatch_condition, ('learning_state', 'orientation', 'condition'),
+        ('mismatch_condition',))),
+    ('cue_prob', _enrichment(
+        _meta_cue_prob, ('mouse', 'orientation', 'trialerror'),
+        ('go', 'reward', 'punishment') + tuple(
+            ['p_{}_since_last_{}'.format(v, a) for a in _cue_prob_events
+             for v in _cue_prob_events]))),
+    ('parsed_stage', _enrichment(
+        _meta_parsed_stage, ('learning_state', 'dprime', 'dprime_run'), ('parsed_stage',),
+        requires=('dprime', 'dprime_run'), pars=('dp_by_run',), date_vec=True)),
+    ('parsed_10stage', _enrichment(
+        _meta_parsed_10stage, ('date', 'run', 'learning_state', 'parsed_stage'),
+        ('parsed_10stage',), requires=('parsed_stage',), pars=('dp_by_run', 'simple'),
+        date_vec=True)),
+    ('parsed_11stage', _enrichment(
+        _meta_parsed_11stage, ('learning_state', 'dprime', 'dprime_run'), ('parsed_11stage',),
+        requires=('dprime', 'dprime_run'), pars=('dp_by_run', 'bin_scale'), date_vec=True)),
+    ('stage_bins', _enrichment(
+        _meta_stage_bins, ('{staging}',), ('stage_bins',), requires=('{staging}',),
+        pars=('staging', 'bins_per_stage'))),
+    ('numeric_stage', _enrichment(
+        _meta_numeric_stage, ('{staging}',), ('numeric_stage',), requires=('{staging}',),
+        pars=('staging',))),
+])
 
 
 def update_naive_meta(meta, verbose=True):
@@ -1324,7 +1613,8 @@ def getcstraces(
     cs : str
         Type of CS. e.g., plus, minus, neutral, 0, 135, 270, ...
     trace_type : str
-        dff, zscore, zscore_iti, deconvolved
+        dff, zscore, zscore_iti, deconvolved, followed by any stage
+        suffixes in trace_stages, e.g., zscore_day_onset_trunc
     downsample : bool
         Downsample from 31 to 15 Hz sampling rate
     clean_artifacts : str
@@ -1353,111 +1643,76 @@ def getcstraces(
 
     """
 
-    t2p = run.trace2p()
     date = run.parent
     date.set_subset(run.cells)
 
     # always exclude bad runs
     exclude_tags = exclude_tags + ('bad',)
 
-    # standardize: z-score
-    if 'zscore' in trace_type.lower():
+    # triggered tensors are cached by base trace type and by each prefix of
+    # the stage pipeline (see trace_stages), so that i.e. zscore_day_trunc
+    # reuses the triggered zscore_day tensor
+    base_type = trace_base_type(trace_type)
+    stages = trace_pipeline(trace_type, smooth=smooth)
+    key = (run.mouse, run.date, run.run,
+           None if run.cells is None else np.asarray(run.cells).tobytes(),
+           base_type, cs, start_time, end_time, downsample, warp,
+           clean_artifacts, thresh, smooth, smooth_win, smooth_win_dec,
+           tuple(exclude_tags))
+    done = len(stages)
+    while done >= 0 and key + tuple(stages[:done]) not in _stage_cache:
+        done -= 1
+    if done >= 0:
+        run_traces = _use_cached_traces(_stage_cache, key + tuple(stages[:done]))
+    else:
+        done = 0
+        run_traces = _triggered_traces(
+            run, cs, base_type, start_time=start_time, end_time=end_time,
+            downsample=downsample, clean_artifacts=clean_artifacts,
+            thresh=thresh, warp=warp, smooth=smooth, smooth_win=smooth_win,
+            exclude_tags=exclude_tags)
+        _cache_stage(key, run_traces)
 
-        # get dff for creation of alternative trace_types
-        traces = t2p.trace('dff')
+    # apply the remaining stages in order
+    pars = {'trace_type': trace_type, 'downsample': downsample,
+            'smooth_win_dec': smooth_win_dec}
+    for i in range(done, len(stages)):
+        run_traces = trace_stages[stages[i]]['func'](run_traces, run, pars)
+        _cache_stage(key + tuple(stages[:i + 1]), run_traces)
 
-        # clean artifacts
-        if clean_artifacts:
-            nanpad = np.zeros(np.shape(traces))
-            nanpad[np.abs(traces) > thresh] = 1
-            print(np.sum(nanpad.flatten()))
-            # dialate around threshold crossings
-            for cell in range(np.shape(traces)[0]):
-                nanpad[cell, :] = np.convolve(nanpad[cell, :], np.ones(3), mode='same')
-            # clear with nans or interpolation
-            if clean_artifacts.lower() == 'nan':
-                traces[nanpad != 0] = np.nan
-            elif clean_artifacts.lower() == 'interp':
-                x = np.arange(0, np.shape(traces)[1])
-                for cell in range(np.shape(traces)[0]):
-                    # x = np.where(np.isfinite(run_traces[cell, :]))[0]
-                    if np.nansum(nanpad[cell, :]) > 0:
-                        blank = np.where(nanpad[cell, :] != 0)[0]
-                        keep = np.where(nanpad[cell, :] == 0)[0]
-                        traces[cell, blank] = np.interp(x[blank], x[keep],
-                                                        traces[cell, keep])
-
-        # z-score
-        if 'zscore' in trace_type.lower():
-            arti = False if clean_artifacts is None else True
-            if 'zscore_day' in trace_type.lower():
-                mu = pool.calc.zscore.mu(date, exclude_tags=exclude_tags, nan_artifacts=arti,
-                                         thresh=thresh)
-                sigma = pool.calc.zscore.sigma(date, exclude_tags=exclude_tags,
-                                               nan_artifacts=arti,
-                                               thresh=thresh)
-            elif 'zscore_iti' in trace_type.lower():
-                mu = pool.calc.zscore.iti_mu(date, exclude_tags=exclude_tags,
-                                             window=4,
-                                             nan_artifacts=arti, thresh=thresh)
-                sigma = pool.calc.zscore.iti_sigma(date,
-                                                   exclude_tags=exclude_tags,
-                                                   window=4,
-                                                   nan_artifacts=arti,
-                                                   thresh=thresh)
-            elif 'zscore_run' in trace_type.lower():
-                mu = pool.calc.zscore.run_mu(run, nan_artifacts=arti,
-                                             thresh=thresh)
-                sigma = pool.calc.zscore.run_sigma(run, nan_artifacts=arti,
-                                                   thresh=thresh)
-            else:
-                print('WARNING: did not recognize z-scoring method.')
-            traces = ((traces.T - mu) / sigma).T
+    # copy so that callers can not change cached tensors
+    return run_traces.copy()
 
-        # smooth data
-        # should always be even to treat both 15 and 30 Hz data equivalently
-        assert smooth_win % 2 == 0
-        if smooth and (t2p.d['framerate'] > 30):
-            for cell in range(np.shape(traces)[0]):
-                traces[cell, :] = np.convolve(
-                    traces[cell, :], np.ones(smooth_win,
-                                             dtype=np.float64) / smooth_win, 'same')
-        elif smooth and (t2p.d['framerate'] < 16):
-            for cell in range(np.shape(traces)[0]):
-                traces[cell, :] = np.convolve(
-                    traces[cell, :], np.ones(int(smooth_win / 2),
-                                             dtype=np.float64) / (smooth_win / 2), 'same')
 
-        # add new trace type into t2p
-        t2p.add_trace(trace_type, traces)
+def _triggered_traces(
+        run,
+        cs,
+        trace_type,
+        start_time=-1,
+        end_time=6,
+        downsample=True,
+        clean_artifacts=None,
+        thresh=17.5,
+        warp=False,
+        smooth=True,
+        smooth_win=6,
+        exclude_tags=('bad',)):
+    """
+    Trigger a base trace type (no stage suffixes) around stimulus onsets and
+    downsample to 15 Hz, the first step of getcstraces.
 
-    # normalize: (X-min)/(max)
-    elif '_norm' in trace_type.lower():
-        arti = False if clean_artifacts is None else True  # artifact removal
+    :return: numpy.ndarray, ncells x frames x nstimuli/onsets
+    """
 
-        # get dff for creation of alternative trace_types
-        traces = t2p.trace('dff')
+    t2p = run.trace2p()
 
-        # subtract the min and divide by max of stimulus windows
-        mx = pool.calc.zscore.stim_max(date, window=5, nan_artifacts=arti,
-                                       thresh=thresh)
-        mn = pool.calc.zscore.stim_min(date, window=5, nan_artifacts=arti,
-                                       thresh=thresh)
-        traces = ((traces.T - mn) / mx).T
-
-        # smooth traces
-        # should always be even to treat both 15 and 30 Hz data equivalently
-        assert smooth_win % 2 == 0
-        if smooth and (t2p.d['framerate'] > 30):
-            for cell in range(np.shape(traces)[0]):
-                traces[cell, :] = np.convolve(
-                    traces[cell, :], np.ones(smooth_win,
-                                             dtype=np.float64) / smooth_win, 'same')
-        elif smooth and (t2p.d['framerate'] < 16):
-            for cell in range(np.shape(traces)[0]):
-                traces[cell, :] = np.convolve(
-                    traces[cell, :], np.ones(int(smooth_win / 2),
-                                             dtype=np.float64) / (smooth_win / 2), 'same')
+    # full-session z-scored or normalized traces, cached per run and
+    # computed from statistics that are cached per day
+    if 'zscore' in trace_type.lower() or '_norm' in trace_type.lower():
+        traces = _session_traces(
+            run, trace_type=trace_type, clean_artifacts=clean_artifacts,
+            thresh=thresh, smooth=smooth, smooth_win=smooth_win,
+            exclude_tags=exclude_tags)
 
         # add new trace type into t2p
         t2p.add_trace(trace_type, traces)
@@ -1499,86 +1754,438 @@ def getcstraces(
             run_traces = run_traces[:, :-1, :]
             sz = np.shape(run_traces)
         # downsample
-        # ignore python and numpy divide by zero warnings
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            with np.errstate(invalid='ignore', divide='ignore'):
-                ds_traces = np.zeros((sz[0], int(sz[1] / 2), sz[2]))
-                for trial in range(sz[2]):
-                    a = run_traces[:, :, trial].reshape(sz[0], int(sz[1] / 2), 2)
-                    if 'deconvolved' in trace_type.lower():
-                        ds_traces[:, :, trial] = np.nanmax(a, axis=2)
-                    else:
-                        ds_traces[:, :, trial] = np.nanmean(a, axis=2)
+        if 'deconvolved' in trace_type.lower():
+            run_traces = _bin_frames(run_traces, 2, np.nanmax)
+        else:
+            run_traces = _bin_frames(run_traces, 2, np.nanmean)
 
-        run_traces = ds_traces
+    return run_traces
 
-    # bin data
-    if '_bin' in trace_type.lower():
-        assert 'deconvolved' in trace_type.lower(), 'Only deconvolved traces can be binned'
-        bin_factor = 4
-        # make sure divisible by bin factor
-        sz = np.shape(run_traces)  # dims: (cells, time, trials)
-        if sz[1] % bin_factor > 0:
-            mod = z[1] % bin_factor
-            run_traces = run_traces[:, :-mod, :]
-            sz = np.shape(run_traces)
-        # bin
-        # ignore python and numpy divide by zero warnings
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            with np.errstate(invalid='ignore', divide='ignore'):
-                ds_traces = np.zeros((sz[0], int(sz[1] / bin_factor), sz[2]))
-                for trial in range(sz[2]):
-                    a = run_traces[:, :, trial].reshape(
-                        sz[0], int(sz[1] / bin_factor), bin_factor)
-                    ds_traces[:, :, trial] = np.nansum(a, axis=2)
 
-        run_traces = ds_traces
+def _stage_bin(run_traces, run, pars):
+    """Sum deconvolved traces into bins of 4 frames."""
 
-    # smooth deconvolved data
-    if smooth and 'deconvolved' in trace_type.lower():
-        sz = np.shape(run_traces)  # dims: (cells, time, trials)
-        run_traces = run_traces.reshape((sz[0], sz[1] * sz[2]))
-        for cell in range(sz[0]):
-            run_traces[cell, :] = np.convolve(run_traces[cell, :],
-                                              np.ones(smooth_win_dec,
-                                                      dtype=np.float64) / smooth_win_dec,
-                                              'same')
-        run_traces = run_traces.reshape((sz[0], sz[1], sz[2]))
-
-    # invert values (to explicitly model inhibition)
-    if '_flip' in trace_type.lower():
-        run_traces = run_traces * -1
-
-    # shift baselines slightly positive
-    if '_bump' in trace_type.lower():
-        run_traces += 0.1
-
-    # truncate negative values (for NMF)
-    if '_trunc' in trace_type.lower():
-        run_traces[run_traces < 0] = 0
-
-    # only look at stimulus period 
-    if '_onset' in trace_type.lower():
-        time_to_off = lookups.stim_length[run.mouse] + 1
-        assert downsample
-        frames_to_off = int(np.floor(time_to_off * 15.5))
-        run_traces = run_traces[:, :frames_to_off, :]
-
-    # cap positive values for deconvolution at 2
-    if '_cap' in trace_type.lower():
-        run_traces[run_traces > 2] = 2
-        # if any entire trial now equals 2 set to nan
-        trial_mins = run_traces.min(axis=1)
-        for rt_cells in range(trial_mins.shape[0]):
-            for rt_trials in range(trial_mins.shape[1]):
-                if trial_mins[rt_cells, rt_trials] == 2:
-                    run_traces[rt_cells, :, rt_trials] = np.nan
+    assert 'deconvolved' in pars['trace_type'].lower(), 'Only deconvolved traces can be binned'
+    bin_factor = 4
+    # make sure divisible by bin factor
+    sz = np.shape(run_traces)  # dims: (cells, time, trials)
+    if sz[1] % bin_factor > 0:
+        mod = sz[1] % bin_factor
+        run_traces = run_traces[:, :-mod, :]
+
+    return _bin_frames(run_traces, bin_factor, np.nansum)
+
+
+def _stage_smooth_deconvolved(run_traces, run, pars):
+    """Smooth deconvolved traces across concatenated trials."""
+
+    sz = np.shape(run_traces)  # dims: (cells, time, trials)
+    run_traces = run_traces.reshape((sz[0], sz[1] * sz[2]))
+    run_traces = _boxcar_smooth(run_traces, pars['smooth_win_dec'])
+
+    return run_traces.reshape((sz[0], sz[1], sz[2]))
+
+
+def _smooth_deconvolved_when(trace_type, smooth):
+    """Deconvolved traces are smoothed unless smoothing is turned off."""
+
+    return smooth and 'deconvolved' in trace_type.lower()
+
+
+def _stage_flip(run_traces, run, pars):
+    """Invert values (to explicitly model inhibition)."""
+
+    return run_traces * -1
+
+
+def _stage_bump(run_traces, run, pars):
+    """Shift baselines slightly positive."""
+
+    return run_traces + 0.1
+
+
+def _stage_trunc(run_traces, run, pars):
+    """Truncate negative values (for NMF)."""
+
+    return np.where(run_traces < 0, 0, run_traces)
+
+
+def _stage_onset(run_traces, run, pars):
+    """Only keep the stimulus period."""
+
+    time_to_off = lookups.stim_length[run.mouse] + 1
+    assert pars['downsample']
+    frames_to_off = int(np.floor(time_to_off * 15.5))
+
+    return run_traces[:, :frames_to_off, :]
+
+
+def _stage_cap(run_traces, run, pars):
+    """Cap positive values at 2, nan trials that are capped entirely."""
+
+    run_traces = run_traces.copy()
+    run_traces[run_traces > 2] = 2
+    # if any entire trial now equals 2 set to nan
+    trial_mins = run_traces.min(axis=1)
+    run_traces[np.broadcast_to((trial_mins == 2)[:, None, :], run_traces.shape)] = np.nan
 
     return run_traces
 
 
+# Stages applied in order by getcstraces after triggering. Each stage is a
+# function (run_traces, run, pars) --> new run_traces that does not change its
+# input. Stages whose 'when' is None run if their name is a suffix of the
+# trace_type, others run if when(trace_type, smooth) is True.
+trace_stages = OrderedDict([
+    ('_bin', {'func': _stage_bin, 'when': None}),
+    ('smooth_deconvolved', {'func': _stage_smooth_deconvolved,
+                            'when': _smooth_deconvolved_when}),
+    ('_flip', {'func': _stage_flip, 'when': None}),
+    ('_bump', {'func': _stage_bump, 'when': None}),
+    ('_trunc', {'func': _stage_trunc, 'when': None}),
+    ('_onset', {'func': _stage_onset, 'when': None}),
+    ('_cap', {'func': _stage_cap, 'when': None}),
+])
+
+
+def register_trace_stage(name, func, when=None, before=None):
+    """
+    Add a stage to the getcstraces pipeline, or replace an existing one.
+
+    :param name: str, stage name, the trace_type suffix that turns it on
+        (i.e., '_clip') if when is None
+    :param func: function (run_traces, run, pars) --> run_traces, must return
+        a new array rather than change run_traces. pars holds 'trace_type',
+        'downsample', and 'smooth_win_dec'.
+    :param when: function (trace_type, smooth) --> bool, optional, decides if
+        the stage runs instead of the suffix
+    :param before: str, name of the stage to insert in front of, None appends
+        to the end of the pipeline
+    """
+
+    entry = {'func': func, 'when': when}
+    trace_stages.pop(name, None)
+    if before is None:
+        trace_stages[name] = entry
+    else:
+        assert before in trace_stages, 'Unknown stage: {}'.format(before)
+        stages = list(trace_stages.items())
+        trace_stages.clear()
+        for k, v in stages:
+            if k == before:
+                trace_stages[name] = entry
+            trace_stages[k] = v
+
+    # cached outputs may have come from the old stage
+    for key in _stage_cache:
+        _trace_cache_order.pop(key, None)
+    _stage_cache.clear()
+
+
+def trace_base_type(trace_type):
+    """
+    Strip all stage suffixes from a trace_type, i.e.,
+    'zscore_day_onset_trunc' --> 'zscore_day'.
+
+    :param trace_type: str, trace type passed to getcstraces
+    :return: str, trace type that is triggered from the Trace2P
+    """
+
+    for name, stage in trace_stages.items():
+        if stage['when'] is None:
+            trace_type = re.sub(re.escape(name), '', trace_type, flags=re.IGNORECASE)
+
+    return trace_type
+
+
+def trace_pipeline(trace_type, smooth=True):
+    """
+    Names of the stages getcstraces applies for a trace_type, in order.
+
+    :param trace_type: str, trace type passed to getcstraces
+    :param smooth: bool, smooth parameter passed to getcstraces
+    :return: list of str
+    """
+
+    pipeline = []
+    for name, stage in trace_stages.items():
+        if stage['when'] is None:
+            if name in trace_type.lower():
+                pipeline.append(name)
+        elif stage['when'](trace_type, smooth):
+            pipeline.append(name)
+
+    return pipeline
+
+
+_session_trace_cache = {}
+_session_trace_cache_max_bytes = 2 * 1024**3
+_stage_cache = {}
+# keys of both trace caches, least recently used first, values are the cache
+_trace_cache_order = OrderedDict()
+_day_stat_cache = {}
+
+
+def set_trace_cache_limit(max_bytes):
+    """
+    Set the memory budget shared by full-session traces cached by getcstraces
+    and triggered tensors cached after each pipeline stage. Least recently
+    used arrays of either cache are evicted to keep both together under it;
+    0 disables the caches.
+
+    :param max_bytes: int, budget in bytes
+    """
+
+    global _session_trace_cache_max_bytes
+    _session_trace_cache_max_bytes = max_bytes
+    _evict_session_traces()
+
+
+def clear_trace_cache():
+    """
+    Clear full-session traces, triggered tensors, and day statistics cached
+    by getcstraces.
+    """
+
+    _session_trace_cache.clear()
+    _stage_cache.clear()
+    _trace_cache_order.clear()
+    _day_stat_cache.clear()
+
+
+def _evict_session_traces():
+    """
+    Drop least recently used arrays from the session trace and stage caches
+    until both together are under budget.
+    """
+
+    total = (sum([v.nbytes for v in _session_trace_cache.values()])
+             + sum([v.nbytes for v in _stage_cache.values()]))
+    while total > _session_trace_cache_max_bytes and len(_trace_cache_order) > 0:
+        key, cache = _trace_cache_order.popitem(last=False)
+        total -= cache.pop(key).nbytes
+
+
+def _use_cached_traces(cache, key):
+    """Get an array from a trace cache, marking it most recently used."""
+
+    _trace_cache_order.move_to_end(key)
+    return cache[key]
+
+
+def _add_cached_traces(cache, key, traces):
+    """Add an array to a trace cache if it fits in the shared budget."""
+
+    if traces.nbytes <= _session_trace_cache_max_bytes:
+        cache[key] = traces
+        _trace_cache_order[key] = cache
+        _trace_cache_order.move_to_end(key)
+        _evict_session_traces()
+
+
+def _cache_stage(key, run_traces):
+    """Cache the triggered tensor after a pipeline stage."""
+
+    _add_cached_traces(_stage_cache, key, run_traces)
+
+
+def _day_stats(run, trace_type, exclude_tags, arti, thresh):
+    """
+    Normalization statistics for the cells of a run, computed once per day
+    (or per run for zscore_run) and cached.
+
+    :return: center, scale, numpy.ndarray, one value per cell: mu and sigma
+             for z-scoring or min and max for _norm
+    """
+
+    if 'zscore_run' in trace_type.lower():
+        key = (run.mouse, run.date, run.run, 'zscore_run', arti, thresh)
+    else:
+        kind = [k for k in ('zscore_day', 'zscore_iti', '_norm')
+                if k in trace_type.lower()]
+        kind = kind[0] if len(kind) > 0 else trace_type.lower()
+        key = (run.mouse, run.date, kind, tuple(exclude_tags), arti, thresh,
+               None if run.cells is None else np.asarray(run.cells).tobytes())
+    if key in _day_stat_cache:
+        return _day_stat_cache[key]
+
+    date = run.parent
+    date.set_subset(run.cells)
+    if 'zscore' in trace_type.lower():
+        if 'zscore_day' in trace_type.lower():
+            mu = pool.calc.zscore.mu(date, exclude_tags=exclude_tags, nan_artifacts=arti,
+                                     thresh=thresh)
+            sigma = pool.calc.zscore.sigma(date, exclude_tags=exclude_tags,
+                                           nan_artifacts=arti,
+                                           thresh=thresh)
+        elif 'zscore_iti' in trace_type.lower():
+            mu = pool.calc.zscore.iti_mu(date, exclude_tags=exclude_tags,
+                                         window=4,
+                                         nan_artifacts=arti, thresh=thresh)
+            sigma = pool.calc.zscore.iti_sigma(date,
+                                               exclude_tags=exclude_tags,
+                                               window=4,
+                                               nan_artifacts=arti,
+                                               thresh=thresh)
+        elif 'zscore_run' in trace_type.lower():
+            mu = pool.calc.zscore.run_mu(run, nan_artifacts=arti,
+                                         thresh=thresh)
+            sigma = pool.calc.zscore.run_sigma(run, nan_artifacts=arti,
+                                               thresh=thresh)
+        else:
+            print('WARNING: did not recognize z-scoring method.')
+        center, scale = mu, sigma
+    else:
+        # subtract the min and divide by max of stimulus windows
+        scale = pool.calc.zscore.stim_max(date, window=5, nan_artifacts=arti,
+                                          thresh=thresh)
+        center = pool.calc.zscore.stim_min(date, window=5, nan_artifacts=arti,
+                                           thresh=thresh)
+
+    _day_stat_cache[key] = (center, scale)
+
+    return center, scale
+
+
+def _session_traces(run, trace_type='zscore_day', clean_artifacts=None,
+                    thresh=17.5, smooth=True, smooth_win=6,
+                    exclude_tags=('bad',)):
+    """
+    Full-session z-scored or normalized (and optionally artifact cleaned and
+    smoothed) traces for a run, as added to the Trace2P by getcstraces.
+    Results are cached so every call for the same run and settings (i.e.,
+    for each cs) skips rereading dff, and day statistics are only computed
+    once for all runs of a day. See set_trace_cache_limit.
+
+    :return: numpy.ndarray, cells x frames
+    """
+
+    key = (run.mouse, run.date, run.run, trace_type, clean_artifacts, thresh,
+           smooth, smooth_win, tuple(exclude_tags),
+           None if run.cells is None else np.asarray(run.cells).tobytes())
+    if key in _session_trace_cache:
+        return _use_cached_traces(_session_trace_cache, key)
+
+    t2p = run.trace2p()
+    arti = False if clean_artifacts is None else True
+
+    # get dff for creation of alternative trace_types
+    traces = t2p.trace('dff')
+
+    # clean artifacts
+    if 'zscore' in trace_type.lower() and clean_artifacts:
+        with np.errstate(invalid='ignore'):
+            crossings = np.abs(traces) > thresh
+        print(np.sum(crossings))
+        # dialate around threshold crossings, one frame on each side
+        nanpad = _dilate_frames(crossings)
+        # clear with nans or interpolation
+        if clean_artifacts.lower() == 'nan':
+            traces[nanpad != 0] = np.nan
+        elif clean_artifacts.lower() == 'interp':
+            x = np.arange(0, np.shape(traces)[1])
+            for cell in range(np.shape(traces)[0]):
+                # x = np.where(np.isfinite(run_traces[cell, :]))[0]
+                if np.nansum(nanpad[cell, :]) > 0:
+                    blank = np.where(nanpad[cell, :] != 0)[0]
+                    keep = np.where(nanpad[cell, :] == 0)[0]
+                    traces[cell, blank] = np.interp(x[blank], x[keep],
+                                                    traces[cell, keep])
+
+    # standardize: z-score, or normalize: (X-min)/(max)
+    center, scale = _day_stats(run, trace_type, exclude_tags, arti, thresh)
+    traces = ((traces.T - center) / scale).T
+
+    # smooth data
+    # should always be even to treat both 15 and 30 Hz data equivalently
+    assert smooth_win % 2 == 0
+    if smooth and (t2p.d['framerate'] > 30):
+        traces = _boxcar_smooth(traces, smooth_win)
+    elif smooth and (t2p.d['framerate'] < 16):
+        traces = _boxcar_smooth(traces, int(smooth_win / 2))
+
+    _add_cached_traces(_session_trace_cache, key, traces)
+
+    return traces
+
+
+def _boxcar_smooth(traces, win):
+    """
+    Moving average over the last axis of every row, equivalent to
+    np.convolve(row, np.ones(win)/win, 'same') for each row (edges are zero
+    padded and nans only spread within the window). np.convolve has a fast
+    path for short kernels, so rows are convolved one at a time unless win is
+    in _batch_smooth_wins, where filtering the whole array at once with
+    scipy.ndimage.convolve1d was faster (i.e., smooth_win_dec=12 for
+    deconvolved data). uniform_filter1d is not used: its running sum carries a
+    nan to the end of the row.
+
+    :param traces: numpy.ndarray, cells x frames
+    :param win: int, window in frames
+    :return: numpy.ndarray, smoothed traces
+    """
+
+    kernel = np.ones(win, dtype=np.float64) / win
+    if win not in _batch_smooth_wins:
+        smoothed = np.empty(np.shape(traces), dtype=np.float64)
+        for cell in range(np.shape(traces)[0]):
+            smoothed[cell, :] = np.convolve(traces[cell, :], kernel, 'same')
+        return smoothed
+
+    # np.convolve centers even windows one frame later than ndimage
+    origin = -1 if win % 2 == 0 else 0
+    smoothed = ndimage.convolve1d(
+        np.asarray(traces, dtype=np.float64), kernel,
+        axis=-1, mode='constant', cval=0.0, origin=origin)
+
+    return smoothed
+
+
+# smoothing windows (frames) where ndimage.convolve1d beat per-row np.convolve
+# on 400 cells x 30000-60000 frames, see scripts/getcstraces_benchmark.py
+_batch_smooth_wins = range(12, 17)
+
+
+def _dilate_frames(mask):
+    """
+    Extend a boolean cells x frames mask by one frame on each side, like
+    convolving each row with np.ones(3). Shifted ors of the whole array are
+    faster than both a per-row loop and ndimage.binary_dilation.
+
+    :param mask: numpy.ndarray of bool, cells x frames
+    :return: numpy.ndarray of bool, dilated mask
+    """
+
+    dilated = mask.copy()
+    dilated[:, 1:] |= mask[:, :-1]
+    dilated[:, :-1] |= mask[:, 1:]
+
+    return dilated
+
+
+def _bin_frames(run_traces, factor, func=np.nanmean):
+    """
+    Combine every factor consecutive frames of all cells and trials at once,
+    i.e., to downsample 31 Hz data to 15 Hz. Trailing frames that do not fill
+    a bin are dropped.
+
+    :param run_traces: numpy.ndarray, cells x frames x trials
+    :param factor: int, number of frames per bin
+    :param func: function, nan-aware reduction, i.e., np.nanmean or np.nanmax
+    :return: numpy.ndarray, cells x frames/factor x trials
+    """
+
+    sz = np.shape(run_traces)
+    n_bins = int(sz[1] / factor)
+    binned = run_traces[:, :n_bins * factor, :].reshape(sz[0], n_bins, factor, sz[2])
+
+    # ignore python and numpy divide by zero warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return func(binned, axis=2)
+
+
 def getcsbehavior(
         run,
         cs='',
@@ -1708,6 +2315,31 @@ def sortfactors(my_method):
     return my_method, my_rank_sorts
 
 
+def apply_factor_sorts(my_method, my_rank_sorts):
+    """
+    Apply neuron factor sort orders (i.e., from sortfactors) to every
+    replicate of each rank.
+
+    Input
+    -------
+    Tensortools ensemble with method.
+    List of sort indexes, one for each rank in my_method.results.
+
+    Returns
+    -------
+    my_method, copy of tensortools ensemble method now with neuron factors sorted.
+
+    """
+
+    my_method = deepcopy(my_method)
+    for k, full_sort in zip(my_method.results.keys(), my_rank_sorts):
+        for i in range(len(my_method.results[k])):
+            factors = my_method.results[k][i].factors[0]
+            my_method.results[k][i].factors[0] = factors[full_sort, :]
+
+    return my_method
+
+
 def define_high_weight_cell_factors(model, rank, threshold=1):
     """
     Return the highest weight cluster for a cell. Note: this is an approximation. TCA suffers from
@@ -2052,3 +2684,57 @@ def flip_cell_index(meta):
         return meta.reset_index().set_index(['mouse', 'cell_id']).sort_index()
     elif 'cell_n' in meta.columns:
         return meta.reset_index().set_index(['mouse', 'cell_n']).sort_index()
+
+
+def trace_index_arrays(shape, cell_ids, timestamps):
+    """
+    Trial, cell, and time values for every element of a cells x times x
+    trials array flattened in C order, built without looping.
+
+    :param shape: tuple, shape of run_traces
+    :param cell_ids: list of int, cell id for each row of run_traces
+    :param timestamps: numpy.ndarray, time of each sample
+    :return: trial_vec, cell_vec, time_vec
+    """
+
+    n_cells, n_times, n_trials = shape
+    trial_vec = np.tile(np.arange(n_trials), n_cells*n_times)
+    cell_vec = np.repeat(np.asarray(cell_ids)[:n_cells], n_times*n_trials)
+    time_vec = np.tile(np.repeat(np.asarray(timestamps)[:n_times], n_trials), n_cells)
+
+    return trial_vec, cell_vec, time_vec
+
+
+def process_map(func, arg_list, n_jobs=1, initializer=None, initargs=()):
+    """
+    Helper function to map a function over a list of argument tuples, optionally
+    across a pool of worker processes. Results are always returned in the order
+    of arg_list so that parallel and serial output match.
+
+    :param func: function
+        Function to call, must be defined at the module level so it can be pickled.
+    :param arg_list: list of tuple
+        Positional arguments for each call to func.
+    :param n_jobs: int
+        Number of worker processes. 1 runs serially in this process, -1 (or None)
+        uses all available cores.
+    :param initializer: function
+        Optional function called once in each worker (or once in this process when
+        running serially) before any calls to func, i.e., to share a large array.
+    :param initargs: tuple
+        Positional arguments for initializer.
+    :return: list of func outputs
+    """
+
+    if n_jobs == 1 or len(arg_list) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return [func(*args) for args in arg_list]
+
+    max_workers = None if n_jobs is None or n_jobs < 1 else n_jobs
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=initializer,
+                             initargs=initargs) as executor:
+        futures = [executor.submit(func, *args) for args in arg_list]
+        results = [f.result() for f in futures]
+
+    return results